@@ -1,13 +1,65 @@
+import json
 import os
-import sqlite3
+import re
+import threading
+import time
+import uuid
 from datetime import datetime
-from typing import Any, Dict, Tuple, Optional, List
+from typing import Any, Dict, Iterator, Tuple, Optional, List
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, send_file, stream_with_context
 from flask_cors import CORS
-import requests
-
-from groq_client import ask_groq
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import metrics
+import timing
+from bot_webhook import SECRET_HEADER, WEBHOOK_PATH, handle_update, runner as webhook_runner, webhook_enabled
+from groq_client import GROQ_MODELS, ask_groq, ask_groq_stream, build_messages
+from groq_router import router as groq_router
+from image_jobs import make_job_queue
+from image_prep import InvalidImage, prep_stats, prepare_init_image
+from image_store import MIME_TYPES as IMAGE_MIME_TYPES, image_store, parse_name as parse_image_name
+from image_variants import formats_for, make_variants, variant_stats
+from log_forwarder import enqueue_log, send_log_now, log_stats
+# слой хранения — отдельный модуль без веб-зависимостей; имена остаются доступны и как api.*
+from storage import (  # noqa: F401
+    access_cache_stats,
+    clear_last_menu,
+    db_close,
+    db_init,
+    db_session,
+    get_access,
+    get_last_menu,
+    job_create,
+    job_delete,
+    job_finish,
+    job_get,
+    job_start,
+    mem_add,
+    mem_clear,
+    mem_compact,
+    mem_get,
+    peek_access,
+    set_blocked,
+    set_free,
+    set_last_menu,
+)
+from singleflight import (
+    CONFLICT,
+    DONE,
+    IDEMPOTENCY_TTL,
+    LEAD,
+    fingerprint,
+    make_flight_table,
+)
+from rate_limit import (
+    UpstreamBusy,
+    groq_gate,
+    is_priority,
+    rate_limiter,
+    retry_after_header,
+    stability_gate,
+)
 
 # ✅ Импортируем стабильность
 try:
@@ -21,7 +73,9 @@ except Exception as e:
     print(f"⚠️ Stability AI import error: {e}")
 
 api = Flask(__name__)
-CORS(api)
+CORS(api, expose_headers=["Server-Timing", "Retry-After", "Idempotent-Replayed"])
+# Railway проксирует запросы: берём схему/хост из X-Forwarded-* для абсолютных ссылок
+api.wsgi_app = ProxyFix(api.wsgi_app, x_proto=1, x_host=1)
 
 BOT_TOKEN = (os.getenv("BOT_TOKEN") or "").strip()
 
@@ -32,200 +86,15 @@ try:
 except Exception:
     GROUP_ID = 0
 
-# --- SQLite (простая база прав) ---
-DB_PATH = os.getenv("ACCESS_DB_PATH") or "access.db"
-
-
-def db_conn():
-    return sqlite3.connect(DB_PATH, check_same_thread=False)
-
-
-def db_init():
-    con = db_conn()
-    cur = con.cursor()
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS access (
-            user_id INTEGER PRIMARY KEY,
-            is_free INTEGER DEFAULT 0,
-            is_blocked INTEGER DEFAULT 0,
-            updated_at TEXT,
-            last_menu_chat_id INTEGER,
-            last_menu_message_id INTEGER
-        )
-        """
-    )
-    # ✅ память чата
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS chat_memory (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            role TEXT NOT NULL,               -- "user" | "assistant"
-            text TEXT NOT NULL,
-            created_at TEXT
-        )
-        """
-    )
-    con.commit()
-    con.close()
-
-
-db_init()
-
-
-def _ensure_columns():
-    """На случай если таблица была создана раньше без колонок меню."""
-    con = db_conn()
-    cur = con.cursor()
-    try:
-        cur.execute("ALTER TABLE access ADD COLUMN last_menu_chat_id INTEGER")
-    except Exception:
-        pass
-    try:
-        cur.execute("ALTER TABLE access ADD COLUMN last_menu_message_id INTEGER")
-    except Exception:
-        pass
-    con.commit()
-    con.close()
-
-
-_ensure_columns()
-
-
-# =========================
-# ACCESS (как было)
-# =========================
-def set_free(user_id: int, value: bool) -> None:
-    con = db_conn()
-    cur = con.cursor()
-    cur.execute(
-        """
-        INSERT INTO access (user_id, is_free, is_blocked, updated_at)
-        VALUES (?, ?, COALESCE((SELECT is_blocked FROM access WHERE user_id=?), 0), ?)
-        ON CONFLICT(user_id) DO UPDATE SET
-            is_free=excluded.is_free,
-            updated_at=excluded.updated_at
-        """,
-        (user_id, 1 if value else 0, user_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
-    )
-    con.commit()
-    con.close()
-
-
-def set_blocked(user_id: int, value: bool) -> None:
-    con = db_conn()
-    cur = con.cursor()
-    cur.execute(
-        """
-        INSERT INTO access (user_id, is_free, is_blocked, updated_at)
-        VALUES (?, COALESCE((SELECT is_free FROM access WHERE user_id=?), 0), ?, ?)
-        ON CONFLICT(user_id) DO UPDATE SET
-            is_blocked=excluded.is_blocked,
-            updated_at=excluded.updated_at
-        """,
-        (user_id, user_id, 1 if value else 0, datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
-    )
-    con.commit()
-    con.close()
-
-
-def get_access(user_id: int) -> Dict[str, Any]:
-    con = db_conn()
-    cur = con.cursor()
-    cur.execute(
-        "SELECT is_free, is_blocked, updated_at, last_menu_chat_id, last_menu_message_id FROM access WHERE user_id=?",
-        (user_id,),
-    )
-    row = cur.fetchone()
-    con.close()
-    if not row:
-        return {
-            "user_id": user_id,
-            "is_free": False,
-            "is_blocked": False,
-            "updated_at": None,
-            "last_menu_chat_id": None,
-            "last_menu_message_id": None,
-        }
-    return {
-        "user_id": user_id,
-        "is_free": bool(row[0]),
-        "is_blocked": bool(row[1]),
-        "updated_at": row[2],
-        "last_menu_chat_id": row[3],
-        "last_menu_message_id": row[4],
-    }
-
-
-def set_last_menu(user_id: int, chat_id: int, message_id: int) -> None:
-    con = db_conn()
-    cur = con.cursor()
-    cur.execute(
-        """
-        INSERT INTO access (user_id, is_free, is_blocked, updated_at, last_menu_chat_id, last_menu_message_id)
-        VALUES (?, COALESCE((SELECT is_free FROM access WHERE user_id=?), 0),
-                COALESCE((SELECT is_blocked FROM access WHERE user_id=?), 0),
-                ?, ?, ?)
-        ON CONFLICT(user_id) DO UPDATE SET
-            last_menu_chat_id=excluded.last_menu_chat_id,
-            last_menu_message_id=excluded.last_menu_message_id,
-            updated_at=excluded.updated_at
-        """,
-        (
-            user_id,
-            user_id,
-            user_id,
-            datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            chat_id,
-            message_id,
-        ),
-    )
-    con.commit()
-    con.close()
-
-
-def clear_last_menu(user_id: int) -> None:
-    con = db_conn()
-    cur = con.cursor()
-    cur.execute(
-        """
-        UPDATE access
-        SET last_menu_chat_id=NULL, last_menu_message_id=NULL, updated_at=?
-        WHERE user_id=?
-        """,
-        (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), user_id),
-    )
-    con.commit()
-    con.close()
-
-
-def get_last_menu(user_id: int) -> Tuple[Optional[int], Optional[int]]:
-    a = get_access(user_id)
-    return a.get("last_menu_chat_id"), a.get("last_menu_message_id")
 
 
 # =========================
 # LOG (как было)
 # =========================
 def send_log_to_group(text: str) -> Tuple[bool, str]:
-    if not BOT_TOKEN:
-        return False, "BOT_TOKEN is empty"
-    if not GROUP_ID:
-        return False, "TARGET_GROUP_ID/LOG_GROUP_ID is empty or invalid"
-
-    if len(text) > 3900:
-        text = text[:3900] + "\n…(truncated)"
-
-    try:
-        r = requests.post(
-            f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage",
-            json={"chat_id": GROUP_ID, "text": text},
-            timeout=12,
-        )
-        return r.ok, r.text
-    except Exception as e:
-        return False, f"requests error: {e}"
+    """Ставит лог в очередь фоновой отправки — обработчик не ждёт Telegram."""
+    with timing.span("log"):
+        return enqueue_log(text)
 
 
 def extract_last_user_message(raw: str) -> str:
@@ -243,63 +112,258 @@ def extract_last_user_message(raw: str) -> str:
     return s
 
 
+
+
 # =========================
-# ✅ MEMORY (новое)
+# MEMORY BUDGET (по токенам)
 # =========================
-def mem_add(user_id: int, role: str, text: str) -> None:
-    con = db_conn()
-    cur = con.cursor()
-    cur.execute(
-        "INSERT INTO chat_memory (user_id, role, text, created_at) VALUES (?, ?, ?, ?)",
-        (user_id, role, text, datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
-    )
-    con.commit()
-    con.close()
-
-
-def mem_get(user_id: int, limit: int = 24) -> List[Dict[str, str]]:
-    con = db_conn()
-    cur = con.cursor()
-    cur.execute(
-        """
-        SELECT role, text
-        FROM chat_memory
-        WHERE user_id=?
-        ORDER BY id DESC
-        LIMIT ?
-        """,
-        (user_id, limit),
-    )
-    rows = cur.fetchall()
-    con.close()
-    rows.reverse()  # в правильный порядок (старые -> новые)
-    out = []
-    for r in rows:
-        out.append({"role": r[0], "text": r[1]})
+def _parse_budgets(raw: str) -> Dict[str, int]:
+    out: Dict[str, int] = {}
+    for part in (raw or "").split(","):
+        key, _, value = part.partition("=")
+        try:
+            out[key.strip().lower()] = int(value)
+        except ValueError:
+            continue
     return out
 
 
-def mem_clear(user_id: int) -> None:
-    con = db_conn()
-    cur = con.cursor()
-    cur.execute("DELETE FROM chat_memory WHERE user_id=?", (user_id,))
-    con.commit()
-    con.close()
+# сколько последних сообщений вообще поднимать из БД
+MEMORY_FETCH_LIMIT = int(os.getenv("MEMORY_FETCH_LIMIT") or "60")
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET") or "1500")
+MEMORY_SUMMARY_TOKENS = int(os.getenv("MEMORY_SUMMARY_TOKENS") or "120")
+# бюджеты по стилю и/или модели: "short=800,detail=2500,llama-3.3-70b-versatile=4000,<model>:<style>=..."
+MEMORY_TOKEN_BUDGETS = _parse_budgets(os.getenv("MEMORY_TOKEN_BUDGETS") or "short=800,steps=1500,detail=2500")
+
+_MSG_OVERHEAD_TOKENS = 4  # "User: " + перевод строки
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка: ~4 байта UTF-8 на токен (латиница ~4 символа, кириллица ~2)."""
+    return len((text or "").encode("utf-8")) // 4 + 1
+
+
+def memory_budget(style: str, model: str) -> int:
+    style = (style or "").strip().lower()
+    model = (model or "").strip().lower()
+    for key in (f"{model}:{style}", model, style):
+        if key in MEMORY_TOKEN_BUDGETS:
+            return MEMORY_TOKEN_BUDGETS[key]
+    return MEMORY_TOKEN_BUDGET
+
+
+def chat_memory_budget(style: str, models: List[str]) -> int:
+    """Модель выбирает роутер уже после сборки промпта — берём самый тесный бюджет из пула."""
+    return min((memory_budget(style, m) for m in models), default=memory_budget(style, ""))
+
+
+def summarize_dropped(dropped: List[Dict[str, str]], max_tokens: int) -> Optional[str]:
+    """Короткая сводка выпавших из бюджета ходов: о чём спрашивал пользователь."""
+    topics: List[str] = []
+    used = estimate_tokens("Earlier in this chat the user asked about: ")
+    for m in reversed(dropped):  # свежие темы важнее
+        if m.get("role") != "user":
+            continue
+        snippet = " ".join((m.get("text") or "").split())[:80]
+        if not snippet:
+            continue
+        cost = estimate_tokens(snippet) + 1
+        if used + cost > max_tokens:
+            break
+        topics.append(snippet)
+        used += cost
+    if not topics:
+        return None
+    topics.reverse()
+    return "Earlier in this chat the user asked about: " + "; ".join(topics)
+
+
+def select_memory(
+    history: List[Dict[str, str]], budget: int
+) -> Tuple[List[Dict[str, str]], Optional[str], int]:
+    """Пакует историю от новых к старым, пока влезает в бюджет.
+    Возвращает (сообщения по порядку, сводка или None, токенов занято)."""
+    costs = [estimate_tokens(m.get("text", "")) + _MSG_OVERHEAD_TOKENS for m in history]
+    if sum(costs) <= budget:
+        return list(history), None, sum(costs)
+
+    # всё не влезает — оставляем место под сводку
+    room = max(0, budget - MEMORY_SUMMARY_TOKENS)
+    used = 0
+    start = len(history)
+    for i in range(len(history) - 1, -1, -1):
+        if used + costs[i] > room:
+            break
+        used += costs[i]
+        start = i
+
+    kept = history[start:]
+    summary = summarize_dropped(history[:start], budget - used)
+    if summary:
+        used += estimate_tokens(summary) + _MSG_OVERHEAD_TOKENS
+    return kept, summary, used
+
+
+class _PromptStats:
+    """Статистика размера промптов — чтобы подбирать бюджет."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.prompt_tokens_total = 0
+        self.prompt_tokens_max = 0
+        self.memory_tokens_total = 0
+        self.dropped_turns = 0
+        self.summaries = 0
+
+    def record(self, prompt_tokens: int, memory_tokens: int, dropped: int, summarized: bool) -> None:
+        with self._lock:
+            self.requests += 1
+            self.prompt_tokens_total += prompt_tokens
+            self.prompt_tokens_max = max(self.prompt_tokens_max, prompt_tokens)
+            self.memory_tokens_total += memory_tokens
+            self.dropped_turns += dropped
+            self.summaries += 1 if summarized else 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            n = self.requests or 1
+            return {
+                "requests": self.requests,
+                "prompt_tokens_avg": round(self.prompt_tokens_total / n, 1),
+                "prompt_tokens_max": self.prompt_tokens_max,
+                "memory_tokens_avg": round(self.memory_tokens_total / n, 1),
+                "dropped_turns": self.dropped_turns,
+                "summaries": self.summaries,
+            }
+
+
+_prompt_stats = _PromptStats()
+
+
+def prompt_stats() -> Dict[str, Any]:
+    return _prompt_stats.stats()
 
 
-def build_memory_prompt(history: List[Dict[str, str]], user_text: str) -> str:
-    lines = []
-    lines.append("Conversation:")
-    if history:
-        for m in history:
-            role = "User" if m.get("role") == "user" else "Assistant"
-            lines.append(f"{role}: {m.get('text','')}")
-    else:
-        lines.append("(empty)")
-    lines.append("")
-    lines.append(f"User: {user_text}")
-    lines.append("Assistant:")
-    return "\n".join(lines)
+# =========================
+# ✅ IDEMPOTENCY: склейка одинаковых запросов
+# =========================
+flights = make_flight_table()
+
+_IDEMPOTENCY_KEY_MAX = 128
+
+
+def _flight_key(endpoint: str, user_id: Any, content_fp: str, explicit: Optional[str]) -> Tuple[str, str, float]:
+    """(ключ, отпечаток, ttl). С явным ключом готовый ответ отдаётся повторно IDEMPOTENCY_TTL и
+    проверяется содержимое; без него ключом служит сам отпечаток и склеиваются только копии,
+    пришедшие, пока первый запрос ещё выполняется: короткое «да» через минуту — новый вопрос."""
+    if explicit:
+        return fingerprint(endpoint, user_id, "key", explicit), content_fp, IDEMPOTENCY_TTL
+    return fingerprint(endpoint, user_id, "fp", content_fp), content_fp, 0
+
+
+def _idempotency_key(data: Dict[str, Any]) -> Tuple[Optional[str], Optional[Tuple[Any, int]]]:
+    key = (request.headers.get("Idempotency-Key") or data.get("idempotency_key") or "").strip()
+    if len(key) > _IDEMPOTENCY_KEY_MAX:
+        return None, (jsonify({"error": "bad_idempotency_key"}), 400)
+    return key or None, None
+
+
+def _replayable(status: int) -> bool:
+    # запоминаем только успех: 402/403 после оплаты или разблокировки, 429/5xx — всё должно
+    # проверяться заново
+    return 200 <= status < 300
+
+
+def _frozen_response(rv: Any) -> Tuple[bytes, int, List[Tuple[str, str]]]:
+    resp = api.make_response(rv)
+    # ответ разделяют разные запросы/потоки — храним только байты и заголовки
+    headers = [(k, v) for k, v in resp.headers if k.lower() != "content-length"]
+    return resp.get_data(), resp.status_code, headers
+
+
+def _single_flight(key: str, fp: str, ttl: float, handler) -> Response:
+    """Выполняет handler() один раз на ключ, остальным копиям отдаёт тот же ответ."""
+
+    def run() -> Tuple[bytes, int, List[Tuple[str, str]]]:
+        return _frozen_response(handler())
+
+    t0 = time.perf_counter()
+    result, how = flights.do(key, fp, run, lambda r: ttl if _replayable(r[1]) else 0)
+    if how != LEAD:
+        timing.record("coalesce_wait", (time.perf_counter() - t0) * 1000)
+    if how == CONFLICT:
+        return jsonify({"error": "idempotency_key_reused"}), 422
+    if result is None:
+        return jsonify({"error": "duplicate_request_timeout"}), 504, {"Retry-After": "5"}
+
+    body, status, headers = result
+    resp = Response(body, status=status, headers=headers)
+    if how != LEAD:
+        resp.headers["Idempotent-Replayed"] = "true"
+    return resp
+
+
+# =========================
+# ✅ METRICS
+# =========================
+HTTP_SECONDS = metrics.histogram(
+    "http_request_seconds", "API request latency (streams: until headers)", ["endpoint", "method", "status"]
+)
+HTTP_ERRORS = metrics.counter("http_errors_total", "API error responses by error code", ["endpoint", "error"])
+_ERROR_CODE_RE = re.compile(r"^[a-z_]{1,40}$")
+IMAGE_SECONDS = metrics.histogram("image_generation_seconds", "Image generation latency by mode", ["mode", "outcome"])
+
+metrics.gauge("image_jobs_queued", "Image jobs waiting for a worker").set_function(lambda: image_jobs.depth())
+metrics.gauge("image_jobs_running", "Image jobs being generated").set_function(lambda: image_jobs.stats()["running"])
+_upstream_active = metrics.gauge("upstream_active", "In-flight upstream calls", ["upstream"])
+_upstream_active.labels("groq").set_function(lambda: groq_gate.active)
+_upstream_active.labels("stability").set_function(lambda: stability_gate.active)
+
+
+@api.before_request
+def _metrics_start():
+    g.t0 = time.perf_counter()
+    timing.start()
+
+
+@api.after_request
+def _metrics_finish(resp):
+    t0 = g.pop("t0", None)
+    if t0 is None:
+        return resp
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    HTTP_SECONDS.labels(endpoint, request.method, resp.status_code).observe(time.perf_counter() - t0)
+    _attach_timing(resp)
+    if resp.status_code >= 400 and resp.is_json:
+        # разбираем тело только у ошибок — на успешном пути ничего не стоит
+        error = (resp.get_json(silent=True) or {}).get("error")
+        # свободный текст исключений в метки не пускаем — только коды вида "rate_limited"
+        if not isinstance(error, str) or not _ERROR_CODE_RE.match(error):
+            error = "other"
+        HTTP_ERRORS.labels(endpoint, error).inc()
+    return resp
+
+
+def _attach_timing(resp) -> None:
+    """Server-Timing в ответ; в лог медленных — при закрытии ответа (для стримов это конец стрима)."""
+    rt = timing.current()
+    if rt is None:
+        return
+    resp.headers["Server-Timing"] = rt.header()
+    # mini app открыт с другого домена — без этого WebView не покажет разбивку
+    resp.headers["Timing-Allow-Origin"] = "*"
+    info = {"method": request.method, "path": request.path, "status": resp.status_code}
+
+    def on_close() -> None:
+        timing.log_if_slow(rt, rt.total_ms(), info)
+
+    resp.call_on_close(on_close)
+
+
+@api.get("/metrics")
+def api_metrics():
+    return Response(metrics.render(), mimetype=None, content_type=metrics.CONTENT_TYPE)
 
 
 # =========================
@@ -318,7 +382,7 @@ def health():
 @api.get("/api/test-log")
 def test_log():
     time_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    ok, info = send_log_to_group(f"✅ TEST LOG\n🕒 {time_str}")
+    ok, info = send_log_now(f"✅ TEST LOG\n🕒 {time_str}")
     return jsonify(
         {
             "ok": ok,
@@ -334,6 +398,49 @@ def api_access(user_id: int):
     return jsonify(get_access(user_id))
 
 
+@api.get("/api/stats")
+def api_stats():
+    return jsonify(
+        {
+            "access_cache": access_cache_stats(),
+            "log_queue": log_stats(),
+            "prompt_tokens": prompt_stats(),
+            "image_jobs": image_jobs.stats(),
+            "image_prep": prep_stats(),
+            "image_variants": variant_stats(),
+            "idempotency": flights.stats(),
+            "rate_limit": rate_limiter.stats(),
+            "upstream": {"groq": groq_gate.stats(), "stability": stability_gate.stats()},
+            "webhook": webhook_runner.stats(),
+            "groq_router": groq_router.stats() if groq_router else None,
+        }
+    )
+
+
+# =========================
+# ✅ TELEGRAM WEBHOOK
+# =========================
+# при BOT_MODE=webhook Telegram шлёт апдейты сюда; они копятся в SQLite, разбирает их владелец бота (bot_webhook)
+_WEBHOOK_STATUS = {
+    "accepted": 200,
+    "duplicate": 200,
+    "forbidden": 403,
+    "bad_request": 400,
+    "busy": 503,
+}
+
+
+@api.post(WEBHOOK_PATH)
+def telegram_webhook():
+    if not webhook_enabled():
+        return jsonify({"ok": False, "error": "not_found"}), 404
+    result = handle_update(request.headers.get(SECRET_HEADER), request.get_json(silent=True))
+    status = _WEBHOOK_STATUS[result]
+    # 503 — Telegram повторит доставку сам
+    headers = {"Retry-After": "1"} if status == 503 else {}
+    return jsonify({"ok": status == 200, "result": result}), status, headers
+
+
 # ✅ очистка памяти по кнопке "Очистить"
 @api.post("/api/memory/clear")
 def api_memory_clear():
@@ -358,14 +465,32 @@ def api_memory_clear():
     return jsonify({"ok": True})
 
 
-@api.post("/api/chat")
-def api_chat():
-    data: Dict[str, Any] = request.get_json(silent=True) or {}
+def _rate_limited(user_id: int, endpoint: str) -> Optional[Tuple[Any, int, Dict[str, str]]]:
+    """None — можно, иначе готовый ответ 429."""
+    with timing.span("rate_limit"):
+        wait = rate_limiter.take(user_id, endpoint, is_priority(user_id))
+    if not wait:
+        return None
+    return jsonify({"error": "rate_limited", "retry_after": round(wait, 1)}), 429, retry_after_header(wait)
+
+
+def _acquire_groq_slot(priority: bool) -> bool:
+    with timing.span("groq_slot"):
+        return groq_gate.acquire(priority)
+
 
+def _upstream_busy(e: UpstreamBusy) -> Tuple[Any, int, Dict[str, str]]:
+    return jsonify({"error": "upstream_busy"}), 503, retry_after_header(e.retry_after)
+
+
+def _prepare_chat(data: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], Optional[Tuple[Any, int]]]:
+    """Общая часть /api/chat и /api/chat/stream.
+    Возвращает (ctx, None) или (None, (ответ, код))."""
     raw_text = (data.get("text") or "").strip()
     if not raw_text:
-        return jsonify({"error": "empty"}), 400
+        return None, (jsonify({"error": "empty"}), 400)
 
+    # новый клиент шлёт только текст вопроса; старый — весь транскрипт, достаём последний вопрос
     text = extract_last_user_message(raw_text)
 
     tg_user_id = data.get("tg_user_id") or data.get("telegram_user_id") or 0
@@ -374,62 +499,287 @@ def api_chat():
     except Exception:
         tg_user_id_int = 0
 
-    tg_username = data.get("tg_username") or data.get("username") or "—"
-    tg_first_name = data.get("tg_first_name") or data.get("first_name") or "—"
-
     # --- ACCESS CHECK ---
     if tg_user_id_int:
         a = get_access(tg_user_id_int)
         if a["is_blocked"]:
-            return jsonify({"error": "blocked"}), 403
+            return None, (jsonify({"error": "blocked"}), 403)
         if not a["is_free"]:
-            return jsonify({"error": "payment_required"}), 402
+            return None, (jsonify({"error": "payment_required"}), 402)
     else:
-        return jsonify({"error": "payment_required"}), 402
+        return None, (jsonify({"error": "payment_required"}), 402)
+
+    limited = _rate_limited(tg_user_id_int, "chat")
+    if limited:
+        return None, limited
 
     lang = data.get("lang") or "ru"
     style = data.get("style") or "steps"
     persona = data.get("persona") or "friendly"
 
-    # ✅ берём историю + строим промпт с памятью
-    history = mem_get(tg_user_id_int, limit=24)
-    prompt_with_memory = build_memory_prompt(history, text)
+    # ✅ берём историю в пределах бюджета токенов + собираем messages (system, user/assistant...)
+    history = mem_get(tg_user_id_int, limit=MEMORY_FETCH_LIMIT)
+    with timing.span("prompt"):
+        kept, summary, memory_tokens = select_memory(history, chat_memory_budget(style, GROQ_MODELS))
+        messages = build_messages(kept, text, lang=lang, style=style, persona=persona, summary=summary)
+
+    _prompt_stats.record(
+        sum(estimate_tokens(m["content"]) + _MSG_OVERHEAD_TOKENS for m in messages),
+        memory_tokens,
+        len(history) - len(kept),
+        bool(summary),
+    )
+
+    return {
+        "user_id": tg_user_id_int,
+        "username": data.get("tg_username") or data.get("username") or "—",
+        "first_name": data.get("tg_first_name") or data.get("first_name") or "—",
+        "text": text,
+        "messages": messages,
+        "priority": is_priority(tg_user_id_int),
+    }, None
+
+
+def _log_chat_turn(ctx: Dict[str, Any], reply: str) -> None:
+    time_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    send_log_to_group(
+        f"🕒 {time_str}\n"
+        f"👤 {ctx['first_name']} (@{ctx['username']})\n"
+        f"🆔 {ctx['user_id']}\n"
+        f"💬 {ctx['text']}\n\n"
+        f"🤖 {reply}"
+    )
+
 
-    # ✅ сохраняем user сообщение в память ДО ответа
-    mem_add(tg_user_id_int, "user", text)
+def _chat_fingerprint(data: Dict[str, Any]) -> str:
+    return fingerprint(
+        (data.get("text") or "").strip(),
+        data.get("lang") or "ru",
+        data.get("style") or "steps",
+        data.get("persona") or "friendly",
+    )
+
+
+def _chat_user_id(data: Dict[str, Any]) -> Any:
+    return data.get("tg_user_id") or data.get("telegram_user_id") or 0
+
+
+@api.post("/api/chat")
+def api_chat():
+    data: Dict[str, Any] = request.get_json(silent=True) or {}
+    explicit, err = _idempotency_key(data)
+    if err:
+        return err
+    key, fp, ttl = _flight_key("chat", _chat_user_id(data), _chat_fingerprint(data), explicit)
+    return _single_flight(key, fp, ttl, lambda: _chat_once(data))
+
+
+def _chat_once(data: Dict[str, Any]):
+    ctx, err = _prepare_chat(data)
+    if err:
+        return err
+
+    # слот к Groq берём заранее: при перегрузке вопрос не должен осесть в памяти без ответа
+    if not _acquire_groq_slot(ctx["priority"]):
+        return _upstream_busy(UpstreamBusy("groq"))
 
     try:
-        reply = ask_groq(prompt_with_memory, lang=lang, style=style, persona=persona)
+        # ✅ сохраняем user сообщение в память ДО ответа
+        mem_add(ctx["user_id"], "user", ctx["text"])
+        with timing.span("groq"):
+            reply = ask_groq(messages=ctx["messages"])
+    except UpstreamBusy as e:
+        # все ключи/модели Groq в лимите или с разомкнутой цепью
+        return _upstream_busy(e)
     except Exception as e:
         send_log_to_group(f"❌ Ошибка /api/chat: {e}")
         return jsonify({"error": str(e)}), 500
+    finally:
+        groq_gate.release()
 
     # ✅ сохраняем ответ в память
-    mem_add(tg_user_id_int, "assistant", reply)
+    mem_add(ctx["user_id"], "assistant", reply)
+    _log_chat_turn(ctx, reply)
 
-    time_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return jsonify({"reply": reply})
 
-    send_log_to_group(
-        f"🕒 {time_str}\n"
-        f"👤 {tg_first_name} (@{tg_username})\n"
-        f"🆔 {tg_user_id_int}\n"
-        f"💬 {text}\n\n"
-        f"🤖 {reply}"
+
+def _sse(payload: Dict[str, Any], event: Optional[str] = None) -> str:
+    head = f"event: {event}\n" if event else ""
+    return f"{head}data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+# ✅ стриминг ответа (Server-Sent Events): первые слова приходят сразу
+@api.post("/api/chat/stream")
+def api_chat_stream():
+    data: Dict[str, Any] = request.get_json(silent=True) or {}
+    explicit, err = _idempotency_key(data)
+    if err:
+        return err
+    key, fp, ttl = _flight_key("chat_stream", _chat_user_id(data), _chat_fingerprint(data), explicit)
+    state, flight = flights.begin(key, fp)
+    if state == CONFLICT:
+        return jsonify({"error": "idempotency_key_reused"}), 422
+    if state != LEAD:
+        # копия уже идущего (или только что законченного) стрима: ждём ведущего до ответа,
+        # чтобы его отказ (4xx, 429/503 с Retry-After) вернуть с тем же кодом
+        result = flight.result if state == DONE else flight.wait()
+        if isinstance(result, tuple):
+            body, status, headers = result
+            resp = Response(body, status=status, headers=headers)
+            resp.headers["Idempotent-Replayed"] = "true"
+            return resp
+
+        def replay() -> Iterator[str]:
+            if result is None:
+                yield _sse({"error": "duplicate_request_failed"}, event="error")
+                return
+            yield _sse(result, event="done")
+
+        return Response(
+            stream_with_context(replay()),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "Idempotent-Replayed": "true"},
+        )
+
+    ctx, err = _prepare_chat(data)
+    if err:
+        # отказ до начала стрима — копиям тот же ответ (не хранится: ttl 0)
+        flights.finish(key, flight, _frozen_response(err), 0)
+        return err
+
+    if not _acquire_groq_slot(ctx["priority"]):
+        busy = _upstream_busy(UpstreamBusy("groq"))
+        flights.finish(key, flight, _frozen_response(busy), 0)
+        return busy
+
+    released = threading.Event()
+    result: Dict[str, Any] = {}
+
+    def release_slot() -> None:
+        # и по окончании стрима, и при закрытии ответа (клиент ушёл раньше) — ровно один раз
+        if not released.is_set():
+            released.set()
+            groq_gate.release()
+            flights.finish(key, flight, result or None, ttl if result else 0)
+
+    def events() -> Iterator[str]:
+        parts: List[str] = []
+        try:
+            # внутри try: упавшая запись в SQLite тоже освобождает слот и завершает flight
+            mem_add(ctx["user_id"], "user", ctx["text"])
+            t0 = time.perf_counter()
+            for delta in ask_groq_stream(messages=ctx["messages"]):
+                if not parts:
+                    timing.record("groq_first_token", (time.perf_counter() - t0) * 1000)
+                parts.append(delta)
+                yield _sse({"delta": delta})
+            timing.record("groq", (time.perf_counter() - t0) * 1000)
+
+            # память и лог — только когда ответ собран целиком
+            reply = "".join(parts).strip()
+            mem_add(ctx["user_id"], "assistant", reply)
+            _log_chat_turn(ctx, reply)
+            result["reply"] = reply
+        except UpstreamBusy as e:
+            yield _sse({"error": "upstream_busy", "retry_after": round(e.retry_after, 1)}, event="error")
+            return
+        except Exception as e:
+            send_log_to_group(f"❌ Ошибка /api/chat/stream: {e}")
+            yield _sse({"error": str(e)}, event="error")
+            return
+        finally:
+            release_slot()
+
+        yield _sse(result, event="done")
+
+    resp = Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
+    resp.call_on_close(release_slot)
+    return resp
 
-    return jsonify({"reply": reply})
+
+# =========================
+# ✅ IMAGE FILES (по хэшу содержимого)
+# =========================
+# база для абсолютных ссылок (mini app живёт на другом домене); иначе — из запроса
+PUBLIC_BASE_URL = (os.getenv("PUBLIC_BASE_URL") or "").strip().rstrip("/")
+
+
+def image_url(name: str, base_url: Optional[str] = None, variant: Optional[str] = None) -> str:
+    path = f"/api/images/{name}"
+    if variant:
+        # формат выбирается по Accept, поэтому ссылка на вариант — через оригинал
+        path += f"?variant={variant}"
+    return (base_url or PUBLIC_BASE_URL or request.host_url.rstrip("/")) + path
+
+
+def _pick_format(variant: str) -> Tuple[Optional[str], bool]:
+    """(формат варианта, выбран ли он по Accept)."""
+    formats = formats_for(variant)
+    wanted = (request.args.get("format") or "").strip().lower()
+    if wanted:
+        return (wanted if wanted in formats else None), False
+    accept = request.headers.get("Accept") or ""
+    # AVIF легче WebP — предпочитаем его, если клиент умеет
+    for fmt in sorted(formats, key=lambda f: f != "avif"):
+        if IMAGE_MIME_TYPES[fmt] in accept:
+            return fmt, True
+    # webp понимают все живые браузеры и Telegram WebView
+    return formats[0], True
+
+
+@api.get("/api/images/<name>")
+def api_image_file(name: str):
+    parsed = parse_image_name(name)
+    if not parsed:
+        return jsonify({"error": "not_found"}), 404
+    stem, ext = parsed
+    variant = (request.args.get("variant") or "original").strip().lower()
+
+    negotiated = False
+    if variant != "original" and "-" not in stem:
+        if variant not in ("display", "thumb"):
+            return jsonify({"error": "invalid_variant"}), 400
+        fmt, negotiated = _pick_format(variant)
+        if not fmt:
+            return jsonify({"error": "invalid_format"}), 400
+        stem, ext = f"{stem}-{variant}", fmt
+
+    name = f"{stem}.{ext}"
+    path = image_store.path_for(name)
+    if not path and "-" in stem:
+        # вариант вытеснили (или его ещё нет) — пересобираем из оригинала
+        make_variants(image_store, stem.split("-", 1)[0])
+        path = image_store.path_for(name)
+    if not path:
+        return jsonify({"error": "not_found"}), 404
+
+    # файл по имени никогда не меняется: ETag = имя, кэш навсегда; Range отдаёт send_file
+    resp = send_file(path, mimetype=IMAGE_MIME_TYPES[ext], conditional=True, etag=name, max_age=31536000)
+    resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    if negotiated:
+        resp.headers["Vary"] = "Accept"
+    return resp
 
 
 # =========================
 # ✅ IMAGE GENERATION ENDPOINT
 # =========================
-@api.post("/api/image")
-def api_image():
-    """Генерация изображения через Stability AI"""
-    
+IMAGE_MODES_NEED_FILE = ("img2img", "remove_bg", "inpaint")
+IMAGE_MODES = ("txt2img", "upscale") + IMAGE_MODES_NEED_FILE
+
+
+def _parse_image_request() -> Tuple[Optional[Dict[str, Any]], Optional[Tuple[Any, int]]]:
+    """Разбор формы /api/image и /api/image/jobs + проверка доступа.
+    Возвращает (params, None) или (None, (ответ, код))."""
     # Проверка доступности Stability AI
     if not STABILITY_AVAILABLE:
-        return jsonify({"error": "image_generation_not_available"}), 503
+        return None, (jsonify({"error": "image_generation_not_available"}), 503)
     
     # Получаем данные из формы (поддерживает файлы)
     tg_user_id = request.form.get("tg_user_id") or 0
@@ -445,15 +795,19 @@ def api_image():
     if tg_user_id_int:
         a = get_access(tg_user_id_int)
         if a["is_blocked"]:
-            return jsonify({"error": "blocked"}), 403
+            return None, (jsonify({"error": "blocked"}), 403)
         if not a["is_free"]:
-            return jsonify({"error": "payment_required"}), 402
+            return None, (jsonify({"error": "payment_required"}), 402)
     else:
-        return jsonify({"error": "payment_required"}), 402
+        return None, (jsonify({"error": "payment_required"}), 402)
+
+    limited = _rate_limited(tg_user_id_int, "image")
+    if limited:
+        return None, limited
     
     # Проверка промпта
     if not prompt and mode == "txt2img":
-        return jsonify({"error": "empty_prompt"}), 400
+        return None, (jsonify({"error": "empty_prompt"}), 400)
     
     # Получаем файл если есть
     image_file = request.files.get("image")
@@ -462,8 +816,19 @@ def api_image():
         image_data = image_file.read()
     
     # Проверка режима
-    if mode in ["img2img", "remove_bg", "inpaint"] and not image_data:
-        return jsonify({"error": "image_required_for_this_mode"}), 400
+    if mode in IMAGE_MODES_NEED_FILE and not image_data:
+        return None, (jsonify({"error": "image_required_for_this_mode"}), 400)
+    if mode not in IMAGE_MODES or (mode == "upscale" and not image_data):
+        return None, (jsonify({"error": "unsupported_mode"}), 400)
+
+    # ✅ фото: EXIF-поворот, размер SDXL, компактный JPEG — до очереди и до Stability
+    init_image = None
+    if image_data and mode != "txt2img":
+        try:
+            with timing.span("image_prep"):
+                init_image = prepare_init_image(image_data)
+        except InvalidImage as e:
+            return None, (jsonify({"error": "invalid_image", "detail": str(e)[:100]}), 400)
     
     # Получаем дополнительные параметры
     negative_prompt = request.form.get("negative_prompt") or None
@@ -477,111 +842,277 @@ def api_image():
         steps, cfg_scale, width, height, strength = 30, 7.0, 1024, 1024, 0.7
     
     # Ограничения для безопасности
-    steps = min(max(steps, 10), 50)
-    cfg_scale = min(max(cfg_scale, 1.0), 20.0)
-    width = min(max(width, 256), 2048)
-    height = min(max(height, 256), 2048)
-    strength = min(max(strength, 0.1), 0.9)
-    
+    return {
+        "user_id": tg_user_id_int,
+        "username": request.form.get("tg_username") or "—",
+        "first_name": request.form.get("tg_first_name") or "—",
+        "prompt": prompt,
+        "mode": mode,
+        "init_image": init_image,
+        "negative_prompt": negative_prompt,
+        "steps": min(max(steps, 10), 50),
+        "cfg_scale": min(max(cfg_scale, 1.0), 20.0),
+        "width": min(max(width, 256), 2048),
+        "height": min(max(height, 256), 2048),
+        "strength": min(max(strength, 0.1), 0.9),
+        # ссылку на картинку строим и вне запроса (в воркере очереди)
+        "base_url": PUBLIC_BASE_URL or request.host_url.rstrip("/"),
+        "priority": is_priority(tg_user_id_int),
+    }, None
+
+
+def _generate_image_png(p: Dict[str, Any]) -> bytes:
+    """Генерация в зависимости от режима."""
+    mode = p["mode"]
+    prompt = p["prompt"]
+    init = p["init_image"] or {}
+    image_data = init.get("data")
+    image_mime = init.get("mime", "image/png")
+
+    if mode == "txt2img":
+        # Текст -> изображение
+        return generate_image(
+            prompt=prompt,
+            negative_prompt=p["negative_prompt"],
+            steps=p["steps"],
+            cfg_scale=p["cfg_scale"],
+            width=p["width"],
+            height=p["height"],
+        )
+
+    if mode == "img2img":
+        # Изображение -> изображение (смена стиля)
+        return generate_image_from_image(
+            prompt=prompt,
+            init_image=image_data,
+            init_image_mime=image_mime,
+            strength=p["strength"],
+            steps=p["steps"],
+            cfg_scale=p["cfg_scale"],
+        )
+
+    if mode == "remove_bg":
+        # Удаление фона (упрощенная версия)
+        # В реальности нужна отдельная логика или другой сервис
+        # Пока используем img2img с специальным промптом
+        enhanced_prompt = f"{prompt}, professional product photo, clean white background, no background, isolated object"
+        return generate_image_from_image(
+            prompt=enhanced_prompt,
+            init_image=image_data,
+            init_image_mime=image_mime,
+            strength=0.6,
+            steps=35,
+            cfg_scale=8.0,
+        )
+
+    if mode == "inpaint":
+        # Удаление объекта (упрощенная версия)
+        enhanced_prompt = f"{prompt}, remove specified object, clean removal, seamless edit"
+        return generate_image_from_image(
+            prompt=enhanced_prompt,
+            init_image=image_data,
+            init_image_mime=image_mime,
+            strength=0.8,
+            steps=40,
+            cfg_scale=7.5,
+        )
+
+    # upscale: улучшение качества (упрощенная версия)
+    enhanced_prompt = f"{prompt}, high resolution, 8k, detailed, sharp focus, professional photography"
+    return generate_image_from_image(
+        prompt=enhanced_prompt,
+        init_image=image_data,
+        init_image_mime=image_mime,
+        strength=0.5,
+        steps=25,
+        cfg_scale=6.0,
+    )
+
+
+def _image_error(error_msg: str) -> Tuple[Dict[str, Any], int]:
+    # Безопасный ответ с ошибкой
+    if "API key" in error_msg:
+        return {"error": "invalid_api_key"}, 500
+    elif "credit" in error_msg.lower() or "balance" in error_msg.lower():
+        return {"error": "insufficient_balance"}, 402
+    elif "timeout" in error_msg.lower():
+        return {"error": "generation_timeout"}, 504
+    else:
+        return {"error": "generation_failed", "detail": error_msg[:100]}, 500
+
+
+def _run_image(p: Dict[str, Any], slot_timeout: Optional[float] = None) -> Tuple[Dict[str, Any], int]:
+    """Генерация + сохранение + лог. Возвращает (тело ответа, код).
+    slot_timeout — сколько ждать свободный слот Stability (None — UPSTREAM_WAIT)."""
+    t0 = time.perf_counter()
+    body, status = _run_image_once(p, slot_timeout)
+    outcome = "ok" if status == 200 else body.get("error", "other")
+    IMAGE_SECONDS.labels(p["mode"], outcome).observe(time.perf_counter() - t0)
+    return body, status
+
+
+def _run_image_once(p: Dict[str, Any], slot_timeout: Optional[float]) -> Tuple[Dict[str, Any], int]:
+    prompt = p["prompt"]
     try:
-        # Генерация в зависимости от режима
-        if mode == "txt2img":
-            # Текст -> изображение
-            image_base64 = generate_image(
-                prompt=prompt,
-                negative_prompt=negative_prompt,
-                steps=steps,
-                cfg_scale=cfg_scale,
-                width=width,
-                height=height,
-            )
-        
-        elif mode == "img2img" and image_data:
-            # Изображение -> изображение (смена стиля)
-            image_base64 = generate_image_from_image(
-                prompt=prompt,
-                init_image=image_data,
-                strength=strength,
-                steps=steps,
-                cfg_scale=cfg_scale,
-            )
-        
-        elif mode == "remove_bg" and image_data:
-            # Удаление фона (упрощенная версия)
-            # В реальности нужна отдельная логика или другой сервис
-            # Пока используем img2img с специальным промптом
-            enhanced_prompt = f"{prompt}, professional product photo, clean white background, no background, isolated object"
-            image_base64 = generate_image_from_image(
-                prompt=enhanced_prompt,
-                init_image=image_data,
-                strength=0.6,
-                steps=35,
-                cfg_scale=8.0,
-            )
-        
-        elif mode == "inpaint" and image_data:
-            # Удаление объекта (упрощенная версия)
-            enhanced_prompt = f"{prompt}, remove specified object, clean removal, seamless edit"
-            image_base64 = generate_image_from_image(
-                prompt=enhanced_prompt,
-                init_image=image_data,
-                strength=0.8,
-                steps=40,
-                cfg_scale=7.5,
-            )
-        
-        elif mode == "upscale" and image_data:
-            # Улучшение качества (упрощенная версия)
-            enhanced_prompt = f"{prompt}, high resolution, 8k, detailed, sharp focus, professional photography"
-            image_base64 = generate_image_from_image(
-                prompt=enhanced_prompt,
-                init_image=image_data,
-                strength=0.5,
-                steps=25,
-                cfg_scale=6.0,
-            )
-        
-        else:
-            return jsonify({"error": "unsupported_mode"}), 400
-        
-        if not image_base64:
-            return jsonify({"error": "generation_failed"}), 500
-        
+        with timing.span("stability_slot"):
+            got_slot = stability_gate.acquire(p["priority"], slot_timeout)
+        if not got_slot:
+            raise UpstreamBusy("stability")
+        try:
+            with timing.span("stability"):
+                image_png = _generate_image_png(p)
+        finally:
+            stability_gate.release()
+        if not image_png:
+            return {"error": "generation_failed"}, 500
+
+        # ✅ кладём в хранилище и отдаём ссылку вместо base64 в JSON
+        with timing.span("image_store"):
+            image_name = image_store.put(image_png, "png")
+        # версии для показа (WebP/AVIF) и превью — сразу, пока PNG уже в памяти
+        with timing.span("image_variants"):
+            make_variants(image_store, parse_image_name(image_name)[0], image_png)
+
         # Логируем успешную генерацию
-        tg_username = request.form.get("tg_username") or "—"
-        tg_first_name = request.form.get("tg_first_name") or "—"
         time_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
         send_log_to_group(
             f"🖼 Изображение сгенерировано\n"
             f"🕒 {time_str}\n"
-            f"👤 {tg_first_name} (@{tg_username})\n"
-            f"🆔 {tg_user_id_int}\n"
-            f"📝 Режим: {mode}\n"
+            f"👤 {p['first_name']} (@{p['username']})\n"
+            f"🆔 {p['user_id']}\n"
+            f"📝 Режим: {p['mode']}\n"
             f"💬 Промпт: {prompt[:80]}..."
         )
-        
-        return jsonify({
+
+        return {
             "success": True,
-            "image_base64": image_base64,
+            "url": image_url(image_name, p["base_url"]),
+            "display_url": image_url(image_name, p["base_url"], "display"),
+            "thumb_url": image_url(image_name, p["base_url"], "thumb"),
             "prompt": prompt,
-            "mode": mode,
-            "width": width,
-            "height": height,
-            "steps": steps,
-        })
-        
+            "mode": p["mode"],
+            "width": p["width"],
+            "height": p["height"],
+            "steps": p["steps"],
+        }, 200
+
+    except UpstreamBusy:
+        return {"error": "upstream_busy"}, 503
+
     except Exception as e:
         # Логируем ошибку
         error_msg = str(e)
-        send_log_to_group(f"❌ Ошибка генерации изображения\n🆔 {tg_user_id_int}\n📝 {prompt[:50]}...\n💥 {error_msg}")
-        
-        # Безопасный ответ с ошибкой
-        if "API key" in error_msg:
-            return jsonify({"error": "invalid_api_key"}), 500
-        elif "credit" in error_msg.lower() or "balance" in error_msg.lower():
-            return jsonify({"error": "insufficient_balance"}), 402
-        elif "timeout" in error_msg.lower():
-            return jsonify({"error": "generation_timeout"}), 504
-        else:
-            return jsonify({"error": "generation_failed", "detail": error_msg[:100]}), 500
\ No newline at end of file
+        send_log_to_group(f"❌ Ошибка генерации изображения\n🆔 {p['user_id']}\n📝 {prompt[:50]}...\n💥 {error_msg}")
+        return _image_error(error_msg)
+
+
+_IMAGE_FP_FIELDS = ("prompt", "mode", "negative_prompt", "steps", "cfg_scale", "width", "height", "strength")
+
+
+def _image_flight_key(endpoint: str) -> Tuple[Optional[Tuple[str, str, float]], Optional[Tuple[Any, int]]]:
+    """Ключ склейки для формы генерации: поля + байты исходного фото."""
+    explicit, err = _idempotency_key(request.form)
+    if err:
+        return None, err
+    parts: List[Any] = [request.form.get(f) or "" for f in _IMAGE_FP_FIELDS]
+    image_file = request.files.get("image")
+    if image_file:
+        parts.append(image_file.read())
+        image_file.seek(0)
+    user_id = request.form.get("tg_user_id") or 0
+    return _flight_key(endpoint, user_id, fingerprint(*parts), explicit), None
+
+
+@api.post("/api/image")
+def api_image():
+    """Генерация изображения через Stability AI (синхронно, держит поток до конца генерации)"""
+    flight_key, err = _image_flight_key("image")
+    if err:
+        return err
+    return _single_flight(*flight_key, _image_once)
+
+
+def _image_once():
+    p, err = _parse_image_request()
+    if err:
+        return err
+    body, status = _run_image(p)
+    if status == 503:
+        return jsonify(body), status, retry_after_header(5)
+    return jsonify(body), status
+
+
+# =========================
+# ✅ IMAGE JOBS: очередь генерации
+# =========================
+IMAGE_JOB_WORKERS = int(os.getenv("IMAGE_JOB_WORKERS") or "4")
+IMAGE_JOB_QUEUE_MAX = int(os.getenv("IMAGE_JOB_QUEUE_MAX") or "32")
+IMAGE_JOB_PER_USER = int(os.getenv("IMAGE_JOB_PER_USER") or "2")
+# воркер очереди может подождать слот Stability дольше, чем HTTP-запрос
+IMAGE_JOB_SLOT_WAIT = float(os.getenv("IMAGE_JOB_SLOT_WAIT") or "60")
+
+image_jobs = make_job_queue(IMAGE_JOB_WORKERS, IMAGE_JOB_QUEUE_MAX, "image-job")
+
+
+def _image_job_public(job: Dict[str, Any]) -> Dict[str, Any]:
+    out = {"job_id": job["job_id"], "status": job["status"], "mode": job["mode"]}
+    if job["status"] in ("done", "error"):
+        out["result"] = job["result"]
+        out["http_status"] = job["http_status"]
+        if job["finished_at"]:
+            out["took_ms"] = round((job["finished_at"] - job["created_at"]) * 1000)
+    return out
+
+
+@api.post("/api/image/jobs")
+def api_image_job_create():
+    """Ставит генерацию в очередь и сразу возвращает job_id (202).
+    Повтор того же запроса (или с тем же Idempotency-Key) получает тот же job_id."""
+    flight_key, err = _image_flight_key("image_job")
+    if err:
+        return err
+    return _single_flight(*flight_key, _image_job_create_once)
+
+
+def _image_job_create_once():
+    p, err = _parse_image_request()
+    if err:
+        return err
+
+    if image_jobs.depth() >= IMAGE_JOB_QUEUE_MAX:
+        return jsonify({"error": "queue_full"}), 503, {"Retry-After": "10"}
+
+    job_id = uuid.uuid4().hex
+    if not job_create(job_id, p["user_id"], p["mode"], IMAGE_JOB_PER_USER):
+        return jsonify({"error": "too_many_jobs"}), 429, {"Retry-After": "5"}
+
+    def run():
+        job_start(job_id)
+        try:
+            body, status = _run_image(p, IMAGE_JOB_SLOT_WAIT)
+        except Exception as e:
+            body, status = _image_error(str(e))
+        job_finish(job_id, body, status)
+
+    if not image_jobs.submit(run):
+        job_delete(job_id)
+        return jsonify({"error": "queue_full"}), 503, {"Retry-After": "10"}
+
+    return jsonify({
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": f"{p['base_url']}/api/image/jobs/{job_id}?tg_user_id={p['user_id']}",
+    }), 202
+
+
+@api.get("/api/image/jobs/<job_id>")
+def api_image_job_status(job_id: str):
+    """Статус задачи — только её владельцу (tg_user_id в query); чужая задача выглядит как 404."""
+    try:
+        user_id = int(request.args.get("tg_user_id") or 0)
+    except ValueError:
+        user_id = 0
+    job = job_get(job_id, user_id) if user_id else None
+    if not job:
+        return jsonify({"error": "not_found"}), 404
+    return jsonify(_image_job_public(job))
@@ -0,0 +1 @@
+# Бенчмарки. Запуск из корня репозитория: python -m bench.<имя>
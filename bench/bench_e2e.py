@@ -0,0 +1,274 @@
+# bench/bench_e2e.py
+"""
+Сквозной нагрузочный тест API без платных сервисов.
+
+Поднимает заглушки Groq/Stability/Telegram (bench/fake_upstreams.py),
+направляет на них клиентов через env, запускает API на случайном порту
+и гоняет смесь запросов из нескольких потоков. Результат — JSON
+(пропускная способность, p50/p95/p99, доля ошибок по операциям),
+который удобно сравнивать между коммитами:
+
+    python -m bench.bench_e2e --duration 30 --concurrency 16 --out before.json
+    python -m bench.bench_e2e --mix chat=6,stream=2,image_job=1,clear=1 --groq-error-rate 0.05
+    python -m bench.bench_e2e --groq-keys 3 --groq-key-skew 400 --groq-rpm 300   # роутер Groq
+    python -m bench.bench_e2e --mix chat=1 --groq-keys 2 --groq-tail-rate 0.03 --groq-hedge   # хвосты и дубли
+"""
+import argparse
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+
+from bench.fake_upstreams import FakeUpstreams, add_arguments, config_from_args
+
+OPS = ("chat", "stream", "image", "image_job", "clear")
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def _parse_mix(raw: str) -> Dict[str, float]:
+    mix: Dict[str, float] = {}
+    for part in raw.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPS:
+            raise SystemExit(f"unknown op in --mix: {name} (known: {', '.join(OPS)})")
+        mix[name] = float(weight or "1")
+    return mix
+
+
+def _setup_env(base: str, tmp: str, args: argparse.Namespace) -> None:
+    # до импорта api: модули читают настройки при импорте
+    os.environ.update({
+        "ACCESS_DB_PATH": os.path.join(tmp, "bench.db"),
+        "IMAGE_STORE_DIR": os.path.join(tmp, "images"),
+        "GROQ_API_KEYS": ",".join(f"fake{i + 1}" for i in range(args.groq_keys)),
+        "GROQ_MODELS": args.groq_models,
+        "GROQ_HEDGE": "1" if args.groq_hedge else "0",
+        "GROQ_BASE_URL": base,
+        "STABILITY_API_KEY": "fake",
+        "STABILITY_API_HOST": base,
+        "TELEGRAM_API_BASE": base,
+        "BOT_TOKEN": "123:fake",
+        "TARGET_GROUP_ID": "-100123",
+        "LOG_MIN_INTERVAL": "0",
+        # лимиты не должны мешать замеру, если их не меряем специально
+        "RATE_LIMITS": args.rate_limits,
+        "SLOW_REQUEST_MS": "1e9",
+    })
+
+
+def _git_commit() -> str:
+    try:
+        repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=repo, text=True).strip()
+    except Exception:
+        return ""
+
+
+class LoadGen:
+    def __init__(self, base_url: str, args: argparse.Namespace):
+        self.base_url = base_url
+        self.args = args
+        self.mix = _parse_mix(args.mix)
+        self._lock = threading.Lock()
+        self._seq = 0
+        self.samples: Dict[str, List[Tuple[float, str]]] = {op: [] for op in self.mix}
+        self._local = threading.local()
+        self._photo = self._make_photo()
+
+    @staticmethod
+    def _make_photo() -> bytes:
+        from PIL import Image
+
+        out = io.BytesIO()
+        Image.effect_noise((1200, 900), 40).convert("RGB").save(out, format="JPEG", quality=85)
+        return out.getvalue()
+
+    def _session(self):
+        import requests
+
+        s = getattr(self._local, "session", None)
+        if s is None:
+            s = self._local.session = requests.Session()
+        return s
+
+    def _next(self) -> int:
+        with self._lock:
+            self._seq += 1
+            return self._seq
+
+    def _text(self, rnd: random.Random) -> str:
+        # часть запросов — точные повторы (двойной тап), остальные уникальные
+        if rnd.random() < self.args.dup:
+            return "повтор вопроса"
+        return f"вопрос {self._next()}"
+
+    # ---------- операции: возвращают код ответа или имя ошибки ----------
+    def op_chat(self, uid: int, rnd: random.Random) -> str:
+        r = self._session().post(f"{self.base_url}/api/chat", json={"text": self._text(rnd), "tg_user_id": uid}, timeout=120)
+        return str(r.status_code)
+
+    def op_stream(self, uid: int, rnd: random.Random) -> str:
+        with self._session().post(
+            f"{self.base_url}/api/chat/stream", json={"text": self._text(rnd), "tg_user_id": uid}, stream=True, timeout=120
+        ) as r:
+            if r.status_code != 200:
+                return str(r.status_code)
+            body = r.content.decode("utf-8", "replace")
+        return "200" if "event: done" in body else "stream_error"
+
+    def _image_form(self, uid: int, rnd: random.Random):
+        mode = "img2img" if rnd.random() < self.args.img2img else "txt2img"
+        data = {"tg_user_id": str(uid), "prompt": f"кот {self._next()}", "mode": mode}
+        files = {"image": ("photo.jpg", self._photo, "image/jpeg")} if mode == "img2img" else None
+        return data, files
+
+    def op_image(self, uid: int, rnd: random.Random) -> str:
+        data, files = self._image_form(uid, rnd)
+        r = self._session().post(f"{self.base_url}/api/image", data=data, files=files, timeout=180)
+        return str(r.status_code)
+
+    def op_image_job(self, uid: int, rnd: random.Random) -> str:
+        data, files = self._image_form(uid, rnd)
+        s = self._session()
+        r = s.post(f"{self.base_url}/api/image/jobs", data=data, files=files, timeout=30)
+        if r.status_code != 202:
+            return str(r.status_code)
+        url = r.json()["status_url"]
+        deadline = time.monotonic() + 180
+        while time.monotonic() < deadline:
+            time.sleep(self.args.poll)
+            job = s.get(url, timeout=30).json()
+            if job.get("status") in ("done", "error"):
+                return str(job.get("http_status"))
+        return "job_timeout"
+
+    def op_clear(self, uid: int, rnd: random.Random) -> str:
+        r = self._session().post(f"{self.base_url}/api/memory/clear", json={"tg_user_id": uid}, timeout=30)
+        return str(r.status_code)
+
+    # ---------- прогон ----------
+    def worker(self, idx: int, deadline: float) -> None:
+        rnd = random.Random(self.args.seed + idx)
+        ops = list(self.mix)
+        weights = [self.mix[o] for o in ops]
+        while time.monotonic() < deadline:
+            op = rnd.choices(ops, weights)[0]
+            uid = self.args.user_base + rnd.randrange(self.args.users)
+            t0 = time.perf_counter()
+            try:
+                status = getattr(self, f"op_{op}")(uid, rnd)
+            except Exception as e:
+                status = type(e).__name__
+            with self._lock:
+                self.samples[op].append(((time.perf_counter() - t0) * 1000, status))
+
+    def run(self) -> float:
+        deadline = time.monotonic() + self.args.duration
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(self.args.concurrency) as pool:
+            for i in range(self.args.concurrency):
+                pool.submit(self.worker, i, deadline)
+        return time.perf_counter() - t0
+
+
+def _summarize(samples: List[Tuple[float, str]], elapsed: float) -> Dict[str, Any]:
+    lat = sorted(s[0] for s in samples)
+    statuses: Dict[str, int] = {}
+    for _, st in samples:
+        statuses[st] = statuses.get(st, 0) + 1
+    errors = sum(n for st, n in statuses.items() if not st.startswith("2"))
+    return {
+        "count": len(samples),
+        "rps": round(len(samples) / elapsed, 2) if elapsed else 0.0,
+        "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+        "p50_ms": round(_percentile(lat, 0.50), 1),
+        "p95_ms": round(_percentile(lat, 0.95), 1),
+        "p99_ms": round(_percentile(lat, 0.99), 1),
+        "max_ms": round(lat[-1], 1) if lat else 0.0,
+        "statuses": statuses,
+    }
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--duration", type=float, default=20, help="секунд нагрузки")
+    p.add_argument("--concurrency", type=int, default=16)
+    p.add_argument("--mix", default="chat=6,stream=2,image_job=1,clear=1")
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--user-base", type=int, default=1_000_000)
+    p.add_argument("--dup", type=float, default=0.0, help="доля повторов одного и того же вопроса")
+    p.add_argument("--img2img", type=float, default=0.3, help="доля img2img среди картинок")
+    p.add_argument("--poll", type=float, default=0.5, help="период опроса статуса задачи, с")
+    p.add_argument("--rate-limits", default="chat=100000/1,image=100000/1")
+    p.add_argument("--groq-keys", type=int, default=1, help="сколько фейковых ключей Groq (fake1..fakeN)")
+    p.add_argument("--groq-models", default="llama-3.1-8b-instant", help="GROQ_MODELS через запятую")
+    p.add_argument("--groq-hedge", action="store_true", help="дублировать медленные запросы к Groq (GROQ_HEDGE=1)")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--out", help="куда записать JSON (иначе stdout)")
+    add_arguments(p)
+    args = p.parse_args()
+
+    fake = FakeUpstreams(config_from_args(args), seed=args.seed)
+    base = fake.start()
+    tmp = tempfile.mkdtemp(prefix="bench_e2e_")
+    _setup_env(base, tmp, args)
+
+    import api  # noqa: E402  (после настройки env)
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server("127.0.0.1", 0, api.api, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, name="bench-api", daemon=True).start()
+    api_url = f"http://127.0.0.1:{server.server_port}"
+
+    for uid in range(args.user_base, args.user_base + args.users):
+        api.set_free(uid, True)
+
+    gen = LoadGen(api_url, args)
+    elapsed = gen.run()
+
+    all_samples = [s for samples in gen.samples.values() for s in samples]
+    report = {
+        "commit": _git_commit(),
+        "python": sys.version.split()[0],
+        "config": {k: v for k, v in vars(args).items() if k != "out"},
+        "elapsed_s": round(elapsed, 2),
+        "total": _summarize(all_samples, elapsed),
+        "ops": {op: _summarize(samples, elapsed) for op, samples in gen.samples.items()},
+        "upstreams": fake.stats(),
+        "server": api.api.test_client().get("/api/stats").get_json(),
+    }
+
+    server.shutdown()
+    fake.stop()
+    api.db_close()
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        t = report["total"]
+        print(f"{args.out}: {t['count']} req, {t['rps']} rps, p95 {t['p95_ms']} ms, errors {t['error_rate']:.2%}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
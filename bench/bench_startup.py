@@ -0,0 +1,139 @@
+# bench/bench_startup.py
+"""
+Время холодного старта процессов: импорт точки входа в свежем
+интерпретаторе (как при деплое/рестарте воркера), плюс первое обращение
+к БД, где схема догоняется лениво. Каждый замер — отдельный процесс.
+
+    python -m bench.bench_startup --runs 7 --out startup.json
+    python -m bench.bench_startup --only bot --top 15   # самые дорогие импорты (-X importtime)
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Tuple
+
+from bench.bench_e2e import _git_commit
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# что импортирует процесс каждой роли; "first" — первое действие после импорта
+TARGETS: Dict[str, Dict[str, str]] = {
+    "storage": {"import": "import storage", "first": "storage.get_access(1)"},
+    "bot": {"import": "import bot", "first": "bot.build_application()"},
+    "api": {"import": "import api", "first": "api.api.test_client().get('/health')"},
+    "wsgi": {"import": "import wsgi", "first": "wsgi.app.test_client().get('/api/access/1')"},
+}
+
+_SCRIPT = """
+import time
+t0 = time.perf_counter()
+{import_}
+t1 = time.perf_counter()
+{first}
+t2 = time.perf_counter()
+import json, sys
+heavy = [m for m in ("flask", "groq", "requests", "PIL", "telegram") if m in sys.modules]
+print("RESULT " + json.dumps({{"import_ms": (t1 - t0) * 1000, "first_ms": (t2 - t1) * 1000, "heavy": heavy}}))
+"""
+
+
+def _env(tmp: str) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": REPO + os.pathsep + env.get("PYTHONPATH", ""),
+        "ACCESS_DB_PATH": os.path.join(tmp, "startup.db"),
+        "IMAGE_STORE_DIR": os.path.join(tmp, "images"),
+        "BOT_TOKEN": env.get("BOT_TOKEN") or "123:fake",
+    })
+    return env
+
+
+def _run_once(name: str, tmp: str) -> Dict[str, Any]:
+    t = TARGETS[name]
+    # свежая БД на каждый замер: первый запрос платит за миграцию, как на новом деплое
+    db = os.path.join(tmp, "startup.db")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db + suffix):
+            os.remove(db + suffix)
+    code = _SCRIPT.format(import_=t["import"], first=t["first"])
+    t0 = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, "-c", code], cwd=tmp, env=_env(tmp), capture_output=True, text=True, check=True
+    ).stdout
+    wall_ms = (time.perf_counter() - t0) * 1000
+    line = next(ln for ln in out.splitlines() if ln.startswith("RESULT "))
+    res = json.loads(line[len("RESULT "):])
+    res["process_ms"] = wall_ms
+    return res
+
+
+def _importtime(name: str, tmp: str, top: int) -> List[Tuple[str, float]]:
+    """Самые дорогие прямые импорты точки входа (время с вложенными модулями)."""
+    err = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", TARGETS[name]["import"]],
+        cwd=tmp, env=_env(tmp), capture_output=True, text=True, check=True,
+    ).stderr
+    rows: List[Tuple[str, float]] = []
+    for ln in err.splitlines():
+        if not ln.startswith("import time:") or "|" not in ln or "cumulative" in ln:
+            continue
+        _, cumulative, module = ln[len("import time:"):].split("|")
+        # " name" — сама точка входа, "   name" — то, что она импортирует напрямую
+        if not module.startswith("   ") or module.startswith("    "):
+            continue
+        if module.strip() in ("_distutils_hack", "sitecustomize", "usercustomize"):
+            continue
+        rows.append((module.strip(), int(cumulative) / 1000))
+    rows.sort(key=lambda r: r[1], reverse=True)
+    return [(m, round(ms, 1)) for m, ms in rows[:top]]
+
+
+def _summary(values: List[float]) -> Dict[str, float]:
+    return {
+        "median": round(statistics.median(values), 1),
+        "min": round(min(values), 1),
+        "max": round(max(values), 1),
+    }
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--only", help="через запятую: " + ",".join(TARGETS))
+    p.add_argument("--top", type=int, default=0, help="показать N самых дорогих импортов")
+    p.add_argument("--out", help="куда записать JSON (иначе stdout)")
+    args = p.parse_args()
+
+    names = [n.strip() for n in args.only.split(",")] if args.only else list(TARGETS)
+    tmp = tempfile.mkdtemp(prefix="bench_startup_")
+    report: Dict[str, Any] = {"commit": _git_commit(), "python": sys.version.split()[0], "runs": args.runs, "targets": {}}
+
+    for name in names:
+        _run_once(name, tmp)  # прогрев: .pyc и файловый кэш ОС
+        runs = [_run_once(name, tmp) for _ in range(args.runs)]
+        entry: Dict[str, Any] = {
+            key: _summary([r[key] for r in runs]) for key in ("import_ms", "first_ms", "process_ms")
+        }
+        entry["heavy_modules"] = runs[-1]["heavy"]
+        if args.top:
+            entry["top_imports_ms"] = _importtime(name, tmp, args.top)
+        report["targets"][name] = entry
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        for name, e in report["targets"].items():
+            print(f"{name}: import {e['import_ms']['median']} ms, first {e['first_ms']['median']} ms, "
+                  f"process {e['process_ms']['median']} ms, loaded {','.join(e['heavy_modules']) or '-'}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
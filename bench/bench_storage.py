@@ -0,0 +1,139 @@
+# bench/bench_storage.py
+"""
+Сравнение слоя хранения: старый вариант (новое соединение на каждый вызов,
+rollback-журнал) против пула соединений в WAL.
+
+    python -m bench.bench_storage --calls 3000 --threads 4
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+_tmp = tempfile.mkdtemp(prefix="bench_storage_")
+os.environ["ACCESS_DB_PATH"] = os.path.join(_tmp, "pooled.db")
+
+import storage  # noqa: E402  (после настройки ACCESS_DB_PATH)
+
+LEGACY_DB = os.path.join(_tmp, "legacy.db")
+
+
+# --- старый вариант: connect/commit/close на каждый вызов ---
+def _legacy_conn():
+    return sqlite3.connect(LEGACY_DB, check_same_thread=False)
+
+
+def legacy_init():
+    con = _legacy_conn()
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS access (user_id INTEGER PRIMARY KEY, is_free INTEGER DEFAULT 0, "
+        "is_blocked INTEGER DEFAULT 0, updated_at TEXT, last_menu_chat_id INTEGER, last_menu_message_id INTEGER)"
+    )
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS chat_memory (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, "
+        "role TEXT NOT NULL, text TEXT NOT NULL, created_at TEXT)"
+    )
+    con.commit()
+    con.close()
+
+
+def legacy_get_access(user_id: int):
+    con = _legacy_conn()
+    cur = con.cursor()
+    cur.execute(
+        "SELECT is_free, is_blocked, updated_at, last_menu_chat_id, last_menu_message_id FROM access WHERE user_id=?",
+        (user_id,),
+    )
+    row = cur.fetchone()
+    con.close()
+    return row
+
+
+def legacy_set_free(user_id: int, value: bool):
+    con = _legacy_conn()
+    con.execute(
+        """
+        INSERT INTO access (user_id, is_free, is_blocked, updated_at)
+        VALUES (?, ?, COALESCE((SELECT is_blocked FROM access WHERE user_id=?), 0), ?)
+        ON CONFLICT(user_id) DO UPDATE SET is_free=excluded.is_free, updated_at=excluded.updated_at
+        """,
+        (user_id, 1 if value else 0, user_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+    )
+    con.commit()
+    con.close()
+
+
+def legacy_mem_add(user_id: int, role: str, text: str):
+    con = _legacy_conn()
+    con.execute(
+        "INSERT INTO chat_memory (user_id, role, text, created_at) VALUES (?, ?, ?, ?)",
+        (user_id, role, text, datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+    )
+    con.commit()
+    con.close()
+
+
+def legacy_mem_get(user_id: int, limit: int = 24):
+    con = _legacy_conn()
+    rows = con.execute(
+        "SELECT role, text FROM chat_memory WHERE user_id=? ORDER BY id DESC LIMIT ?",
+        (user_id, limit),
+    ).fetchall()
+    con.close()
+    return rows
+
+
+# --- прогон ---
+def run(fn, calls: int, threads: int) -> float:
+    per_thread = max(1, calls // threads)
+
+    def worker(n: int):
+        for i in range(per_thread):
+            fn(1000 + (n * per_thread + i) % 200)
+
+    ts = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    t0 = time.perf_counter()
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    dt = time.perf_counter() - t0
+    return (per_thread * threads) / dt
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--calls", type=int, default=3000)
+    p.add_argument("--threads", type=int, default=4)
+    args = p.parse_args()
+
+    legacy_init()
+    for uid in range(1000, 1200):
+        legacy_set_free(uid, True)
+        storage.set_free(uid, True)
+
+    cases = [
+        ("get_access", legacy_get_access, storage._get_access_db),
+        ("get_access+cache", legacy_get_access, storage.get_access),
+        ("set_free", lambda u: legacy_set_free(u, True), lambda u: storage.set_free(u, True)),
+        ("mem_add", lambda u: legacy_mem_add(u, "user", "hello"), lambda u: storage.mem_add(u, "user", "hello")),
+        ("mem_get", legacy_mem_get, storage.mem_get),
+    ]
+
+    print(f"db dir: {_tmp}  calls={args.calls} threads={args.threads}")
+    print(f"{'op':<18}{'before, calls/s':>18}{'after, calls/s':>18}{'x':>8}")
+    for name, before_fn, after_fn in cases:
+        before = run(before_fn, args.calls, args.threads)
+        after = run(after_fn, args.calls, args.threads)
+        print(f"{name:<18}{before:>18.0f}{after:>18.0f}{after / before:>8.1f}")
+
+    print("access cache:", storage.access_cache_stats())
+
+    storage.db_close()
+
+
+if __name__ == "__main__":
+    main()
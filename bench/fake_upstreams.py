@@ -0,0 +1,264 @@
+# bench/fake_upstreams.py
+"""
+Локальные заглушки платных API для нагрузочных тестов:
+
+- Groq (OpenAI-совместимый) POST /openai/v1/chat/completions, в т.ч. stream=true
+- Stability v1      POST /v1/generation/<engine>/text-to-image | image-to-image
+- Telegram Bot API  POST /bot<token>/sendMessage
+
+У каждого апстрима настраиваются задержка, разброс и доля ошибок
+(500/503/429 с Retry-After). Groq, как настоящий, отвечает заголовками
+x-ratelimit-*: rpm — лимит запросов в минуту на ключ (0 — без лимита),
+сверх него 429; key_skew — добавка к задержке за номер ключа (fake1,
+fake2, ...: у fakeN на (N-1)*key_skew мс медленнее), чтобы было видно,
+как роутер уводит трафик с медленного ключа; tail_rate — доля ответов,
+которые "зависают" ещё на tail мс (хвост задержек для таймаутов и дублей).
+Отдельно можно запустить так:
+
+    python -m bench.fake_upstreams --port 8099 --groq-latency 300 --groq-error-rate 0.02
+"""
+import argparse
+import base64
+import io
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional
+
+DEFAULTS: Dict[str, Dict[str, float]] = {
+    # latency/jitter — мс; для стрима latency = до первого куска, chunk — между кусками
+    "groq": {"latency": 300, "jitter": 100, "error_rate": 0.0, "chunks": 20, "chunk": 15, "rpm": 0, "key_skew": 0,
+             "tail_rate": 0.0, "tail": 5000},
+    "stability": {"latency": 4000, "jitter": 1000, "error_rate": 0.0},
+    "telegram": {"latency": 80, "jitter": 40, "error_rate": 0.0},
+}
+
+_ERROR_STATUSES = (500, 503, 429)
+
+
+def _make_png(size: int) -> bytes:
+    """Картинка, похожая на настоящую по размеру и сжимаемости: градиент + лёгкий шум."""
+    from PIL import Image
+
+    img = Image.linear_gradient("L").resize((size, size)).convert("RGB")
+    noise = Image.effect_noise((size, size), 24).convert("RGB")
+    img = Image.blend(img, noise, 0.25)
+    out = io.BytesIO()
+    img.save(out, format="PNG")
+    return out.getvalue()
+
+
+class FakeUpstreams:
+    def __init__(self, config: Optional[Dict[str, Dict[str, float]]] = None, image_size: int = 1024, seed: int = 1):
+        self.config = {k: dict(v) for k, v in DEFAULTS.items()}
+        for name, values in (config or {}).items():
+            self.config[name].update(values)
+        self._png_b64 = base64.b64encode(_make_png(image_size)).decode("ascii")
+        self._rnd = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls: Dict[str, int] = {"groq": 0, "stability": 0, "telegram": 0}
+        self.errors: Dict[str, int] = {"groq": 0, "stability": 0, "telegram": 0}
+        # по ключам Groq: всего запросов и окно текущей минуты (начало, счётчик)
+        self.groq_keys: Dict[str, int] = {}
+        self._groq_windows: Dict[str, list] = {}
+        self.server: Optional[ThreadingHTTPServer] = None
+
+    # ---------- поведение ----------
+    def _delay(self, name: str, key: str = "latency") -> None:
+        c = self.config[name]
+        with self._lock:
+            ms = c[key] + self._rnd.uniform(-c.get("jitter", 0), c.get("jitter", 0)) if key == "latency" else c[key]
+            if key == "latency" and self._rnd.random() < c.get("tail_rate", 0):
+                ms += c["tail"]
+        if ms > 0:
+            time.sleep(ms / 1000)
+
+    def _pick_error(self, name: str) -> Optional[int]:
+        with self._lock:
+            self.calls[name] += 1
+            if self._rnd.random() < self.config[name]["error_rate"]:
+                self.errors[name] += 1
+                return self._rnd.choice(_ERROR_STATUSES)
+        return None
+
+    def _groq_quota(self, key: str) -> Dict[str, str]:
+        """Заголовки лимитов для ключа; remaining-requests < 0 — лимит превышен."""
+        rpm = int(self.config["groq"]["rpm"])
+        now = time.monotonic()
+        with self._lock:
+            self.groq_keys[key] = self.groq_keys.get(key, 0) + 1
+            window = self._groq_windows.setdefault(key, [now, 0])
+            if now - window[0] >= 60:
+                window[0], window[1] = now, 0
+            window[1] += 1
+            used, reset = window[1], 60 - (now - window[0])
+        limit = rpm or 14400
+        return {
+            "x-ratelimit-limit-requests": str(limit),
+            "x-ratelimit-remaining-requests": str(limit - used),
+            "x-ratelimit-reset-requests": f"{reset:.2f}s",
+            "x-ratelimit-limit-tokens": "60000",
+            "x-ratelimit-remaining-tokens": "59000",
+            "x-ratelimit-reset-tokens": "1.2s",
+        }
+
+    def _key_skew(self, key: str) -> None:
+        skew = self.config["groq"]["key_skew"]
+        digits = key[len(key.rstrip("0123456789")):]
+        if skew > 0 and digits and int(digits) > 1:
+            time.sleep((int(digits) - 1) * skew / 1000)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"calls": dict(self.calls), "injected_errors": dict(self.errors), "groq_keys": dict(self.groq_keys)}
+
+    # ---------- сервер ----------
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _body(self) -> bytes:
+                n = int(self.headers.get("Content-Length") or 0)
+                return self.rfile.read(n) if n else b""
+
+            def _json(self, status: int, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _error(self, status: int, telegram: bool = False, headers: Optional[Dict[str, str]] = None) -> None:
+                headers = dict(headers or {})
+                if status == 429:
+                    headers.setdefault("Retry-After", "1")
+                if telegram:
+                    payload = {"ok": False, "error_code": status, "description": "injected"}
+                    if status == 429:
+                        payload["parameters"] = {"retry_after": 1}
+                    self._json(status, payload, headers)
+                else:
+                    self._json(status, {"name": "injected_error", "message": f"fake {status}"}, headers)
+
+            def do_POST(self):
+                body = self._body()
+                path = self.path.split("?")[0]
+                if path.endswith("/chat/completions"):
+                    return self._groq(body)
+                if path.startswith("/v1/generation/"):
+                    return self._stability()
+                if path.startswith("/bot") and path.endswith("/sendMessage"):
+                    return self._telegram()
+                self._json(404, {"error": "not_found"})
+
+            def _groq(self, body: bytes) -> None:
+                key = (self.headers.get("Authorization") or "").replace("Bearer ", "", 1)
+                quota = fake._groq_quota(key)
+                if int(quota["x-ratelimit-remaining-requests"]) < 0:
+                    quota["x-ratelimit-remaining-requests"] = "0"
+                    quota["Retry-After"] = str(max(1, int(float(quota["x-ratelimit-reset-requests"][:-1]))))
+                    return self._error(429, headers=quota)
+                err = fake._pick_error("groq")
+                fake._delay("groq")
+                fake._key_skew(key)
+                if err:
+                    return self._error(err)
+                req = json.loads(body or b"{}")
+                model = req.get("model", "fake")
+                words = ["Это", "ответ", "заглушки", "Groq", "для", "нагрузочного", "теста."]
+                n = int(fake.config["groq"]["chunks"])
+                pieces = [words[i % len(words)] + " " for i in range(n)]
+                if not req.get("stream"):
+                    return self._json(200, {
+                        "id": "fake", "object": "chat.completion", "created": int(time.time()), "model": model,
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(pieces)},
+                                     "finish_reason": "stop"}],
+                        "usage": {"prompt_tokens": 100, "completion_tokens": n, "total_tokens": 100 + n},
+                    }, quota)
+                self.send_response(200)
+                for k, v in quota.items():
+                    self.send_header(k, v)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for i, piece in enumerate(pieces + [None]):
+                    chunk = {
+                        "id": "fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                        "choices": [{"index": 0, "delta": {"content": piece} if piece else {},
+                                     "finish_reason": None if piece else "stop"}],
+                    }
+                    self._chunk(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                    if piece and i:
+                        fake._delay("groq", "chunk")
+                self._chunk(b"data: [DONE]\n\n")
+                self._chunk(b"")
+
+            def _chunk(self, data: bytes) -> None:
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+            def _stability(self) -> None:
+                err = fake._pick_error("stability")
+                fake._delay("stability")
+                if err:
+                    return self._error(err)
+                self._json(200, {"artifacts": [{"base64": fake._png_b64, "seed": 1, "finishReason": "SUCCESS"}]})
+
+            def _telegram(self) -> None:
+                err = fake._pick_error("telegram")
+                fake._delay("telegram")
+                if err:
+                    return self._error(err, telegram=True)
+                self._json(200, {"ok": True, "result": {"message_id": 1}})
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="fake-upstreams", daemon=True).start()
+        return f"http://{host}:{self.server.server_address[1]}"
+
+    def stop(self) -> None:
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def add_arguments(p: argparse.ArgumentParser) -> None:
+    for name, values in DEFAULTS.items():
+        for key, value in values.items():
+            p.add_argument(f"--{name}-{key.replace('_', '-')}", type=float, default=value)
+
+
+def config_from_args(args: argparse.Namespace) -> Dict[str, Dict[str, float]]:
+    return {
+        name: {key: getattr(args, f"{name}_{key}") for key in values}
+        for name, values in DEFAULTS.items()
+    }
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--port", type=int, default=8099)
+    add_arguments(p)
+    args = p.parse_args()
+    fake = FakeUpstreams(config_from_args(args))
+    base = fake.start(port=args.port)
+    print(f"GROQ_BASE_URL={base}  STABILITY_API_HOST={base}  TELEGRAM_API_BASE={base}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
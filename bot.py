@@ -1,6 +1,10 @@
 import os
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters
 
+from metrics import serve_metrics, timed_handler
+
+from bot_async import start_loop_lag_monitor
+from bot_broadcast import start_broadcast_scheduler
 from bot_handlers import start, on_button
 from bot_admin import (
     cmd_whoami,
@@ -9,12 +13,33 @@ from bot_admin import (
     cmd_block,
     cmd_unblock,
     cmd_status,
+    cmd_free_many,
+    cmd_paid_many,
+    cmd_block_many,
+    cmd_unblock_many,
+    cmd_broadcast,
+    cmd_broadcast_status,
+    cmd_broadcast_cancel,
+    on_bulk_document,
 )
 
 BOT_TOKEN = (os.getenv("BOT_TOKEN") or "").strip()
+# отдельный /metrics для процесса бота (при APP_ROLE=bot или бот в дочернем процессе); 0 — выключено
+BOT_METRICS_PORT = int(os.getenv("BOT_METRICS_PORT") or "0")
 
 
 async def post_init(app: Application):
+    if BOT_METRICS_PORT:
+        try:
+            serve_metrics(BOT_METRICS_PORT)
+        except OSError as e:
+            # порт ещё держит предыдущий владелец бота (webhook) — бот важнее метрик
+            print("BOT METRICS ERROR:", e)
+    # задержка event loop — признак того, что где-то в обработчиках блокирующий вызов
+    start_loop_lag_monitor()
+    # рассылки из SQLite: после рестарта продолжаются незавершённые
+    start_broadcast_scheduler(app.bot)
+
     # Команды для подсказок "/" (чтобы слева предлагались команды)
     # Покажутся у тех, кто пишет боту/в группе с ботом (Telegram сам решает где отображать)
     await app.bot.set_my_commands(
@@ -26,27 +51,60 @@ async def post_init(app: Application):
             ("block", "Заблокировать: /block <user_id>"),
             ("unblock", "Разблокировать: /unblock <user_id>"),
             ("status", "Статус: /status <user_id>"),
+            ("free_many", "FREE списком id или CSV"),
+            ("paid_many", "Платно списком id или CSV"),
+            ("block_many", "Заблокировать списком id или CSV"),
+            ("unblock_many", "Разблокировать списком id или CSV"),
+            ("broadcast", "Рассылка: /broadcast <текст>"),
+            ("broadcast_status", "Прогресс рассылок"),
+            ("broadcast_cancel", "Отменить рассылку: /broadcast_cancel <id>"),
         ]
     )
 
 
-def start_bot():
+def build_application(updater: bool = True) -> Application:
+    """Приложение PTB со всеми обработчиками; updater=False — для webhook (апдейты приносит API)."""
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN is not set")
 
-    app = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+    builder = Application.builder().token(BOT_TOKEN).post_init(post_init)
+    if not updater:
+        builder = builder.updater(None)
+    app = builder.build()
 
     # user
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CallbackQueryHandler(on_button))
+    app.add_handler(CommandHandler("start", timed_handler("start", start)))
+    app.add_handler(CallbackQueryHandler(timed_handler("on_button", on_button)))
 
     # admin (работают только в группе логов и только от ADMIN_USER_ID)
-    app.add_handler(CommandHandler("whoami", cmd_whoami))
-    app.add_handler(CommandHandler("free", cmd_free))
-    app.add_handler(CommandHandler("paid", cmd_paid))
-    app.add_handler(CommandHandler("block", cmd_block))
-    app.add_handler(CommandHandler("unblock", cmd_unblock))
-    app.add_handler(CommandHandler("status", cmd_status))
-
-    print("🤖 Telegram bot started")
+    app.add_handler(CommandHandler("whoami", timed_handler("cmd_whoami", cmd_whoami)))
+    app.add_handler(CommandHandler("free", timed_handler("cmd_free", cmd_free)))
+    app.add_handler(CommandHandler("paid", timed_handler("cmd_paid", cmd_paid)))
+    app.add_handler(CommandHandler("block", timed_handler("cmd_block", cmd_block)))
+    app.add_handler(CommandHandler("unblock", timed_handler("cmd_unblock", cmd_unblock)))
+    app.add_handler(CommandHandler("status", timed_handler("cmd_status", cmd_status)))
+
+    # массовые команды: id в аргументах, CSV в ответе или CSV с командой в подписи
+    app.add_handler(CommandHandler("free_many", timed_handler("cmd_free_many", cmd_free_many)))
+    app.add_handler(CommandHandler("paid_many", timed_handler("cmd_paid_many", cmd_paid_many)))
+    app.add_handler(CommandHandler("block_many", timed_handler("cmd_block_many", cmd_block_many)))
+    app.add_handler(CommandHandler("unblock_many", timed_handler("cmd_unblock_many", cmd_unblock_many)))
+    app.add_handler(
+        MessageHandler(
+            filters.Document.ALL & filters.CaptionRegex(r"^/(free|paid|block|unblock)_many\b"),
+            timed_handler("on_bulk_document", on_bulk_document),
+        )
+    )
+    app.add_handler(CommandHandler("broadcast", timed_handler("cmd_broadcast", cmd_broadcast)))
+    app.add_handler(CommandHandler("broadcast_status", timed_handler("cmd_broadcast_status", cmd_broadcast_status)))
+    app.add_handler(CommandHandler("broadcast_cancel", timed_handler("cmd_broadcast_cancel", cmd_broadcast_cancel)))
+    return app
+
+
+def start_bot():
+    # long polling: для локальной разработки и как запасной вариант к webhook
+    # (start_polling сам снимает ранее установленный webhook)
+    app = build_application()
+
+    print("🤖 Telegram bot started (polling)")
     app.run_polling(stop_signals=None, close_loop=False)
\ No newline at end of file
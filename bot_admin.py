@@ -1,10 +1,23 @@
+import csv
+import io
 import os
 import re
+from typing import List
+
 from telegram import Update
 from telegram.ext import ContextTypes
 
-from api import set_free, set_blocked, get_access
-from bot_handlers import send_fresh_menu, send_block_notice
+from storage import broadcast_cancel, broadcast_counts, broadcast_get, broadcast_recent
+from bot_async import (
+    get_access_async,
+    list_user_ids_async,
+    run_blocking,
+    set_blocked_async,
+    set_blocked_many_async,
+    set_free_async,
+    set_free_many_async,
+)
+from bot_broadcast import enqueue_broadcast, progress_text
 
 ADMIN_USER_ID_RAW = (os.getenv("ADMIN_USER_ID") or "0").strip()
 try:
@@ -19,6 +32,10 @@ try:
 except Exception:
     ADMIN_GROUP_ID = 0
 
+# защита от случайной загрузки огромного файла
+BULK_MAX_IDS = int(os.getenv("BULK_MAX_IDS") or "100000")
+BULK_MAX_FILE_BYTES = int(os.getenv("BULK_MAX_FILE_BYTES") or str(5 * 1024 * 1024))
+
 
 def is_admin(update: Update) -> bool:
     u = update.effective_user
@@ -49,15 +66,8 @@ async def cmd_whoami(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def _push_menu(context: ContextTypes.DEFAULT_TYPE, uid: int):
-    a = get_access(uid)
-    if a.get("is_blocked"):
-        await send_block_notice(context.bot, uid)
-    else:
-        await send_fresh_menu(
-            context.bot,
-            uid,
-            "🤖 InstaGroq AI\n\nВыбирай действие кнопками ниже 👇",
-        )
+    # рассылка на одного: общий с массовыми темп и flood wait, повторы и переживает рестарт
+    await enqueue_broadcast(context.bot, "menu", [uid])
 
 
 async def cmd_free(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -71,10 +81,10 @@ async def cmd_free(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.effective_message.reply_text("❌ Не вижу user_id. Нужно число.")
         return
 
-    set_free(uid, True)
+    await set_free_async(uid, True)
     await _push_menu(context, uid)
 
-    a = get_access(uid)
+    a = await get_access_async(uid)
     await update.effective_message.reply_text(f"✅ FREE включен для {uid}\n{a}")
 
 
@@ -89,10 +99,10 @@ async def cmd_paid(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.effective_message.reply_text("❌ Не вижу user_id. Нужно число.")
         return
 
-    set_free(uid, False)
+    await set_free_async(uid, False)
     await _push_menu(context, uid)
 
-    a = get_access(uid)
+    a = await get_access_async(uid)
     await update.effective_message.reply_text(f"✅ Теперь платно для {uid}\n{a}")
 
 
@@ -107,10 +117,10 @@ async def cmd_block(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.effective_message.reply_text("❌ Не вижу user_id. Нужно число.")
         return
 
-    set_blocked(uid, True)
+    await set_blocked_async(uid, True)
     await _push_menu(context, uid)
 
-    a = get_access(uid)
+    a = await get_access_async(uid)
     await update.effective_message.reply_text(f"⛔ Заблокирован {uid}\n{a}")
 
 
@@ -125,10 +135,10 @@ async def cmd_unblock(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.effective_message.reply_text("❌ Не вижу user_id. Нужно число.")
         return
 
-    set_blocked(uid, False)
+    await set_blocked_async(uid, False)
     await _push_menu(context, uid)
 
-    a = get_access(uid)
+    a = await get_access_async(uid)
     await update.effective_message.reply_text(f"✅ Разблокирован {uid}\n{a}")
 
 
@@ -142,5 +152,180 @@ async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not uid:
         await update.effective_message.reply_text("❌ Не вижу user_id. Нужно число.")
         return
-    a = get_access(uid)
-    await update.effective_message.reply_text(f"ℹ️ Статус {uid}\n{a}")
\ No newline at end of file
+    a = await get_access_async(uid)
+    await update.effective_message.reply_text(f"ℹ️ Статус {uid}\n{a}")
+
+
+# =========================
+#   BULK: много user_id сразу
+# =========================
+def parse_user_ids(parts: List[str]) -> List[int]:
+    """user_id из аргументов команды: через пробел, запятую или с новой строки."""
+    ids: List[int] = []
+    for part in parts:
+        ids.extend(int(x) for x in re.findall(r"\d+", part or ""))
+    return [uid for uid in ids if uid]
+
+
+def parse_csv_ids(data: bytes) -> List[int]:
+    """user_id из CSV: колонка user_id (или tg_user_id / id), иначе первая колонка."""
+    text = data.decode("utf-8-sig", errors="replace")
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    rows = list(csv.reader(io.StringIO(text), dialect))
+    if not rows:
+        return []
+    col = 0
+    header = [c.strip().lower() for c in rows[0]]
+    for name in ("user_id", "tg_user_id", "id"):
+        if name in header:
+            col = header.index(name)
+            rows = rows[1:]
+            break
+    ids: List[int] = []
+    for row in rows:
+        if len(row) > col:
+            uid = parse_user_id(row[col])
+            if uid > 0:
+                ids.append(uid)
+    return ids
+
+
+async def _document_ids(update: Update) -> List[int]:
+    """CSV из самого сообщения (команда в подписи) или из сообщения, на которое ответили."""
+    msg = update.effective_message
+    doc = msg.document or (msg.reply_to_message.document if msg.reply_to_message else None)
+    if not doc:
+        return []
+    if doc.file_size and doc.file_size > BULK_MAX_FILE_BYTES:
+        raise ValueError(f"файл больше {BULK_MAX_FILE_BYTES // 1024} КБ")
+    f = await doc.get_file()
+    return parse_csv_ids(bytes(await f.download_as_bytearray()))
+
+
+async def _collect_ids(update: Update, context: ContextTypes.DEFAULT_TYPE) -> List[int]:
+    args = context.args
+    if args is None:
+        # команда в подписи к документу: аргументы после неё
+        args = (update.effective_message.caption or "").split()[1:]
+    ids = parse_user_ids(args) + await _document_ids(update)
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > BULK_MAX_IDS:
+        raise ValueError(f"слишком много user_id: {len(ids)} > {BULK_MAX_IDS}")
+    return ids
+
+
+BULK_ACTIONS = {
+    "free_many": (set_free_many_async, True, "✅ FREE включен"),
+    "paid_many": (set_free_many_async, False, "✅ Теперь платно"),
+    "block_many": (set_blocked_many_async, True, "⛔ Заблокированы"),
+    "unblock_many": (set_blocked_many_async, False, "✅ Разблокированы"),
+}
+
+
+async def _bulk(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str):
+    msg = update.effective_message
+    try:
+        ids = await _collect_ids(update, context)
+    except ValueError as e:
+        await msg.reply_text(f"❌ {e}")
+        return
+    if not ids:
+        await msg.reply_text(
+            f"Использование: /{action} <user_id> <user_id> ...\n"
+            f"или отправь CSV с подписью /{action} (либо ответь командой на CSV)"
+        )
+        return
+
+    setter, value, title = BULK_ACTIONS[action]
+    # одна транзакция на весь список
+    n = await setter(ids, value)
+    await msg.reply_text(f"{title} для {n} пользователей. Рассылаю меню…")
+    # меню — через планировщик рассылок, с соблюдением лимитов Telegram
+    await enqueue_broadcast(context.bot, "menu", ids, report_chat_id=update.effective_chat.id)
+
+
+async def cmd_free_many(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if is_admin(update):
+        await _bulk(update, context, "free_many")
+
+
+async def cmd_paid_many(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if is_admin(update):
+        await _bulk(update, context, "paid_many")
+
+
+async def cmd_block_many(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if is_admin(update):
+        await _bulk(update, context, "block_many")
+
+
+async def cmd_unblock_many(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if is_admin(update):
+        await _bulk(update, context, "unblock_many")
+
+
+async def on_bulk_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """CSV-документ с подписью вида /free_many."""
+    if not is_admin(update):
+        return
+    caption = (update.effective_message.caption or "").strip()
+    action = caption.split()[0].lstrip("/").split("@")[0] if caption else ""
+    if action in BULK_ACTIONS:
+        await _bulk(update, context, action)
+
+
+# =========================
+#   BROADCAST
+# =========================
+async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        return
+    msg = update.effective_message
+    parts = (msg.text or "").split(None, 1)
+    text = parts[1].strip() if len(parts) > 1 else ""
+    if not text:
+        await msg.reply_text(
+            "Использование: /broadcast <текст>\n"
+            "Всем незаблокированным; ответом на CSV — только пользователям из файла."
+        )
+        return
+    try:
+        ids = await _document_ids(update)
+    except ValueError as e:
+        await msg.reply_text(f"❌ {e}")
+        return
+    if not ids:
+        ids = await list_user_ids_async()
+    if not ids:
+        await msg.reply_text("Некому отправлять: список пользователей пуст.")
+        return
+    await enqueue_broadcast(context.bot, "text", ids, text=text, report_chat_id=update.effective_chat.id)
+
+
+async def cmd_broadcast_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        return
+    bid = parse_user_id(context.args[0]) if context.args else 0
+    items = [await run_blocking(broadcast_get, bid)] if bid else await run_blocking(broadcast_recent, 5)
+    items = [b for b in items if b]
+    if not items:
+        await update.effective_message.reply_text("Рассылок нет.")
+        return
+    lines = [progress_text(b, await run_blocking(broadcast_counts, b["id"])) for b in items]
+    await update.effective_message.reply_text("\n\n".join(lines))
+
+
+async def cmd_broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        return
+    bid = parse_user_id(context.args[0]) if context.args else 0
+    if not bid:
+        await update.effective_message.reply_text("Использование: /broadcast_cancel <id>")
+        return
+    ok = await run_blocking(broadcast_cancel, bid)
+    await update.effective_message.reply_text(
+        f"🛑 Рассылка #{bid} отменена" if ok else f"Рассылка #{bid} не найдена или уже завершена"
+    )
@@ -0,0 +1,125 @@
+# bot_async.py
+"""
+Асинхронные обёртки над хранилищем для обработчиков бота.
+
+Обработчики PTB выполняются в event loop: любой синхронный вызов SQLite
+там останавливает обработку апдейтов всех пользователей. Здесь каждый
+такой вызов уходит в отдельный небольшой пул потоков; попадание в кэш
+доступа отвечает сразу, без переключения потока. Логи в Telegram бот
+только ставит в очередь (log_forwarder), так что сетевых ожиданий в
+loop нет вовсе.
+
+Плюс замер задержки event loop: если loop где-то блокируется, это сразу
+видно в bot_event_loop_lag_seconds.
+"""
+import asyncio
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import metrics
+from storage import (
+    clear_last_menu,
+    get_access,
+    list_user_ids,
+    peek_access,
+    set_blocked,
+    set_blocked_many,
+    set_free,
+    set_free_many,
+    set_last_menu,
+)
+
+BOT_DB_THREADS = int(os.getenv("BOT_DB_THREADS") or "4")
+# период проверки задержки event loop, секунды
+BOT_LOOP_LAG_INTERVAL = float(os.getenv("BOT_LOOP_LAG_INTERVAL") or "0.5")
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+LOOP_LAG = metrics.histogram(
+    "bot_event_loop_lag_seconds",
+    "How late the bot event loop wakes up a timer (blocking work shows up here)",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+LOOP_LAG_MAX = metrics.gauge("bot_event_loop_lag_max_seconds", "Max event loop lag over the last minute")
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=BOT_DB_THREADS, thread_name_prefix="bot-db")
+    return _executor
+
+
+async def run_blocking(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """Выполнить синхронную функцию в пуле, не блокируя event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), functools.partial(fn, *args, **kwargs))
+
+
+# =========================
+#   STORAGE (async)
+# =========================
+async def get_access_async(user_id: int) -> Dict[str, Any]:
+    cached = peek_access(user_id)
+    if cached is not None:
+        return cached
+    return await run_blocking(get_access, user_id)
+
+
+async def get_last_menu_async(user_id: int) -> Tuple[Optional[int], Optional[int]]:
+    a = await get_access_async(user_id)
+    return a.get("last_menu_chat_id"), a.get("last_menu_message_id")
+
+
+async def set_last_menu_async(user_id: int, chat_id: int, message_id: int) -> None:
+    await run_blocking(set_last_menu, user_id, chat_id, message_id)
+
+
+async def clear_last_menu_async(user_id: int) -> None:
+    await run_blocking(clear_last_menu, user_id)
+
+
+async def set_free_async(user_id: int, value: bool) -> None:
+    await run_blocking(set_free, user_id, value)
+
+
+async def set_blocked_async(user_id: int, value: bool) -> None:
+    await run_blocking(set_blocked, user_id, value)
+
+
+async def set_free_many_async(user_ids: List[int], value: bool) -> int:
+    return await run_blocking(set_free_many, user_ids, value)
+
+
+async def set_blocked_many_async(user_ids: List[int], value: bool) -> int:
+    return await run_blocking(set_blocked_many, user_ids, value)
+
+
+async def list_user_ids_async(include_blocked: bool = False) -> List[int]:
+    return await run_blocking(list_user_ids, include_blocked)
+
+
+# =========================
+#   EVENT LOOP LAG
+# =========================
+async def _watch_loop_lag() -> None:
+    window_started = time.monotonic()
+    window_max = 0.0
+    while True:
+        t0 = time.monotonic()
+        await asyncio.sleep(BOT_LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.monotonic() - t0 - BOT_LOOP_LAG_INTERVAL)
+        LOOP_LAG.observe(lag)
+        window_max = max(window_max, lag)
+        LOOP_LAG_MAX.set(window_max)
+        if time.monotonic() - window_started >= 60:
+            window_started = time.monotonic()
+            window_max = 0.0
+
+
+def start_loop_lag_monitor() -> "asyncio.Task":
+    """Вызывать из работающего loop (post_init бота)."""
+    return asyncio.get_running_loop().create_task(_watch_loop_lag(), name="loop-lag")
@@ -0,0 +1,251 @@
+# bot_broadcast.py
+"""
+Планировщик рассылок бота: меню после массовой смены доступа и объявления.
+
+Получатели лежат в SQLite (broadcasts / broadcast_recipients), поэтому
+рассылка переживает рестарт: после запуска планировщик продолжает
+незавершённые. Получателей забирают пачками с арендой, так что несколько
+процессов (webhook под gunicorn) не шлют одному человеку дважды.
+
+Темп держит SendPacer: общий лимит на бота (BROADCAST_RATE сообщений в
+секунду, у Telegram ~30) и пауза между сообщениями в один чат. Лимит
+Telegram общий на токен, поэтому рассылает только один процесс — тот,
+что держит файловый замок BROADCAST_LOCK_PATH; планировщики в других
+процессах (второй бот, перекрытие при деплое) ждут, пока он не освободится. На 429
+(flood wait) вся отправка замирает на retry_after, а попытка не
+засчитывается. Прогресс раз в BROADCAST_PROGRESS_INTERVAL секунд
+обновляется в сообщении у админа.
+"""
+import asyncio
+import fcntl
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import metrics
+from storage import (
+    DB_PATH,
+    broadcast_active,
+    broadcast_claim,
+    broadcast_counts,
+    broadcast_create,
+    broadcast_get,
+    broadcast_mark,
+    broadcast_set_report,
+    broadcast_try_finish,
+)
+from bot_async import run_blocking
+from bot_handlers import push_menu
+
+# сообщений в секунду на весь бот (в процессе)
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE") or "25")
+# пауза между сообщениями в один чат, с
+BROADCAST_CHAT_INTERVAL = float(os.getenv("BROADCAST_CHAT_INTERVAL") or "1")
+# у групп свой лимит Telegram: ~20 сообщений в минуту
+BROADCAST_GROUP_INTERVAL = float(os.getenv("BROADCAST_GROUP_INTERVAL") or "3")
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH") or "50")
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY") or "8")
+BROADCAST_MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS") or "3")
+BROADCAST_POLL = float(os.getenv("BROADCAST_POLL") or "2")
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL") or "10")
+BROADCAST_LOCK_PATH = os.getenv("BROADCAST_LOCK_PATH") or (DB_PATH + ".broadcast.lock")
+
+BROADCAST_MESSAGES = metrics.counter(
+    "broadcast_messages_total", "Broadcast deliveries by kind and result", ["kind", "result"]
+)
+FLOOD_WAIT_SECONDS = metrics.counter("broadcast_flood_wait_seconds_total", "Time paused on Telegram 429 flood wait")
+
+_task: Optional["asyncio.Task"] = None
+_lock_fd: Optional[int] = None
+_last_progress: Dict[int, float] = {}
+
+
+class SendPacer:
+    """Общий темп отправки + интервал на чат + пауза на flood wait. Только внутри одного event loop."""
+
+    def __init__(self, rate: float, chat_interval: float, max_chats: int = 10000):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.chat_interval = chat_interval
+        self.max_chats = max_chats
+        self._next = 0.0
+        self._paused_until = 0.0
+        self._chat_next: "OrderedDict[int, float]" = OrderedDict()
+
+    async def wait(self, chat_id: int, cost: float = 1.0) -> None:
+        while True:
+            now = time.monotonic()
+            at = max(self._next, self._paused_until, self._chat_next.get(chat_id, 0.0))
+            if at <= now:
+                self._next = now + self.interval * cost
+                gap = BROADCAST_GROUP_INTERVAL if chat_id < 0 else self.chat_interval
+                self._chat_next[chat_id] = now + gap * cost
+                self._chat_next.move_to_end(chat_id)
+                while len(self._chat_next) > self.max_chats:
+                    self._chat_next.popitem(last=False)
+                return
+            await asyncio.sleep(at - now)
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+pacer = SendPacer(BROADCAST_RATE, BROADCAST_CHAT_INTERVAL)
+
+
+def _retry_after_seconds(e: Exception) -> float:
+    ra = getattr(e, "retry_after", 5)
+    return ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+
+
+# =========================
+#   ОТПРАВКА
+# =========================
+async def _deliver(bot, b: Dict[str, Any], user_id: int, attempt: int) -> Tuple[int, str, Optional[str], int]:
+    from telegram.error import BadRequest, Forbidden, RetryAfter
+
+    try:
+        if b["kind"] == "menu":
+            # удаление старого меню + новое сообщение
+            await pacer.wait(user_id, cost=2)
+            await push_menu(bot, user_id)
+        else:
+            await pacer.wait(user_id)
+            await bot.send_message(chat_id=user_id, text=b["text"])
+        result = ("sent", None, 0)
+    except RetryAfter as e:
+        wait = _retry_after_seconds(e)
+        pacer.pause(wait)
+        FLOOD_WAIT_SECONDS.inc(wait)
+        result = ("pending", "flood_wait", 1)
+    except Forbidden as e:
+        # пользователь заблокировал бота — повторять бессмысленно
+        result = ("failed", f"forbidden: {e}"[:200], 0)
+    except BadRequest as e:
+        result = ("failed", f"bad_request: {e}"[:200], 0)
+    except Exception as e:
+        err = f"{type(e).__name__}: {e}"[:200]
+        result = ("pending" if attempt < BROADCAST_MAX_ATTEMPTS else "failed", err, 0)
+    BROADCAST_MESSAGES.labels(b["kind"], result[1] if result[1] == "flood_wait" else result[0]).inc()
+    return (user_id,) + result
+
+
+async def _run_batch(bot, b: Dict[str, Any], claimed: List[Tuple[int, int]]) -> None:
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def one(uid: int, attempt: int):
+        async with sem:
+            return await _deliver(bot, b, uid, attempt)
+
+    results = await asyncio.gather(*(one(uid, attempt) for uid, attempt in claimed))
+    await run_blocking(broadcast_mark, b["id"], list(results))
+
+
+# =========================
+#   ПРОГРЕСС
+# =========================
+def progress_text(b: Dict[str, Any], counts: Dict[str, int]) -> str:
+    done = counts["sent"] + counts["failed"]
+    title = "меню" if b["kind"] == "menu" else "объявление"
+    status = {"running": "⏳ идёт", "done": "✅ готово", "cancelled": "🛑 отменена"}.get(b["status"], b["status"])
+    return (
+        f"📣 Рассылка #{b['id']} ({title}) — {status}\n"
+        f"{done}/{b['total']}: отправлено {counts['sent']}, ошибок {counts['failed']}"
+    )
+
+
+async def _report(bot, b: Dict[str, Any], force: bool = False) -> None:
+    if not b.get("report_chat_id") or not b.get("report_message_id"):
+        return
+    now = time.monotonic()
+    if not force and now - _last_progress.get(b["id"], 0.0) < BROADCAST_PROGRESS_INTERVAL:
+        return
+    _last_progress[b["id"]] = now
+    counts = await run_blocking(broadcast_counts, b["id"])
+    try:
+        await pacer.wait(b["report_chat_id"])
+        await bot.edit_message_text(
+            progress_text(b, counts), chat_id=b["report_chat_id"], message_id=b["report_message_id"]
+        )
+    except Exception as e:
+        # "message is not modified" и прочее — прогресс не критичен
+        print("BROADCAST REPORT ERROR:", e)
+
+
+# =========================
+#   ПЛАНИРОВЩИК
+# =========================
+async def _tick(bot) -> bool:
+    """Одна пачка самой старой незавершённой рассылки. False — делать нечего."""
+    for b in await run_blocking(broadcast_active):
+        claimed = await run_blocking(broadcast_claim, b["id"], BROADCAST_BATCH)
+        if claimed:
+            await _run_batch(bot, b, claimed)
+            await _report(bot, b)
+            return True
+        if await run_blocking(broadcast_try_finish, b["id"]):
+            b["status"] = "done"
+            await _report(bot, b, force=True)
+            _last_progress.pop(b["id"], None)
+        # остаток держат другие процессы — смотрим следующую рассылку
+    return False
+
+
+def _hold_sender_lock() -> bool:
+    """Этот процесс — единственный отправитель рассылок? Замок держим до конца процесса."""
+    global _lock_fd
+    if _lock_fd is not None:
+        return True
+    fd = os.open(BROADCAST_LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return False
+    _lock_fd = fd
+    return True
+
+
+def _reset_after_fork() -> None:
+    # flock наследуется дочерним процессом через общий файл — ребёнок рассылки не ведёт
+    global _lock_fd
+    if _lock_fd is not None:
+        os.close(_lock_fd)
+    _lock_fd = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+async def _scheduler(bot) -> None:
+    while True:
+        try:
+            # рассылает другой процесс — ждём, вдруг он завершится
+            busy = await _tick(bot) if _hold_sender_lock() else False
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("BROADCAST ERROR:", e)
+            busy = False
+        if not busy:
+            await asyncio.sleep(BROADCAST_POLL)
+
+
+def start_broadcast_scheduler(bot) -> "asyncio.Task":
+    """Вызывать из работающего loop (post_init бота)."""
+    global _task
+    _task = asyncio.get_running_loop().create_task(_scheduler(bot), name="broadcast")
+    return _task
+
+
+async def enqueue_broadcast(
+    bot, kind: str, user_ids: List[int], text: Optional[str] = None, report_chat_id: Optional[int] = None
+) -> int:
+    """Поставить рассылку в очередь; если задан report_chat_id — туда придёт сообщение с прогрессом."""
+    bid = await run_blocking(broadcast_create, kind, text, user_ids, report_chat_id)
+    if report_chat_id:
+        b = await run_blocking(broadcast_get, bid)
+        counts = {"pending": b["total"], "sending": 0, "sent": 0, "failed": 0}
+        m = await bot.send_message(chat_id=report_chat_id, text=progress_text(b, counts))
+        await run_blocking(broadcast_set_report, bid, m.message_id)
+    return bid
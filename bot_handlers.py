@@ -1,41 +1,28 @@
 # bot_handlers.py
 import os
 from datetime import datetime
+from typing import Any, Dict, Optional
 
-import requests
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
+from telegram.error import BadRequest
 from telegram.ext import ContextTypes
 
-from api import get_access, get_last_menu, set_last_menu, clear_last_menu
+import metrics
+from bot_async import clear_last_menu_async, get_access_async, get_last_menu_async, set_last_menu_async
+from log_forwarder import enqueue_log
 
-BOT_TOKEN = (os.getenv("BOT_TOKEN") or "").strip()
 MINIAPP_URL = (os.getenv("MINIAPP_URL") or "").strip()
 
-# лог-группа: TARGET_GROUP_ID приоритет
-GROUP_ID_RAW = (os.getenv("TARGET_GROUP_ID") or os.getenv("LOG_GROUP_ID") or "0").strip()
-try:
-    GROUP_ID = int(GROUP_ID_RAW)
-except Exception:
-    GROUP_ID = 0
-
 
 def is_valid_https_url(url: str) -> bool:
     return url.startswith("https://") and len(url) > len("https://")
 
 
 def send_log_http(text: str):
-    if not BOT_TOKEN or not GROUP_ID:
-        return
-    try:
-        r = requests.post(
-            f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage",
-            json={"chat_id": GROUP_ID, "text": text},
-            timeout=12,
-        )
-        if not r.ok:
-            print("LOG ERROR:", r.status_code, r.text)
-    except Exception as e:
-        print("LOG ERROR:", e)
+    # только постановка в очередь: event loop бота не ждёт Telegram
+    ok, info = enqueue_log(text)
+    if not ok:
+        print("LOG ERROR:", info)
 
 
 def build_start_log(update: Update) -> str:
@@ -90,22 +77,16 @@ TAB_TEXT = {
 }
 
 
-def tab_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_menu")]])
-
-
-def main_menu_for_user(user_id: int) -> InlineKeyboardMarkup:
-    a = get_access(user_id) if user_id else {"is_free": False, "is_blocked": False}
-
+def _build_menu(layout: str) -> InlineKeyboardMarkup:
     keyboard = []
 
     # если заблокирован — показываем вкладку "blocked" (по нажатию откроется вкладка)
-    if a.get("is_blocked"):
+    if layout == "blocked":
         keyboard.append([InlineKeyboardButton("⛔ Доступ заблокирован", callback_data="tab:blocked")])
         return InlineKeyboardMarkup(keyboard)
 
     # открыть miniapp: если free -> web_app, иначе вкладка оплаты
-    if a.get("is_free") and is_valid_https_url(MINIAPP_URL):
+    if layout == "free":
         keyboard.append([InlineKeyboardButton("🚀 Открыть Mini App", web_app=WebAppInfo(url=MINIAPP_URL))])
     else:
         keyboard.append([InlineKeyboardButton("🚀 Открыть Mini App", callback_data="tab:need_pay")])
@@ -134,18 +115,58 @@ def main_menu_for_user(user_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(keyboard)
 
 
+# раскладок всего три — собираем один раз (разметка PTB неизменяемая, её можно делить)
+MENU_MARKUPS: Dict[str, InlineKeyboardMarkup] = {
+    layout: _build_menu(layout) for layout in ("blocked", "free", "pay")
+}
+TAB_KB = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_menu")]])
+
+
+def tab_kb() -> InlineKeyboardMarkup:
+    return TAB_KB
+
+
+def menu_layout(a: Dict[str, Any]) -> str:
+    if a.get("is_blocked"):
+        return "blocked"
+    if a.get("is_free") and is_valid_https_url(MINIAPP_URL):
+        return "free"
+    return "pay"
+
+
+async def main_menu_for_user(user_id: int) -> InlineKeyboardMarkup:
+    a = await get_access_async(user_id) if user_id else {"is_free": False, "is_blocked": False}
+    return MENU_MARKUPS[menu_layout(a)]
+
+
+# =========================
+#   MENU VIEWS (что показывает меню)
+# =========================
+# в callback Telegram присылает само сообщение с кнопкой — его текст и разметка и есть
+# "что сейчас показано"; верно для любого процесса и после рестарта, без своего кэша
+MENU_EDITS_SKIPPED = metrics.counter("bot_menu_edits_skipped_total", "Menu edits skipped because nothing changed")
+
+
+def _shows(msg, text: str, markup: InlineKeyboardMarkup) -> bool:
+    return (msg.text or "") == text and msg.reply_markup == markup
+
+
+def _not_modified(e: Exception) -> bool:
+    return isinstance(e, BadRequest) and "not modified" in str(e).lower()
+
+
 # =========================
 #   MENU MESSAGE MANAGEMENT
 # =========================
 async def delete_prev_menu(bot, user_id: int):
-    chat_id, msg_id = get_last_menu(user_id)
+    chat_id, msg_id = await get_last_menu_async(user_id)
     if not chat_id or not msg_id:
         return
     try:
         await bot.delete_message(chat_id=chat_id, message_id=msg_id)
     except Exception:
         pass
-    clear_last_menu(user_id)
+    await clear_last_menu_async(user_id)
 
 
 async def send_fresh_menu(bot, user_id: int, text: str):
@@ -153,12 +174,14 @@ async def send_fresh_menu(bot, user_id: int, text: str):
     await delete_prev_menu(bot, user_id)
 
     # отправляем новое
+    a = await get_access_async(user_id)
+    layout = menu_layout(a)
     m = await bot.send_message(
         chat_id=user_id,
         text=text,
-        reply_markup=main_menu_for_user(user_id),
+        reply_markup=MENU_MARKUPS[layout],
     )
-    set_last_menu(user_id, user_id, m.message_id)
+    await set_last_menu_async(user_id, user_id, m.message_id)
 
 
 async def send_block_notice(bot, user_id: int):
@@ -169,21 +192,49 @@ async def send_block_notice(bot, user_id: int):
     await bot.send_message(chat_id=user_id, text="⛔ Доступ заблокирован.")
 
 
+async def push_menu(bot, user_id: int):
+    """Свежее меню пользователю (или уведомление о блокировке) — после смены доступа."""
+    a = await get_access_async(user_id)
+    if a.get("is_blocked"):
+        await send_block_notice(bot, user_id)
+    else:
+        await send_fresh_menu(bot, user_id, MENU_TEXT)
+
+
+async def _edit_menu_message(
+    context: ContextTypes.DEFAULT_TYPE, query, user_id: int, text: str, markup: InlineKeyboardMarkup,
+    a: Optional[Dict[str, Any]] = None,
+):
+    msg = query.message
+    chat_id = msg.chat_id
+    if _shows(msg, text, markup):
+        # сообщение уже показывает то же самое — запрос к Telegram не нужен
+        MENU_EDITS_SKIPPED.inc()
+    else:
+        try:
+            await msg.edit_text(text, reply_markup=markup)
+        except Exception as e:
+            # "message is not modified" — содержимое и так нужное, это успех;
+            # дорогой путь (удалить + отправить заново) — только при настоящей ошибке
+            if not _not_modified(e):
+                await send_fresh_menu(context.bot, user_id, MENU_TEXT)
+                return
+    # запись в БД — только если меню переехало в другое сообщение
+    if a is None:
+        a = await get_access_async(user_id)
+    if (a.get("last_menu_chat_id"), a.get("last_menu_message_id")) != (chat_id, msg.message_id):
+        await set_last_menu_async(user_id, chat_id, msg.message_id)
+
+
 async def edit_to_menu(context: ContextTypes.DEFAULT_TYPE, query, user_id: int):
-    try:
-        await query.message.edit_text(MENU_TEXT, reply_markup=main_menu_for_user(user_id))
-        set_last_menu(user_id, user_id, query.message.message_id)
-    except Exception:
-        await send_fresh_menu(context.bot, user_id, MENU_TEXT)
+    a = await get_access_async(user_id)
+    layout = menu_layout(a)
+    await _edit_menu_message(context, query, user_id, MENU_TEXT, MENU_MARKUPS[layout], a)
 
 
 async def edit_to_tab(context: ContextTypes.DEFAULT_TYPE, query, user_id: int, tab_key: str):
     text = TAB_TEXT.get(tab_key, "Раздел в разработке.")
-    try:
-        await query.message.edit_text(text, reply_markup=tab_kb())
-        set_last_menu(user_id, user_id, query.message.message_id)
-    except Exception:
-        await send_fresh_menu(context.bot, user_id, MENU_TEXT)
+    await _edit_menu_message(context, query, user_id, text, TAB_KB)
 
 
 # =========================
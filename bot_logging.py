@@ -2,9 +2,10 @@
 import os
 from datetime import datetime
 
-import requests
 from telegram import Update
 
+from log_forwarder import enqueue_log
+
 # Эти переменные инициализируются через init_env()
 BOT_TOKEN = ""
 LOG_GROUP_ID = 0
@@ -18,7 +19,7 @@ def init_env():
 
 def send_log_http(text: str):
     """
-    Надёжная отправка в группу через Telegram HTTP API.
+    Отправка в группу через фоновую очередь (log_forwarder).
     Пишет ошибку в Railway Logs, если что-то не так.
     """
     if not BOT_TOKEN:
@@ -28,16 +29,9 @@ def send_log_http(text: str):
         print("LOG ERROR: LOG_GROUP_ID empty/0")
         return
 
-    try:
-        r = requests.post(
-            f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage",
-            json={"chat_id": LOG_GROUP_ID, "text": text},
-            timeout=12,
-        )
-        if not r.ok:
-            print("LOG ERROR:", r.status_code, r.text)
-    except Exception as e:
-        print("LOG ERROR: requests exception:", e)
+    ok, info = enqueue_log(text, LOG_GROUP_ID)
+    if not ok:
+        print("LOG ERROR:", info)
 
 
 def build_start_log(update: Update) -> str:
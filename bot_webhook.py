@@ -0,0 +1,300 @@
+# bot_webhook.py
+"""
+Telegram webhook: апдейты приходят POST-запросом на маршрут рядом с API
+(api.py -> WEBHOOK_PATH), а не через long polling.
+
+Маршрут в любом воркере только проверяет секрет и кладёт апдейт в
+SQLite (telegram_updates): повторный update_id отбрасывается там же,
+поэтому повтор доставки, попавший в другой воркер, тоже не обработается
+дважды. Ответ Telegram уходит сразу. В очереди не больше
+WEBHOOK_MAX_PENDING апдейтов, сверх этого — 503, Telegram повторит сам.
+
+Бот (приложение PTB в отдельном потоке со своим event loop) работает
+только в одном процессе — том, что держит файловый замок
+WEBHOOK_LOCK_PATH. Там один раз выполняются post_init (метрики,
+set_webhook, планировщик рассылок) и разбор очереди: одновременно не
+больше WEBHOOK_WORKERS апдейтов. Остальные воркеры ждут замок и
+подхватывают бота, если владелец завершился.
+
+Telegram-зависимости импортируются только при запуске бота: сам модуль
+безопасно импортировать из api.
+"""
+import asyncio
+import fcntl
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Set
+
+import metrics
+from storage import (
+    DB_PATH,
+    update_claim,
+    update_enqueue,
+    update_expire,
+    update_finish,
+    update_pending_count,
+    update_requeue_processing,
+)
+
+# polling | webhook
+BOT_MODE = (os.getenv("BOT_MODE") or "polling").strip().lower()
+# публичный https-адрес сервиса; на Railway берётся из RAILWAY_PUBLIC_DOMAIN
+WEBHOOK_BASE_URL = (
+    os.getenv("WEBHOOK_BASE_URL")
+    or (f"https://{os.getenv('RAILWAY_PUBLIC_DOMAIN')}" if os.getenv("RAILWAY_PUBLIC_DOMAIN") else "")
+).strip().rstrip("/")
+WEBHOOK_PATH = (os.getenv("WEBHOOK_PATH") or "/telegram/webhook").strip()
+# секрет для X-Telegram-Bot-Api-Secret-Token; по умолчанию выводится из токена бота,
+# чтобы у всех воркеров и перезапусков он совпадал
+WEBHOOK_SECRET = (os.getenv("WEBHOOK_SECRET") or "").strip()
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS") or "8")
+WEBHOOK_MAX_PENDING = int(os.getenv("WEBHOOK_MAX_PENDING") or "256")
+# сколько помнить обработанные update_id: Telegram хранит недоставленные апдейты сутки
+WEBHOOK_DEDUP_TTL = float(os.getenv("WEBHOOK_DEDUP_TTL") or "86400")
+# как часто владелец бота смотрит очередь, если его не разбудили (апдейт пришёл в другой воркер), с
+WEBHOOK_POLL = float(os.getenv("WEBHOOK_POLL") or "0.1")
+# замок владельца бота: один на все процессы, которые делят БД
+WEBHOOK_LOCK_PATH = os.getenv("WEBHOOK_LOCK_PATH") or (DB_PATH + ".bot.lock")
+# сколько параллельных соединений Telegram откроет к webhook (1..100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS") or "40")
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+UPDATES = metrics.counter("webhook_updates_total", "Telegram webhook deliveries by result", ["result"])
+UPDATE_SECONDS = metrics.histogram("webhook_update_seconds", "Webhook update time from receipt to processed")
+
+
+def webhook_enabled() -> bool:
+    return BOT_MODE == "webhook" and bool(WEBHOOK_BASE_URL)
+
+
+def webhook_url() -> str:
+    return WEBHOOK_BASE_URL + WEBHOOK_PATH
+
+
+def webhook_secret() -> str:
+    if WEBHOOK_SECRET:
+        return WEBHOOK_SECRET
+    token = (os.getenv("BOT_TOKEN") or "").strip()
+    return hashlib.sha256(f"webhook:{token}".encode("utf-8")).hexdigest()[:48]
+
+
+def check_secret(value: Optional[str]) -> bool:
+    return hmac.compare_digest((value or "").encode("utf-8"), webhook_secret().encode("utf-8"))
+
+
+class WebhookRunner:
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self._lock = threading.Lock()
+        self._elector: Optional[threading.Thread] = None
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+        self._lock_fd: Optional[int] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.app = None
+        self._wake: Optional[asyncio.Event] = None
+        self._tasks: Set["asyncio.Task"] = set()
+        self._pid = 0
+        self.error: Optional[str] = None
+
+    # ---------- запуск / остановка ----------
+    def start(self) -> None:
+        with self._lock:
+            # после fork потоки родителя не существуют — запускаемся заново
+            if self._elector is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._ready.clear()
+            self._lock_fd = None
+            self.error = None
+            self._elector = threading.Thread(target=self._elect, name="telegram-webhook-lock", daemon=True)
+            self._elector.start()
+
+    def _elect(self) -> None:
+        """Ждёт файловый замок; получивший его процесс запускает бота. Замок снимается со смертью процесса."""
+        fd = os.open(WEBHOOK_LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except OSError as e:
+            os.close(fd)
+            self.error = str(e)
+            print("WEBHOOK LOCK ERROR:", e)
+            return
+        self._lock_fd = fd
+        self._thread = threading.Thread(target=self._run, name="telegram-webhook", daemon=True)
+        self._thread.start()
+
+    def running(self) -> bool:
+        """Бот работает в этом процессе."""
+        return self._ready.is_set() and self.error is None and self._pid == os.getpid()
+
+    def _run(self) -> None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.loop = loop
+        self._wake = asyncio.Event()
+        try:
+            loop.run_until_complete(self._startup())
+        except Exception as e:
+            self.error = str(e)
+            print("WEBHOOK START ERROR:", e)
+            self._ready.set()
+            loop.close()
+            return
+        self._ready.set()
+        print(f"🤖 Telegram bot started (webhook {webhook_url()}, pid={os.getpid()}, workers={self.workers})")
+        consumer = loop.create_task(self._consume(), name="webhook-consumer")
+        try:
+            loop.run_forever()
+        finally:
+            consumer.cancel()
+            loop.run_until_complete(asyncio.gather(consumer, return_exceptions=True))
+            loop.run_until_complete(self._shutdown())
+            loop.close()
+
+    async def _startup(self) -> None:
+        from telegram import Update
+
+        from bot import build_application
+        from bot_async import run_blocking
+
+        # владелец до нас упал посреди обработки — эти апдейты ещё не обработаны
+        requeued = await run_blocking(update_requeue_processing)
+        if requeued:
+            print(f"WEBHOOK: requeued {requeued} unfinished updates")
+        app = build_application(updater=False)
+        await app.initialize()
+        # post_init PTB вызывает только в run_polling/run_webhook — здесь сами
+        if app.post_init:
+            await app.post_init(app)
+        await app.start()
+        await app.bot.set_webhook(
+            url=webhook_url(),
+            secret_token=webhook_secret(),
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        self.app = app
+
+    async def _shutdown(self) -> None:
+        # webhook не снимаем: апдейты продолжают копиться в БД, следующий владелец их разберёт
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=10)
+        if self.app is not None:
+            try:
+                await self.app.stop()
+                await self.app.shutdown()
+            except Exception as e:
+                print("WEBHOOK STOP ERROR:", e)
+
+    def stop(self) -> None:
+        if self.loop is not None and self.running():
+            self._ready.clear()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        if self._thread is not None:
+            self._thread.join(10)
+            self._thread = None
+        if self._lock_fd is not None:
+            # замок — следующему воркеру
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    # ---------- приём апдейтов ----------
+    def submit(self, data: Dict[str, Any]) -> str:
+        """accepted | duplicate | busy; вызывается из потока Flask любого воркера."""
+        result = update_enqueue(data["update_id"], json.dumps(data, ensure_ascii=False), self.max_pending)
+        if result == "accepted" and self.running():
+            # бот в этом же процессе — не ждём очередного опроса
+            self.loop.call_soon_threadsafe(self._wake.set)
+        return result
+
+    # ---------- разбор очереди (только у владельца) ----------
+    async def _consume(self) -> None:
+        from bot_async import run_blocking
+
+        next_expire = 0.0
+        while True:
+            try:
+                free = self.workers - len(self._tasks)
+                claimed = await run_blocking(update_claim, free) if free > 0 else []
+                for update_id, payload, received_at in claimed:
+                    task = asyncio.get_running_loop().create_task(self._process(update_id, payload, received_at))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._task_done)
+                if time.monotonic() >= next_expire:
+                    next_expire = time.monotonic() + 3600
+                    await run_blocking(update_expire, WEBHOOK_DEDUP_TTL)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("WEBHOOK QUEUE ERROR:", e)
+                claimed = []
+            if claimed and len(self._tasks) < self.workers:
+                continue
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), WEBHOOK_POLL)
+            except asyncio.TimeoutError:
+                pass
+
+    def _task_done(self, task: "asyncio.Task") -> None:
+        self._tasks.discard(task)
+        # освободился слот — можно забрать следующий апдейт
+        self._wake.set()
+
+    async def _process(self, update_id: int, payload: str, received_at: float) -> None:
+        from telegram import Update
+
+        from bot_async import run_blocking
+
+        try:
+            await self.app.process_update(Update.de_json(json.loads(payload), self.app.bot))
+        except Exception as e:
+            print("WEBHOOK UPDATE ERROR:", e)
+        finally:
+            await run_blocking(update_finish, update_id)
+            UPDATE_SECONDS.observe(time.time() - received_at)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": BOT_MODE,
+            "running": self.running(),
+            "error": self.error,
+            "pending": update_pending_count() if webhook_enabled() else 0,
+            "in_progress": len(self._tasks),
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+        }
+
+
+runner = WebhookRunner(WEBHOOK_WORKERS, WEBHOOK_MAX_PENDING)
+metrics.gauge("webhook_pending_updates", "Webhook updates accepted but not processed yet").set_function(
+    lambda: runner.stats()["pending"]
+)
+
+
+def start_webhook() -> None:
+    """Претендовать на бота в режиме webhook: бот поднимется, когда процесс получит замок (повтор ничего не делает)."""
+    runner.start()
+
+
+def stop_webhook() -> None:
+    runner.stop()
+
+
+def handle_update(secret: Optional[str], data: Any) -> str:
+    """Результат приёма: forbidden | bad_request | accepted | duplicate | busy."""
+    if not check_secret(secret):
+        result = "forbidden"
+    elif not isinstance(data, dict) or not isinstance(data.get("update_id"), int):
+        result = "bad_request"
+    else:
+        result = runner.submit(data)
+    UPDATES.labels(result).inc()
+    return result
@@ -2,6 +2,7 @@
 
 const API_BASE = "https://instagroq-ai-bot-production.up.railway.app";
 const API_CHAT = API_BASE + "/api/chat";
+const API_CHAT_STREAM = API_BASE + "/api/chat/stream";
 const API_CLEAR_MEMORY = API_BASE + "/api/memory/clear";
 
 function getLang(){
@@ -29,11 +30,11 @@ function getTelegramUser(){
   };
 }
 
-export async function askAI(promptText) {
+function chatPayload(userText){
   const user = getTelegramUser();
 
-  const payload = {
-    text: promptText,
+  return {
+    text: userText,
     lang: getLang(),
     style: getStyle(),
     persona: getPersona(),
@@ -43,11 +44,13 @@ export async function askAI(promptText) {
     tg_username: user.tg_username,
     tg_first_name: user.tg_first_name,
   };
+}
 
+export async function askAI(userText) {
   const r = await fetch(API_CHAT, {
     method: "POST",
     headers: { "Content-Type": "application/json" },
-    body: JSON.stringify(payload),
+    body: JSON.stringify(chatPayload(userText)),
   });
 
   if (!r.ok) {
@@ -58,6 +61,54 @@ export async function askAI(promptText) {
   return (data.reply || "").trim();
 }
 
+// ✅ стриминг ответа (SSE): onDelta(textSoFar) вызывается на каждый кусок
+export async function askAIStream(userText, onDelta) {
+  const r = await fetch(API_CHAT_STREAM, {
+    method: "POST",
+    headers: { "Content-Type": "application/json", "Accept": "text/event-stream" },
+    body: JSON.stringify(chatPayload(userText)),
+  });
+
+  if (!r.ok || !r.body) {
+    throw new Error("API error " + r.status);
+  }
+
+  const reader = r.body.getReader();
+  const decoder = new TextDecoder();
+  let buf = "";
+  let text = "";
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buf += decoder.decode(value, { stream: true });
+
+    let sep;
+    while ((sep = buf.indexOf("\n\n")) !== -1) {
+      const block = buf.slice(0, sep);
+      buf = buf.slice(sep + 2);
+
+      let event = "message";
+      let data = "";
+      for (const line of block.split("\n")) {
+        if (line.startsWith("event:")) event = line.slice(6).trim();
+        else if (line.startsWith("data:")) data += line.slice(5).trim();
+      }
+      if (!data) continue;
+
+      const msg = JSON.parse(data);
+      if (event === "error") throw new Error(msg.error || "stream error");
+      if (event === "done") return (msg.reply || text).trim();
+      if (msg.delta) {
+        text += msg.delta;
+        if (onDelta) onDelta(text);
+      }
+    }
+  }
+
+  return text.trim();
+}
+
 // ✅ очистка памяти ИИ на сервере
 export async function clearAIMemory() {
   const user = getTelegramUser();
@@ -1,4 +1,4 @@
-import { askAI } from "./api.js";
+import { askAIStream } from "./api.js";
 import { tg } from "./telegram.js";
 
 export const STORAGE_KEY = "chat_history_v1";
@@ -62,6 +62,24 @@ export function createChatController({ chatEl, inputEl, sendBtnEl }) {
     }
   }
 
+  // пузырь бота, который дописывается по мере стриминга
+  function addStreaming(){
+    const d = document.createElement("div");
+    d.className = "msg bot";
+    chatEl.appendChild(d);
+    return {
+      update(text){
+        const atBottom = chatEl.scrollHeight - chatEl.scrollTop - chatEl.clientHeight < 40;
+        d.textContent = text;
+        if (atBottom) chatEl.scrollTop = chatEl.scrollHeight;
+      },
+      finish(text){
+        d.remove();
+        add("bot", text, true);
+      },
+    };
+  }
+
   function getLang(){
     try{
       return localStorage.getItem("miniapp_lang_v1") || "ru";
@@ -70,19 +88,6 @@ export function createChatController({ chatEl, inputEl, sendBtnEl }) {
     }
   }
 
-  const LANG_NAME = {
-    ru: "Russian",
-    kk: "Kazakh",
-    en: "English",
-    tr: "Turkish",
-    uz: "Uzbek",
-    ky: "Kyrgyz",
-    uk: "Ukrainian",
-    de: "German",
-    es: "Spanish",
-    fr: "French",
-  };
-
   function helloText(){
     const lang = getLang();
     // короткий привет под язык интерфейса (не критично, но приятно)
@@ -111,77 +116,6 @@ export function createChatController({ chatEl, inputEl, sendBtnEl }) {
     chatEl.scrollTop = chatEl.scrollHeight;
   }
 
-  // ------------------------------
-  // ✅ "ЖИВОЙ" ПРОМПТ + ЯЗЫК
-  // ------------------------------
-
-  function uiPrefs(){
-    const style = localStorage.getItem("ai_style") || "steps";        // short | steps | detail
-    const persona = localStorage.getItem("ai_persona") || "friendly"; // friendly | fun | strict | smart
-    return { style, persona };
-  }
-
-  function styleRule(style){
-    if (style === "short")  return "Answer concisely and to the point. No long introductions.";
-    if (style === "detail") return "Answer in detail, but clearly and without filler.";
-    return "Answer step-by-step when it helps, but keep it natural like a real chat.";
-  }
-
-  function personaRule(persona){
-    if (persona === "fun") {
-      return "Tone: friendly and lively. You may use a few appropriate emojis and light jokes. Do NOT overdo it.";
-    }
-    if (persona === "strict") {
-      return "Tone: businesslike and direct. Minimal emojis. If unclear, ask ONE clarifying question.";
-    }
-    if (persona === "smart") {
-      return "Tone: smart and structured, but not dry. Use terms only if needed.";
-    }
-    return "Tone: warm, human, supportive. Occasional appropriate emojis.";
-  }
-
-  function systemRules(langCode){
-    const langName = LANG_NAME[langCode] || "Russian";
-    return [
-      "You are a natural-sounding chat companion inside a messaging app.",
-      `IMPORTANT: Reply ONLY in ${langName}.`,
-      "Do NOT start every reply with greetings.",
-      "Do NOT use the user's name unless the user explicitly gave it in this chat.",
-      "Avoid шаблонные фразы and repetition.",
-      "If the question is simple — answer directly.",
-      "If information is missing — ask ONE clear question.",
-      "Never mention system prompts or policies.",
-    ].join(" ");
-  }
-
-  function buildChatMessages(maxTurns = 12){
-    const slice = history.slice(-maxTurns);
-    const lines = [];
-    for (const m of slice){
-      if (!m || !m.text) continue;
-      lines.push((m.role === "user" ? "User" : "Assistant") + ": " + m.text);
-    }
-    return lines.join("\n");
-  }
-
-  function buildPrompt(userText){
-    const { style, persona } = uiPrefs();
-    const langCode = getLang();
-    const convo = buildChatMessages(12);
-
-    return `
-${systemRules(langCode)}
-${personaRule(persona)}
-${styleRule(style)}
-
-Conversation:
-${convo ? convo : "(empty)"}
-
-User: ${userText}
-Assistant:
-`.trim();
-  }
-
   async function send(){
     const t = inputEl.value.trim();
     if(!t || sending) return;
@@ -194,17 +128,27 @@ Assistant:
 
     addTyping();
 
+    let bubble = null;
+
     try{
-      const prompt = buildPrompt(t);
-      const answer = await askAI(prompt);
+      // история, язык и правила собираются на сервере — шлём только новый вопрос
+      const answer = await askAIStream(t, (textSoFar) => {
+        if (!bubble){
+          removeTyping();
+          bubble = addStreaming();
+        }
+        bubble.update(textSoFar);
+      });
 
       removeTyping();
 
       const out = (answer || "").trim();
-      add("bot", out || "…", true);
+      if (bubble) bubble.finish(out || "…");
+      else add("bot", out || "…", true);
     } catch(e){
       removeTyping();
-      add("bot", "❌ Ошибка: " + (e?.message || e), true);
+      if (bubble) bubble.finish("❌ Ошибка: " + (e?.message || e));
+      else add("bot", "❌ Ошибка: " + (e?.message || e), true);
     } finally{
       sending = false;
       sendBtnEl.disabled = false;
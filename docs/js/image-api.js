@@ -1,7 +1,33 @@
 // docs/js/image-api.js
 
 const API_BASE = "https://instagroq-ai-bot-production.up.railway.app";
-const API_IMAGE = API_BASE + "/api/image";
+const API_IMAGE_JOBS = API_BASE + "/api/image/jobs";
+
+const POLL_INTERVAL_MS = 1500;
+const POLL_TIMEOUT_MS = 180000;
+
+function sleep(ms){
+  return new Promise((resolve) => setTimeout(resolve, ms));
+}
+
+// ждём результат задачи: опрашиваем статус, пока не done/error
+// (статус отдаётся только владельцу задачи — передаём tg_user_id)
+async function waitForJob(jobId, tgUserId){
+  const started = Date.now();
+  const query = new URLSearchParams({ tg_user_id: tgUserId || "" });
+  while (Date.now() - started < POLL_TIMEOUT_MS) {
+    await sleep(POLL_INTERVAL_MS);
+
+    const r = await fetch(`${API_IMAGE_JOBS}/${jobId}?${query}`);
+    if (!r.ok) throw new Error(`API error ${r.status}`);
+
+    const job = await r.json();
+    if (job.status === "done" || job.status === "error") {
+      return job.result || { error: "generation_failed" };
+    }
+  }
+  throw new Error("generation_timeout");
+}
 
 function getTelegramUser(){
   const tg = window.Telegram?.WebApp;
@@ -51,7 +77,8 @@ export async function generateImage({ prompt, mode, file }) {
   }
   
   try {
-    const r = await fetch(API_IMAGE, {
+    // Ставим задачу в очередь — сервер отвечает сразу, результат забираем опросом
+    const r = await fetch(API_IMAGE_JOBS, {
       method: "POST",
       body: form,
       // Не устанавливаем Content-Type вручную - браузер сам установит с boundary
@@ -70,7 +97,8 @@ export async function generateImage({ prompt, mode, file }) {
       }
     }
     
-    const data = await r.json();
+    const job = await r.json();
+    const data = await waitForJob(job.job_id, user.tg_user_id);
     
     // Проверяем успешность ответа
     if (data.error) {
@@ -99,6 +127,10 @@ export async function generateImage({ prompt, mode, file }) {
       throw new Error("Выберите изображение для этого режима.");
     } else if (errorMsg.includes("generation_timeout")) {
       throw new Error("Таймаут генерации. Попробуйте позже.");
+    } else if (errorMsg.includes("too_many_jobs") || errorMsg.includes("queue_full") || errorMsg.includes("upstream_busy")) {
+      throw new Error("Сейчас много генераций. Подождите немного и попробуйте снова.");
+    } else if (errorMsg.includes("rate_limited")) {
+      throw new Error("Слишком часто. Подождите минуту и попробуйте снова.");
     } else if (errorMsg.includes("invalid_api_key")) {
       throw new Error("Ошибка сервиса генерации. Сообщите администратору.");
     } else {
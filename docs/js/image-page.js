@@ -266,8 +266,11 @@ if (genBtn) {
       
       console.log("Generation successful:", result);
       
-      if (resultImg && result.image_base64) {
-        resultImg.src = result.image_base64;
+      // показываем лёгкую версию (WebP/AVIF), оригинал PNG — по тапу
+      const src = result.display_url || result.url || result.image_base64;
+      if (resultImg && src) {
+        resultImg.src = src;
+        resultImg.onclick = result.url ? () => window.open(result.url, "_blank") : null;
         resultImg.onload = () => {
           if (outEl) outEl.classList.remove("hidden");
           if (loadingEl) loadingEl.classList.add("hidden");
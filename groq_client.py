@@ -1,13 +1,14 @@
-import os
-from typing import Optional
+import itertools
+import time
+from contextlib import ExitStack
+from typing import Any, Callable, Dict, Iterator, List, Optional
 
-from groq import Groq
+import metrics
+from groq_router import GROQ_MODELS, Endpoint, HedgeCancelled, classify, router
 
 # ---------- ENV ----------
-GROQ_API_KEY = (os.getenv("GROQ_API_KEY") or "").strip()
-GROQ_MODEL = (os.getenv("GROQ_MODEL") or "llama-3.1-8b-instant").strip()
-
-groq_client = Groq(api_key=GROQ_API_KEY) if GROQ_API_KEY else None
+# ключи и модели (GROQ_API_KEYS / GROQ_MODELS) разбирает groq_router; первая модель — основная
+GROQ_MODEL = GROQ_MODELS[0]
 
 
 # ---------- Language / Style / Persona ----------
@@ -66,43 +67,199 @@ def build_system_prompt(lang: str, style: str, persona: str) -> str:
     )
 
 
-# ---------- MAIN AI FUNCTION ----------
-def ask_groq(
+# ---------- MESSAGES ----------
+def build_messages(
+    history: Optional[List[Dict[str, str]]],
     user_text: str,
     *,
     lang: str = "ru",
     style: str = "steps",
     persona: str = "friendly",
-) -> str:
-    if not groq_client:
-        raise RuntimeError("GROQ_API_KEY is not set")
+    summary: Optional[str] = None,
+) -> List[Dict[str, str]]:
+    """
+    system, затем ходы user/assistant по очереди, в конце — новый вопрос.
+    Системный промпт идёт первым и не зависит от истории — стабильный префикс.
+    """
+    messages = [{"role": "system", "content": build_system_prompt(lang, style, persona)}]
+    if summary:
+        messages.append({"role": "system", "content": summary})
+
+    turns: List[Dict[str, str]] = []
+    for m in (history or []) + [{"role": "user", "text": user_text}]:
+        role = "user" if m.get("role") == "user" else "assistant"
+        text = (m.get("text") or "").strip()
+        if not text:
+            continue
+        if turns and turns[-1]["role"] == role:
+            # две реплики одной стороны подряд (например, ответ не сохранился) — склеиваем
+            turns[-1]["content"] += "\n\n" + text
+        else:
+            turns.append({"role": role, "content": text})
+
+    # диалог должен начинаться с пользователя
+    while turns and turns[0]["role"] != "user":
+        turns.pop(0)
+
+    return messages + turns
+
+
+# ---------- METRICS ----------
+GROQ_SECONDS = metrics.histogram(
+    "groq_request_seconds", "Groq chat completion latency (stream: until the last chunk)", ["model", "kind", "outcome"]
+)
+GROQ_FIRST_TOKEN_SECONDS = metrics.histogram(
+    "groq_first_token_seconds", "Groq streaming time to first content chunk", ["model"]
+)
+
+
+def _observe(model: str, kind: str, outcome: str, t0: float) -> None:
+    GROQ_SECONDS.labels(model, kind, outcome).observe(time.perf_counter() - t0)
 
-    system_prompt = build_system_prompt(lang, style, persona)
 
+# ---------- MAIN AI FUNCTION ----------
+def _completion_kwargs(model: str, messages: List[Dict[str, str]], *, legacy: bool = False) -> dict:
+    kwargs = dict(
+        model=model,
+        messages=messages,
+        temperature=0.95,
+        top_p=0.9,
+        max_tokens=600,
+    )
+    if not legacy:
+        kwargs.update(frequency_penalty=0.35, presence_penalty=0.25)
+    return kwargs
+
+
+def _send(create: Callable[..., Any], ep: Endpoint, messages: List[Dict[str, str]], extra: dict):
     try:
-        resp = groq_client.chat.completions.create(
-            model=GROQ_MODEL,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_text},
-            ],
-            temperature=0.95,
-            top_p=0.9,
-            frequency_penalty=0.35,
-            presence_penalty=0.25,
-            max_tokens=600,
-        )
+        return create(**extra, **_completion_kwargs(ep.model, messages))
     except TypeError:
         # fallback for older SDK
-        resp = groq_client.chat.completions.create(
-            model=GROQ_MODEL,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_text},
-            ],
-            temperature=0.95,
-            top_p=0.9,
-            max_tokens=600,
+        return create(**extra, **_completion_kwargs(ep.model, messages, legacy=True))
+
+
+def _create(ep: Endpoint, kind: str, messages: List[Dict[str, str]], **extra):
+    """Запрос к точке с адаптивным таймаутом и разбором заголовков лимитов."""
+    completions = router.client(ep).chat.completions
+    extra["timeout"] = router.timeout(ep.model, kind)
+    if extra.get("stream"):
+        raw = _send(completions.with_raw_response.create, ep, messages, extra)
+        router.on_headers(ep, raw.headers)
+        return raw.parse()
+
+    # тело читаем только после заголовков: проигравший дубль закрывает ответ, не дочитав
+    with ExitStack() as stack:
+        raw = _send(
+            lambda **kw: stack.enter_context(completions.with_streaming_response.create(**kw)), ep, messages, extra
         )
+        router.on_headers(ep, raw.headers)
+        if router.attempt_cancelled():
+            raise HedgeCancelled()
+        return raw.parse()
+
+
+def _resolve_messages(
+    user_text: str,
+    messages: Optional[List[Dict[str, str]]],
+    lang: str,
+    style: str,
+    persona: str,
+) -> List[Dict[str, str]]:
+    if messages:
+        return messages
+    return build_messages(None, user_text, lang=lang, style=style, persona=persona)
 
-    return (resp.choices[0].message.content or "").strip()
\ No newline at end of file
+
+def ask_groq(
+    user_text: str = "",
+    *,
+    messages: Optional[List[Dict[str, str]]] = None,
+    lang: str = "ru",
+    style: str = "steps",
+    persona: str = "friendly",
+) -> str:
+    """
+    messages — готовый список (см. build_messages); иначе один вопрос user_text.
+    Точку (ключ, модель) и таймаут выбирает groq_router; UpstreamBusy — все точки недоступны.
+    """
+    if router is None:
+        raise RuntimeError("GROQ_API_KEY is not set")
+
+    messages = _resolve_messages(user_text, messages, lang, style, persona)
+
+    def call(ep: Endpoint):
+        t0 = time.perf_counter()
+        try:
+            resp = _create(ep, "complete", messages)
+        except HedgeCancelled:
+            _observe(ep.model, "complete", "cancelled", t0)
+            raise
+        except Exception:
+            _observe(ep.model, "complete", "error", t0)
+            raise
+        router.on_success(ep, "complete", time.perf_counter() - t0)
+        _observe(ep.model, "complete", "ok", t0)
+        return resp
+
+    # медленную попытку может подстраховать дубль на другой точке (GROQ_HEDGE)
+    resp, _ = router.run_hedged("complete", call)
+    return (resp.choices[0].message.content or "").strip()
+
+
+def ask_groq_stream(
+    user_text: str = "",
+    *,
+    messages: Optional[List[Dict[str, str]]] = None,
+    lang: str = "ru",
+    style: str = "steps",
+    persona: str = "friendly",
+) -> Iterator[str]:
+    """То же, что ask_groq, но отдаёт ответ кусками по мере генерации."""
+    if router is None:
+        raise RuntimeError("GROQ_API_KEY is not set")
+
+    messages = _resolve_messages(user_text, messages, lang, style, persona)
+    t0 = time.perf_counter()
+
+    def call(ep: Endpoint):
+        # первый кусок читаем здесь: до него ошибку можно перенести на другую точку
+        t_ep = time.perf_counter()
+        try:
+            chunks = iter(_create(ep, "stream", messages, stream=True))
+            first_chunk = next(chunks, None)
+        except Exception:
+            _observe(ep.model, "stream", "error", t_ep)
+            raise
+        router.on_success(ep, "stream", time.perf_counter() - t_ep, final=False)
+        return first_chunk, chunks
+
+    (first_chunk, chunks), ep = router.run("stream", call)
+
+    first = True
+    outcome = "error"
+    try:
+        for chunk in itertools.chain([first_chunk] if first_chunk is not None else [], chunks):
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if first:
+                    first = False
+                    GROQ_FIRST_TOKEN_SECONDS.labels(ep.model).observe(time.perf_counter() - t0)
+                yield delta
+        outcome = "ok"
+        router.on_stream_end(ep, completed=True)
+    except GeneratorExit:
+        # клиент ушёл, не дочитав
+        outcome = "cancelled"
+        router.on_stream_end(ep, completed=False)
+        raise
+    except Exception as e:
+        # обрыв посреди ответа: перенести уже нельзя, но точка должна за него отвечать,
+        # иначе ключ/модель, которые рвут стримы, так и остаются «здоровыми»
+        failure, _, retry_after = classify(e)
+        router.on_failure(ep, failure, retry_after, mid_stream=True)
+        raise
+    finally:
+        _observe(ep.model, "stream", outcome, t0)
@@ -0,0 +1,606 @@
+# groq_router.py
+"""
+Маршрутизатор запросов к Groq по пулу конечных точек (ключ, модель).
+
+Для каждой точки держим скользящее среднее (EWMA) задержки и доли
+ошибок, число запросов в полёте и остатки лимитов из заголовков
+x-ratelimit-* (их читаем через with_raw_response). Запрос уходит на
+точку с лучшей оценкой; модели ниже первой в GROQ_MODELS получают штраф,
+поэтому запасная модель выбирается, только когда основная медленная,
+в ошибках или упёрлась в лимит.
+
+Серия 429/5xx/таймаутов подряд размыкает цепь: точка не используется
+GROQ_BREAKER_COOLDOWN секунд, потом пропускает один пробный запрос
+(half-open) — успех замыкает цепь, неудача размыкает её снова с
+удвоенной паузой. Ошибка, которую стоит повторить, сразу переносится на
+следующую точку (не больше GROQ_MAX_ATTEMPTS попыток); у стрима —
+только до первого куска ответа, а обрыв позже не переносится, но
+засчитывается точке как ошибка. Свои повторы SDK выключены, чтобы не
+ждать бэкофф на ключе, который уже упёрся в лимит.
+
+Таймаут попытки — адаптивный, по модели: GROQ_TIMEOUT_FACTOR × p99
+последних GROQ_LATENCY_WINDOW ответов (у стрима — до первого куска), в
+пределах [GROQ_TIMEOUT_MIN, GROQ_TIMEOUT_MAX]; пока замеров мало —
+GROQ_TIMEOUT_MAX. Зависший вызов не держит поток дольше этого и уходит
+на другую точку как таймаут.
+
+При GROQ_HEDGE=1 обычный (не стрим) запрос, не ответивший за p95 своей
+модели, дублируется на другую точку. Основная попытка идёт в потоке
+вызывающего, дубль — в пуле; если основная упала или оборвалась по
+таймауту, берётся ответ дубля, который к этому времени уже в пути.
+Ответ отдан — дубль отменяется: ещё не начатый не стартует, а начатый
+закрывает ответ по заголовкам, не читая тело (HedgeCancelled).
+Дубли ограничены бюджетом: GROQ_HEDGE_BUDGET дубля на запрос (по
+умолчанию 5%), с запасом не больше GROQ_HEDGE_BURST.
+"""
+import heapq
+import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+import metrics
+from rate_limit import UpstreamBusy
+
+# ключи через запятую; если не заданы — один GROQ_API_KEY
+GROQ_API_KEYS = [
+    k.strip() for k in (os.getenv("GROQ_API_KEYS") or os.getenv("GROQ_API_KEY") or "").split(",") if k.strip()
+]
+# модели в порядке предпочтения; первая — основная
+GROQ_MODELS = [
+    m.strip() for m in (os.getenv("GROQ_MODELS") or os.getenv("GROQ_MODEL") or "llama-3.1-8b-instant").split(",")
+    if m.strip()
+]
+GROQ_EWMA_ALPHA = float(os.getenv("GROQ_EWMA_ALPHA") or "0.2")
+# штраф за каждую позицию модели в списке, мс задержки
+GROQ_MODEL_PENALTY_MS = float(os.getenv("GROQ_MODEL_PENALTY_MS") or "800")
+GROQ_BREAKER_FAILURES = int(os.getenv("GROQ_BREAKER_FAILURES") or "3")
+GROQ_BREAKER_COOLDOWN = float(os.getenv("GROQ_BREAKER_COOLDOWN") or "15")
+GROQ_BREAKER_COOLDOWN_MAX = float(os.getenv("GROQ_BREAKER_COOLDOWN_MAX") or "300")
+GROQ_MAX_ATTEMPTS = int(os.getenv("GROQ_MAX_ATTEMPTS") or "3")
+# ниже этого остатка токенов по заголовкам точку не берём до сброса окна
+GROQ_MIN_REMAINING_TOKENS = int(os.getenv("GROQ_MIN_REMAINING_TOKENS") or "600")
+# адаптивный таймаут попытки, с
+GROQ_TIMEOUT_MIN = float(os.getenv("GROQ_TIMEOUT_MIN") or "5")
+GROQ_TIMEOUT_MAX = float(os.getenv("GROQ_TIMEOUT_MAX") or "60")
+GROQ_TIMEOUT_FACTOR = float(os.getenv("GROQ_TIMEOUT_FACTOR") or "3")
+GROQ_LATENCY_WINDOW = int(os.getenv("GROQ_LATENCY_WINDOW") or "200")
+# меньше замеров — перцентили не считаем (таймаут максимальный, дублей нет)
+GROQ_LATENCY_MIN_SAMPLES = int(os.getenv("GROQ_LATENCY_MIN_SAMPLES") or "20")
+# дублирование медленных запросов
+GROQ_HEDGE = (os.getenv("GROQ_HEDGE") or "0").strip() == "1"
+# дублируем только хвост: дольше p95 отвечает каждый двадцатый запрос
+GROQ_HEDGE_QUANTILE = float(os.getenv("GROQ_HEDGE_QUANTILE") or "0.95")
+GROQ_HEDGE_BUDGET = float(os.getenv("GROQ_HEDGE_BUDGET") or "0.05")
+GROQ_HEDGE_BURST = float(os.getenv("GROQ_HEDGE_BURST") or "5")
+GROQ_HEDGE_THREADS = int(os.getenv("GROQ_HEDGE_THREADS") or "32")
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+ROUTER_REQUESTS = metrics.counter(
+    "groq_router_requests_total", "Groq calls per endpoint by outcome", ["endpoint", "outcome"]
+)
+ROUTER_FAILOVERS = metrics.counter("groq_router_failovers_total", "Requests moved to another endpoint", ["reason"])
+ROUTER_UNAVAILABLE = metrics.counter("groq_router_unavailable_total", "Requests rejected: no usable endpoint")
+ROUTER_CIRCUIT_OPENS = metrics.counter("groq_router_circuit_opens_total", "Circuit breaker trips", ["endpoint"])
+ROUTER_STATE = metrics.gauge("groq_router_circuit_state", "0 closed, 1 half-open, 2 open", ["endpoint"])
+ROUTER_LATENCY = metrics.gauge("groq_router_latency_ewma_seconds", "EWMA latency per endpoint", ["endpoint", "kind"])
+ROUTER_ERROR_RATE = metrics.gauge("groq_router_error_rate_ewma", "EWMA error rate per endpoint", ["endpoint"])
+ROUTER_TIMEOUT = metrics.gauge("groq_router_timeout_seconds", "Current adaptive timeout", ["model", "kind"])
+ROUTER_HEDGES = metrics.counter(
+    "groq_router_hedges_total",
+    "Hedged requests: sent, won (hedge answered first), cancelled (hedge dropped), no_budget",
+    ["result"],
+)
+ROUTER_REMAINING = metrics.gauge(
+    "groq_router_ratelimit_remaining", "Remaining quota from x-ratelimit headers", ["endpoint", "limit"]
+)
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_duration(raw: Optional[str]) -> Optional[float]:
+    """'2m59.56s', '7.66s', '120ms', '3' -> секунды."""
+    if not raw:
+        return None
+    raw = raw.strip()
+    try:
+        return float(raw)
+    except ValueError:
+        pass
+    parts = _DURATION_RE.findall(raw)
+    if not parts:
+        return None
+    return sum(float(n) * _DURATION_UNITS[u] for n, u in parts)
+
+
+def _header_int(headers, name: str) -> Optional[int]:
+    try:
+        return int(float(headers.get(name)))
+    except (TypeError, ValueError):
+        return None
+
+
+class LatencyWindow:
+    """Последние N задержек для перцентилей (под замком роутера)."""
+
+    def __init__(self, size: int):
+        self.values: Deque[float] = deque(maxlen=max(1, size))
+
+    def add(self, seconds: float) -> None:
+        self.values.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if len(self.values) < GROQ_LATENCY_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.values)
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+class HedgeCancelled(Exception):
+    """Дубль больше не нужен: ответ уже отдан основной попыткой."""
+
+
+# попытка-дубль в потоке пула: событие «ответ уже отдан» (см. attempt_cancelled)
+_attempt = threading.local()
+
+
+class _Timers:
+    """Один поток на все отложенные дубли: куча (срок, номер, функция)."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap: List[Tuple[float, int, Callable[[], None]]] = []
+        self._seq = 0
+        self._thread: Optional[threading.Thread] = None
+
+    def schedule(self, delay: float, fn: Callable[[], None]) -> None:
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._heap, (time.monotonic() + delay, self._seq, fn))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="groq-hedge-timer", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, fn = heapq.heappop(self._heap)
+            try:
+                fn()
+            except Exception as e:
+                print(f"⚠️ groq hedge timer: {e!r}")
+
+
+class Endpoint:
+    def __init__(self, key_index: int, key: str, model: str, rank: int):
+        # имя без самого ключа: идёт в метрики и /api/stats
+        self.name = f"k{key_index}:{model}"
+        self.key_index = key_index
+        self.key = key
+        self.model = model
+        self.rank = rank
+        self.latency: Dict[str, Optional[float]] = {"complete": None, "stream": None}
+        self.error_rate = 0.0
+        self.inflight = 0
+        self.state = CLOSED
+        self.failures = 0  # подряд
+        self.timeouts = 0
+        self.open_until = 0.0
+        self.cooldown = GROQ_BREAKER_COOLDOWN
+        self.trial = False  # пробный запрос в half-open уже идёт
+        self.limited_until = 0.0  # по заголовкам лимитов / Retry-After
+        self.remaining_requests: Optional[int] = None
+        self.remaining_tokens: Optional[int] = None
+
+    def available_at(self, now: float) -> float:
+        """Когда точку можно брать (<= now — уже можно)."""
+        at = self.limited_until
+        if self.state == OPEN:
+            at = max(at, self.open_until)
+        elif self.state == HALF_OPEN and self.trial:
+            at = max(at, now + self.cooldown)
+        return at
+
+    def score(self, kind: str) -> float:
+        lat = self.latency[kind]
+        if lat is None:
+            lat = self.latency["stream" if kind == "complete" else "complete"]
+        # неизвестная точка — оптимистично 0: новые ключи быстро получают трафик и замеры
+        ms = (lat or 0.0) * 1000
+        return ms * (1 + 3 * self.error_rate) * (1 + 0.25 * self.inflight) + self.rank * GROQ_MODEL_PENALTY_MS
+
+
+class GroqRouter:
+    def __init__(self, keys: List[str], models: List[str]):
+        self.endpoints = [
+            Endpoint(ki + 1, key, model, rank)
+            for rank, model in enumerate(models)
+            for ki, key in enumerate(keys)
+        ]
+        self.models = list(models)
+        self._lock = threading.Lock()
+        self._clients: Dict[int, Any] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._timers = _Timers()
+        self.windows: Dict[Tuple[str, str], LatencyWindow] = {
+            (model, kind): LatencyWindow(GROQ_LATENCY_WINDOW) for model in models for kind in ("complete", "stream")
+        }
+        self._hedge_tokens = GROQ_HEDGE_BURST
+        self.hedges: Dict[str, int] = {"sent": 0, "won": 0, "cancelled": 0, "no_budget": 0}
+        for model, kind in self.windows:
+            ROUTER_TIMEOUT.labels(model, kind).set_function(lambda m=model, k=kind: self.timeout(m, k))
+        for ep in self.endpoints:
+            ROUTER_STATE.labels(ep.name).set_function(lambda ep=ep: _STATE_VALUE[ep.state])
+            ROUTER_ERROR_RATE.labels(ep.name).set_function(lambda ep=ep: ep.error_rate)
+            for kind in ("complete", "stream"):
+                ROUTER_LATENCY.labels(ep.name, kind).set_function(lambda ep=ep, kind=kind: ep.latency[kind] or 0.0)
+
+    # ---------- клиенты ----------
+    def client(self, ep: Endpoint):
+        c = self._clients.get(ep.key_index)
+        if c is None:
+            with self._lock:
+                c = self._clients.get(ep.key_index)
+                if c is None:
+                    from groq import Groq
+
+                    # повторы делает роутер (на другой точке), а не SDK на той же
+                    c = self._clients[ep.key_index] = Groq(api_key=ep.key, max_retries=0)
+        return c
+
+    def after_fork(self) -> None:
+        # httpx-клиенты родителя в ребёнке не используем
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._executor = None
+        self._timers = _Timers()
+        for ep in self.endpoints:
+            ep.inflight = 0
+            ep.trial = False
+
+    # ---------- выбор ----------
+    def pick(self, kind: str, exclude: Set[str], avoid: Iterable[str] = ()) -> Endpoint:
+        """avoid — точки, которые брать только если других нет (дубль идёт мимо основной попытки)."""
+        now = time.monotonic()
+        avoid = set(avoid) - exclude
+        with self._lock:
+            best: Optional[Endpoint] = None
+            soonest = None
+            for ep in self.endpoints:
+                if ep.name in exclude:
+                    continue
+                if ep.state == OPEN and ep.open_until <= now:
+                    ep.state = HALF_OPEN
+                at = ep.available_at(now)
+                if at > now:
+                    soonest = at if soonest is None else min(soonest, at)
+                    continue
+                if best is None or (ep.name in avoid, ep.score(kind)) < (best.name in avoid, best.score(kind)):
+                    best = ep
+            if best is None:
+                ROUTER_UNAVAILABLE.inc()
+                raise UpstreamBusy("groq", max(1.0, (soonest or now + 1) - now))
+            if best.state == HALF_OPEN:
+                best.trial = True
+            best.inflight += 1
+            return best
+
+    # ---------- учёт результата ----------
+    def _ewma(self, old: Optional[float], value: float) -> float:
+        return value if old is None else old + GROQ_EWMA_ALPHA * (value - old)
+
+    def on_headers(self, ep: Endpoint, headers) -> None:
+        if headers is None:
+            return
+        rr = _header_int(headers, "x-ratelimit-remaining-requests")
+        rt = _header_int(headers, "x-ratelimit-remaining-tokens")
+        now = time.monotonic()
+        with self._lock:
+            if rr is not None:
+                ep.remaining_requests = rr
+                ROUTER_REMAINING.labels(ep.name, "requests").set(rr)
+                if rr <= 0:
+                    reset = parse_duration(headers.get("x-ratelimit-reset-requests")) or 1.0
+                    ep.limited_until = max(ep.limited_until, now + reset)
+            if rt is not None:
+                ep.remaining_tokens = rt
+                ROUTER_REMAINING.labels(ep.name, "tokens").set(rt)
+                if rt < GROQ_MIN_REMAINING_TOKENS:
+                    reset = parse_duration(headers.get("x-ratelimit-reset-tokens")) or 1.0
+                    ep.limited_until = max(ep.limited_until, now + reset)
+
+    def on_success(self, ep: Endpoint, kind: str, seconds: float, final: bool = True) -> None:
+        """
+        Ответ получен за seconds. final=False — у стрима пришёл первый кусок: задержку
+        учитываем, а здоровой точку признаёт on_stream_end, когда стрим дочитан.
+        """
+        with self._lock:
+            ep.inflight = max(0, ep.inflight - 1)
+            ep.latency[kind] = self._ewma(ep.latency[kind], seconds)
+            self.windows[(ep.model, kind)].add(seconds)
+            if final:
+                self._mark_healthy(ep)
+        if final:
+            ROUTER_REQUESTS.labels(ep.name, "ok").inc()
+
+    def on_stream_end(self, ep: Endpoint, completed: bool) -> None:
+        """Стрим дочитан (completed) или брошен клиентом — тогда ни успех, ни ошибка."""
+        with self._lock:
+            if completed:
+                self._mark_healthy(ep)
+            else:
+                ep.trial = False
+        ROUTER_REQUESTS.labels(ep.name, "ok" if completed else "cancelled").inc()
+
+    def on_cancelled(self, ep: Endpoint) -> None:
+        """Попытку бросили (дубль больше не нужен): ни успех, ни ошибка."""
+        with self._lock:
+            ep.inflight = max(0, ep.inflight - 1)
+            ep.trial = False
+        ROUTER_REQUESTS.labels(ep.name, "cancelled").inc()
+
+    def _mark_healthy(self, ep: Endpoint) -> None:
+        ep.error_rate = self._ewma(ep.error_rate, 0.0)
+        ep.failures = 0
+        ep.trial = False
+        ep.state = CLOSED
+        ep.cooldown = GROQ_BREAKER_COOLDOWN
+
+    def on_failure(
+        self, ep: Endpoint, outcome: str, retry_after: Optional[float] = None, mid_stream: bool = False
+    ) -> None:
+        """
+        outcome: rate_limited | server_error | timeout | connection | endpoint_error | client_error.
+        mid_stream — стрим оборвался после первого куска: inflight уже уменьшен
+        on_success(final=False), ошибка идёт в долю ошибок и размыкатель.
+        """
+        now = time.monotonic()
+        tripped = False
+        with self._lock:
+            if not mid_stream:
+                ep.inflight = max(0, ep.inflight - 1)
+            ep.trial = False
+            if outcome == "client_error":
+                # плохой запрос — точка тут ни при чём
+                pass
+            else:
+                if outcome == "timeout":
+                    ep.timeouts += 1
+                ep.error_rate = self._ewma(ep.error_rate, 1.0)
+                ep.failures += 1
+                if retry_after:
+                    ep.limited_until = max(ep.limited_until, now + retry_after)
+                if outcome == "endpoint_error":
+                    # ключ отозван / модели нет — ждать серии незачем
+                    ep.failures = max(ep.failures, GROQ_BREAKER_FAILURES)
+                    ep.cooldown = GROQ_BREAKER_COOLDOWN_MAX
+                if ep.state == HALF_OPEN or ep.failures >= GROQ_BREAKER_FAILURES:
+                    if ep.state == HALF_OPEN:
+                        ep.cooldown = min(GROQ_BREAKER_COOLDOWN_MAX, ep.cooldown * 2)
+                    ep.state = OPEN
+                    ep.open_until = now + ep.cooldown
+                    tripped = True
+        ROUTER_REQUESTS.labels(ep.name, outcome).inc()
+        if tripped:
+            ROUTER_CIRCUIT_OPENS.labels(ep.name).inc()
+
+    # ---------- таймауты и дубли ----------
+    def timeout(self, model: str, kind: str) -> float:
+        """Таймаут попытки для модели: FACTOR × p99, в пределах [MIN, MAX]."""
+        with self._lock:
+            p99 = self.windows[(model, kind)].percentile(0.99)
+        if p99 is None:
+            return GROQ_TIMEOUT_MAX
+        return min(GROQ_TIMEOUT_MAX, max(GROQ_TIMEOUT_MIN, p99 * GROQ_TIMEOUT_FACTOR))
+
+    def hedge_delay(self, model: str) -> Optional[float]:
+        with self._lock:
+            return self.windows[(model, "complete")].percentile(GROQ_HEDGE_QUANTILE)
+
+    def _take_hedge_token(self) -> bool:
+        with self._lock:
+            if self._hedge_tokens >= 1:
+                self._hedge_tokens -= 1
+                return True
+            return False
+
+    def _earn_hedge_budget(self) -> None:
+        with self._lock:
+            self._hedge_tokens = min(GROQ_HEDGE_BURST, self._hedge_tokens + GROQ_HEDGE_BUDGET)
+
+    def _count_hedge(self, result: str) -> None:
+        with self._lock:
+            self.hedges[result] += 1
+        ROUTER_HEDGES.labels(result).inc()
+
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(GROQ_HEDGE_THREADS, thread_name_prefix="groq-hedge")
+        return self._executor
+
+    def run_hedged(self, kind: str, call: Callable[[Endpoint], Any]) -> Tuple[Any, Endpoint]:
+        """
+        Как run, но основная попытка, не ответившая за p95 модели (если есть
+        бюджет), получает дубль на другой точке. Основная идёт в потоке
+        вызывающего, дубль — в пуле. Упала основная — ждём дубль (не дольше
+        таймаута попытки); успела основная — дубль отменяется: из очереди
+        пула снимается, а начатый бросает ответ, как только call спросит
+        attempt_cancelled().
+        """
+        if not GROQ_HEDGE:
+            return self.run(kind, call)
+        self._earn_hedge_budget()
+        lock = threading.Lock()
+        picked: List[Endpoint] = []
+        hedge: List[Future] = []
+        # дубль ушёл — основная больше не переносится: её перенос — это и есть дубль
+        hedged = threading.Event()
+        # ответ отдан (или ждать уже нечего) — дубль не запускается и не переносится дальше
+        settled = threading.Event()
+
+        def fire():
+            with lock:
+                if settled.is_set():
+                    return
+                if not self._take_hedge_token():
+                    self._count_hedge("no_budget")
+                    return
+                self._count_hedge("sent")
+                hedged.set()
+                hedge.append(self.executor().submit(duplicate, [ep.name for ep in picked]))
+
+        def duplicate(avoid: List[str]):
+            if settled.is_set():
+                raise HedgeCancelled()
+            _attempt.cancel = settled
+            try:
+                return self.run(kind, call, avoid, settled)
+            except HedgeCancelled:
+                self._count_hedge("cancelled")
+                raise
+            finally:
+                _attempt.cancel = None
+
+        def tracked(ep: Endpoint):
+            with lock:
+                first = not picked
+                picked.append(ep)
+            if first:
+                delay = self.hedge_delay(ep.model)
+                if delay is not None:
+                    self._timers.schedule(delay, fire)
+            return call(ep)
+
+        try:
+            return self.run(kind, tracked, stop=hedged)
+        except Exception as primary_error:
+            with lock:
+                second = hedge[0] if hedge else None
+                if second is None:
+                    # поздний дубль после ошибки основной уже не нужен
+                    settled.set()
+            if second is None:
+                raise
+            try:
+                result = second.result(timeout=self.timeout(picked[0].model, kind))
+            except Exception:
+                # дубль тоже упал или не успел — отдаём ошибку основной
+                second.cancel()
+                raise primary_error
+            self._count_hedge("won")
+            return result
+        finally:
+            with lock:
+                settled.set()
+                # дубль ещё в очереди пула — не запускаем вовсе
+                if hedge and hedge[0].cancel():
+                    self._count_hedge("cancelled")
+
+    def attempt_cancelled(self) -> bool:
+        """Для call: эта попытка — дубль, а ответ уже отдан другой."""
+        cancel = getattr(_attempt, "cancel", None)
+        return cancel is not None and cancel.is_set()
+
+    # ---------- вызовы ----------
+    def run(
+        self, kind: str, call: Callable[[Endpoint], Any], avoid: Iterable[str] = (),
+        stop: Optional[threading.Event] = None,
+    ) -> Tuple[Any, Endpoint]:
+        """
+        Выполнить call(endpoint) с переносом на другую точку при ошибках,
+        которые стоит повторить. call сам вызывает on_success, как только
+        ответ (у стрима — первый кусок) получен; ошибки учитывает run.
+        """
+        tried: Set[str] = set()
+        attempts = min(GROQ_MAX_ATTEMPTS, len(self.endpoints))
+        while True:
+            ep = self.pick(kind, tried, avoid)
+            tried.add(ep.name)
+            try:
+                return call(ep), ep
+            except HedgeCancelled:
+                self.on_cancelled(ep)
+                raise
+            except Exception as e:
+                outcome, retriable, retry_after = classify(e)
+                self.on_failure(ep, outcome, retry_after)
+                if not retriable or len(tried) >= attempts or (stop is not None and stop.is_set()):
+                    if outcome == "rate_limited":
+                        # лимиты исчерпаны на всех опробованных точках — это "занято", а не сбой
+                        raise UpstreamBusy("groq", retry_after or 1.0) from e
+                    raise
+                ROUTER_FAILOVERS.labels(outcome).inc()
+
+    def stats(self) -> Dict[str, Any]:
+        per_model: Dict[str, Any] = {}
+        for model in self.models:
+            delay = self.hedge_delay(model)
+            per_model[model] = {
+                "timeout_s": {kind: round(self.timeout(model, kind), 2) for kind in ("complete", "stream")},
+                "hedge_after_ms": round(delay * 1000, 1) if delay is not None else None,
+            }
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "models": self.models,
+                "per_model": per_model,
+                "hedge": dict(self.hedges, enabled=GROQ_HEDGE, budget_tokens=round(self._hedge_tokens, 2)),
+                "endpoints": [
+                    {
+                        "endpoint": ep.name,
+                        "state": ep.state,
+                        "latency_ms": {k: round(v * 1000, 1) if v is not None else None for k, v in ep.latency.items()},
+                        "error_rate": round(ep.error_rate, 4),
+                        "inflight": ep.inflight,
+                        "failures": ep.failures,
+                        "timeouts": ep.timeouts,
+                        "available_in_s": round(max(0.0, ep.available_at(now) - now), 1),
+                        "remaining_requests": ep.remaining_requests,
+                        "remaining_tokens": ep.remaining_tokens,
+                    }
+                    for ep in self.endpoints
+                ],
+            }
+
+
+def classify(e: Exception) -> Tuple[str, bool, Optional[float]]:
+    """(исход, переносить ли на другую точку, Retry-After в секундах)."""
+    import groq
+
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    retry_after = parse_duration(headers.get("retry-after")) if headers is not None else None
+    if isinstance(e, groq.RateLimitError):
+        return "rate_limited", True, retry_after
+    if isinstance(e, groq.APITimeoutError):
+        return "timeout", True, None
+    if isinstance(e, groq.APIConnectionError):
+        return "connection", True, None
+    if isinstance(e, (groq.AuthenticationError, groq.PermissionDeniedError, groq.NotFoundError)):
+        return "endpoint_error", True, None
+    if isinstance(e, groq.APIStatusError):
+        if e.status_code >= 500:
+            return "server_error", True, retry_after
+        return "client_error", False, None
+    return "client_error", False, None
+
+
+def make_router() -> Optional[GroqRouter]:
+    if not GROQ_API_KEYS:
+        return None
+    return GroqRouter(GROQ_API_KEYS, GROQ_MODELS)
+
+
+router = make_router()
+if router is not None:
+    os.register_at_fork(after_in_child=router.after_fork)
@@ -0,0 +1,67 @@
+# gunicorn.conf.py
+# Продакшн-режим API. Все параметры — через ENV (см. README).
+import os
+import tempfile
+
+import metrics
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+# gthread: несколько процессов, в каждом пул потоков —
+# запросы к Groq/Stability ждут сеть, а не CPU
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY") or "2")
+threads = int(os.getenv("WEB_THREADS") or "8")
+
+# img2img у Stability идёт до 90 с — таймаут воркера должен быть больше
+timeout = int(os.getenv("WEB_TIMEOUT") or "120")
+graceful_timeout = int(os.getenv("WEB_GRACEFUL_TIMEOUT") or "30")
+keepalive = int(os.getenv("WEB_KEEPALIVE") or "5")
+
+# перезапуск воркеров против утечек памяти
+max_requests = int(os.getenv("WEB_MAX_REQUESTS") or "0")
+max_requests_jitter = int(os.getenv("WEB_MAX_REQUESTS_JITTER") or "0")
+
+# приложение грузится в каждом воркере отдельно: свои соединения SQLite и фоновые потоки
+preload_app = False
+
+accesslog = os.getenv("WEB_ACCESS_LOG") or None
+errorlog = "-"
+loglevel = os.getenv("WEB_LOG_LEVEL") or "info"
+
+# /metrics попадает в случайный воркер — воркеры складывают снимки метрик в общий каталог
+metrics.enable_multiprocess(
+    os.getenv("METRICS_DIR") or os.path.join(tempfile.gettempdir(), f"metrics-{os.getpid()}")
+)
+
+
+def on_starting(server):
+    # в мастере до запуска воркеров: задачи картинок прошлого запуска уже никто не доделает
+    from storage import job_fail_stale
+
+    n = job_fail_stale()
+    if n:
+        print(f"🧹 image jobs interrupted by restart: {n}")
+
+
+def post_worker_init(worker):
+    metrics.start_flusher()
+
+    # компакция памяти чата: поток есть в каждом воркере, работает один — взявший замок
+    from storage import start_memory_compactor
+
+    start_memory_compactor()
+
+    # BOT_MODE=webhook: апдейты принимает любой воркер, а бота поднимает один —
+    # тот, кто взял замок (остальные ждут его и подхватят, если владелец завершится)
+    from bot_webhook import start_webhook, webhook_enabled
+
+    if webhook_enabled():
+        start_webhook()
+
+
+def worker_exit(server, worker):
+    from bot_webhook import stop_webhook
+
+    stop_webhook()
+    metrics.flush()
@@ -0,0 +1,184 @@
+# http_client.py
+"""
+Общий HTTP-клиент для исходящих запросов (Stability, Telegram Bot API).
+
+Одна requests.Session на процесс: пул keep-alive соединений по хостам,
+раздельные таймауты на соединение и чтение, повторы с экспоненциальной
+паузой и джиттером (Retry-After уважается). Неидемпотентный запрос
+(генерация у Stability списывает кредиты) повторяется, только когда
+точно не выполнялся: не удалось соединиться или сервер прямо попросил
+повторить (429/503 с Retry-After).
+Session безопасно делить между потоками — пулы urllib3 потокобезопасны.
+"""
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+
+if TYPE_CHECKING:
+    import requests
+
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT") or "5")
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE") or "10")
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES") or "2")
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF") or "0.5")
+HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX") or "20")
+
+# 500 не повторяем: запрос мог уже выполниться (и списать кредиты)
+RETRY_STATUSES = (429, 502, 503, 504)
+# для неидемпотентных: 502/504 — прокси не дождался ответа, а запрос мог выполниться;
+# 429/503 — только вместе с Retry-After (сервер отказал, не выполняя)
+RETRY_STATUSES_UNSAFE = (429, 503)
+
+
+def _parse_pool_sizes(raw: str) -> Dict[str, int]:
+    out: Dict[str, int] = {}
+    for part in (raw or "").split(","):
+        host, _, size = part.partition("=")
+        try:
+            out[host.strip().lower()] = int(size)
+        except ValueError:
+            continue
+    return out
+
+
+# размеры пулов по хостам: "api.stability.ai=16,api.telegram.org=4"
+HTTP_POOL_SIZES = _parse_pool_sizes(
+    os.getenv("HTTP_POOL_SIZES") or "api.stability.ai=16,api.telegram.org=4"
+)
+
+# requests импортируется при первом запросе — процесс бота стартует без него
+_session: Optional["requests.Session"] = None
+_session_lock = threading.Lock()
+
+
+def _build_session() -> "requests.Session":
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    s = requests.Session()
+    default = HTTPAdapter(pool_connections=8, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=0)
+    s.mount("https://", default)
+    s.mount("http://", default)
+    # requests выбирает адаптер по самому длинному префиксу URL
+    for host, size in HTTP_POOL_SIZES.items():
+        s.mount(f"https://{host}/", HTTPAdapter(pool_connections=1, pool_maxsize=size, max_retries=0))
+    return s
+
+
+def get_session() -> "requests.Session":
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+
+def _reset_after_fork() -> None:
+    # сокеты родителя в ребёнке использовать нельзя
+    global _session, _session_lock
+    _session = None
+    _session_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def retry_after_seconds(resp: "requests.Response") -> Optional[float]:
+    """Retry-After из заголовка (секунды или HTTP-дата) или из JSON Telegram."""
+    raw = resp.headers.get("Retry-After")
+    if raw:
+        try:
+            return max(0.0, float(raw))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(raw).timestamp() - time.time())
+            except Exception:
+                pass
+    if resp.status_code == 429:
+        try:
+            value = resp.json().get("parameters", {}).get("retry_after")
+            if value is not None:
+                return float(value)
+        except Exception:
+            pass
+    return None
+
+
+def _failed_before_send(e: Exception) -> bool:
+    """Ошибка на этапе соединения — до сервера запрос не дошёл, повтор безопасен."""
+    import requests
+    from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    reason = e.args[0] if e.args else None
+    if isinstance(reason, MaxRetryError):
+        reason = reason.reason
+    # отказ в соединении, DNS (NameResolutionError — подкласс)
+    return isinstance(reason, NewConnectionError)
+
+
+def _backoff(attempt: int) -> float:
+    # "full jitter": случайная пауза до экспоненциального потолка
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF * (2 ** attempt)))
+
+
+def request(
+    method: str,
+    url: str,
+    *,
+    read_timeout: float = 30,
+    connect_timeout: Optional[float] = None,
+    retries: Optional[int] = None,
+    idempotent: bool = False,
+    **kwargs,
+) -> "requests.Response":
+    """
+    Запрос через общую сессию. idempotent=True — повторяет любые ошибки сети
+    и ответы 429/502/503/504. Иначе запрос мог выполниться на той стороне,
+    поэтому повторяются только ошибки соединения и 429/503 с Retry-After;
+    обрыв после отправки тела, таймаут чтения, 502/504 — нет.
+    """
+    import requests
+
+    retries = HTTP_RETRIES if retries is None else retries
+    timeout: Tuple[float, float] = (connect_timeout or HTTP_CONNECT_TIMEOUT, read_timeout)
+    session = get_session()
+
+    attempt = 0
+    while True:
+        try:
+            resp = session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= retries or not (idempotent or _failed_before_send(e)):
+                raise
+            time.sleep(_backoff(attempt))
+            attempt += 1
+            continue
+
+        if resp.status_code not in RETRY_STATUSES or attempt >= retries:
+            return resp
+
+        wait = retry_after_seconds(resp)
+        if not idempotent and (resp.status_code not in RETRY_STATUSES_UNSAFE or wait is None):
+            return resp
+        if wait is None:
+            wait = _backoff(attempt)
+        elif wait > HTTP_BACKOFF_MAX:
+            # ждать дольше нет смысла — пусть решает вызывающий код
+            return resp
+        resp.close()
+        time.sleep(wait + random.uniform(0, 0.25))
+        attempt += 1
+
+
+def post(url: str, **kwargs) -> "requests.Response":
+    return request("POST", url, **kwargs)
+
+
+def get(url: str, **kwargs) -> "requests.Response":
+    return request("GET", url, idempotent=True, **kwargs)
@@ -0,0 +1,118 @@
+# image_jobs.py
+"""
+Пул фоновых воркеров для генерации картинок.
+
+HTTP-обработчик кладёт задачу в ограниченную очередь и сразу отвечает,
+генерацию выполняет один из фиксированного числа потоков. Статус задач
+хранится в SQLite (см. job_* в storage.py), здесь — только исполнение и
+замер времени от постановки в очередь до результата.
+"""
+import os
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Tuple
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+class JobQueue:
+    def __init__(self, workers: int, max_queue: int, name: str = "job"):
+        self.workers = max(1, workers)
+        self.max_queue = max(1, max_queue)
+        self.name = name
+        self._init_state()
+
+    def _init_state(self) -> None:
+        self._q: "queue.Queue[Tuple[float, Callable[[], None]]]" = queue.Queue(self.max_queue)
+        self._lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+        self._running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        # последние замеры: (ожидание в очереди, от постановки до результата), секунды
+        self._samples: Deque[Tuple[float, float]] = deque(maxlen=500)
+
+    def _after_fork(self) -> None:
+        # потоки родителя в ребёнок не переезжают
+        self._init_state()
+
+    def _ensure_workers(self) -> None:
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, name=f"{self.name}-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, fn: Callable[[], None]) -> bool:
+        """Ставит задачу в очередь. False — очередь заполнена."""
+        self._ensure_workers()
+        try:
+            self._q.put_nowait((time.monotonic(), fn))
+            return True
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+
+    def depth(self) -> int:
+        return self._q.qsize()
+
+    def _worker(self) -> None:
+        while True:
+            enqueued_at, fn = self._q.get()
+            started_at = time.monotonic()
+            with self._lock:
+                self._running += 1
+            ok = True
+            try:
+                fn()
+            except Exception as e:
+                ok = False
+                print(f"JOB ERROR ({self.name}):", e)
+            finally:
+                done_at = time.monotonic()
+                with self._lock:
+                    self._running -= 1
+                    if ok:
+                        self.completed += 1
+                    else:
+                        self.failed += 1
+                    self._samples.append((started_at - enqueued_at, done_at - enqueued_at))
+                self._q.task_done()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            waits = sorted(s[0] for s in self._samples)
+            totals = sorted(s[1] for s in self._samples)
+            return {
+                "workers": self.workers,
+                "queued": self._q.qsize(),
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "queue_wait_ms_p50": round(_percentile(waits, 0.5) * 1000, 1),
+                "queue_wait_ms_p95": round(_percentile(waits, 0.95) * 1000, 1),
+                "enqueue_to_result_ms_p50": round(_percentile(totals, 0.5) * 1000, 1),
+                "enqueue_to_result_ms_p95": round(_percentile(totals, 0.95) * 1000, 1),
+                "enqueue_to_result_ms_max": round((totals[-1] if totals else 0.0) * 1000, 1),
+            }
+
+
+def make_job_queue(workers: int, max_queue: int, name: str) -> JobQueue:
+    q = JobQueue(workers, max_queue, name)
+    os.register_at_fork(after_in_child=q._after_fork)
+    return q
@@ -0,0 +1,153 @@
+# image_prep.py
+"""
+Подготовка исходного фото перед img2img в Stability.
+
+Картинка декодируется один раз, поворачивается по EXIF, подгоняется
+к ближайшему по пропорциям размеру, который принимает SDXL, и
+перекодируется компактно (JPEG, либо PNG если есть прозрачность).
+Pillow импортируется лениво — только когда реально пришло фото.
+"""
+import io
+import math
+import os
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+# размеры, которые принимает stable-diffusion-xl-1024-v1-0
+SDXL_RESOLUTIONS: List[Tuple[int, int]] = [
+    (1024, 1024),
+    (1152, 896),
+    (896, 1152),
+    (1216, 832),
+    (832, 1216),
+    (1344, 768),
+    (768, 1344),
+    (1536, 640),
+    (640, 1536),
+]
+
+INIT_IMAGE_JPEG_QUALITY = int(os.getenv("INIT_IMAGE_JPEG_QUALITY") or "90")
+# защита от "декомпрессионных бомб": больше — не декодируем
+INIT_IMAGE_MAX_PIXELS = int(os.getenv("INIT_IMAGE_MAX_PIXELS") or "50000000")
+
+_EXIF_ORIENTATION = 0x0112
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+def nearest_sdxl_size(width: int, height: int) -> Tuple[int, int]:
+    """Размер SDXL с ближайшим соотношением сторон."""
+    ratio = width / height
+    return min(SDXL_RESOLUTIONS, key=lambda wh: abs(math.log(ratio / (wh[0] / wh[1]))))
+
+
+class _PrepStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.stage_ms: Dict[str, float] = {}
+
+    def record(self, timings: Dict[str, float], bytes_in: int, bytes_out: int) -> None:
+        with self._lock:
+            self.count += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            for stage, ms in timings.items():
+                self.stage_ms[stage] = self.stage_ms.get(stage, 0.0) + ms
+
+    def error(self) -> None:
+        with self._lock:
+            self.errors += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            n = self.count or 1
+            return {
+                "count": self.count,
+                "errors": self.errors,
+                "avg_bytes_in": round(self.bytes_in / n),
+                "avg_bytes_out": round(self.bytes_out / n),
+                "avg_stage_ms": {k: round(v / n, 2) for k, v in self.stage_ms.items()},
+            }
+
+
+_stats = _PrepStats()
+
+
+def prep_stats() -> Dict[str, Any]:
+    return _stats.stats()
+
+
+def prepare_init_image(data: bytes) -> Dict[str, Any]:
+    """
+    Возвращает {"data", "mime", "filename", "width", "height", "timings"}.
+    timings — миллисекунды по этапам (decode, orient, resize, encode).
+    Бросает InvalidImage, если это не картинка.
+    """
+    from PIL import Image, ImageOps  # лениво: Pillow нужен только для img2img
+
+    timings: Dict[str, float] = {}
+    t = time.perf_counter()
+
+    def lap(stage: str) -> None:
+        nonlocal t
+        now = time.perf_counter()
+        timings[stage] = round((now - t) * 1000, 2)
+        t = now
+
+    try:
+        img = Image.open(io.BytesIO(data))
+        if img.width * img.height > INIT_IMAGE_MAX_PIXELS:
+            raise InvalidImage("image is too large")
+
+        # размер после поворота по EXIF (90°/270° меняют стороны местами)
+        orientation = img.getexif().get(_EXIF_ORIENTATION, 1)
+        w, h = (img.height, img.width) if orientation in (5, 6, 7, 8) else (img.width, img.height)
+        target = nearest_sdxl_size(w, h)
+
+        # JPEG умеет декодироваться сразу в уменьшенном масштабе (1/2, 1/4, 1/8) — в разы быстрее
+        if img.format == "JPEG":
+            draft = target if (w, h) == (img.width, img.height) else (target[1], target[0])
+            img.draft("RGB", draft)
+        img.load()
+    except InvalidImage:
+        _stats.error()
+        raise
+    except Exception as e:
+        _stats.error()
+        raise InvalidImage(f"cannot decode image: {e}")
+    lap("decode")
+
+    img = ImageOps.exif_transpose(img)
+    has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+    img = img.convert("RGBA" if has_alpha else "RGB")
+    lap("orient")
+
+    img = ImageOps.fit(img, target, method=Image.LANCZOS)
+    lap("resize")
+
+    out = io.BytesIO()
+    if has_alpha:
+        img.save(out, format="PNG", optimize=False, compress_level=6)
+        mime, filename = "image/png", "image.png"
+    else:
+        img.save(out, format="JPEG", quality=INIT_IMAGE_JPEG_QUALITY, optimize=True)
+        mime, filename = "image/jpeg", "image.jpg"
+    encoded = out.getvalue()
+    lap("encode")
+
+    _stats.record(timings, len(data), len(encoded))
+    return {
+        "data": encoded,
+        "mime": mime,
+        "filename": filename,
+        "width": target[0],
+        "height": target[1],
+        "timings": timings,
+    }
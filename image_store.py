@@ -0,0 +1,151 @@
+# image_store.py
+"""
+Локальное хранилище сгенерированных картинок с адресацией по содержимому.
+
+Ключ — sha256 от байтов файла, имя — "<ключ>.<расширение>". Одинаковые
+картинки хранятся один раз, а файл по ключу никогда не меняется, поэтому
+его можно кэшировать в браузере/CDN навсегда. Производные версии
+(см. image_variants.py) лежат рядом как "<ключ>-<вариант>.<расширение>".
+
+Размер ограничен IMAGE_STORE_MAX_MB: при переполнении удаляются файлы,
+к которым дольше всего не обращались (mtime обновляется при чтении).
+Несколько процессов могут делить одну папку — учёт размера каждый
+процесс ведёт сам, а при вытеснении пересчитывает по диску.
+"""
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+from typing import Optional, Tuple
+
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR") or "image_store"
+IMAGE_STORE_MAX_MB = float(os.getenv("IMAGE_STORE_MAX_MB") or "512")
+
+# обновлять mtime при чтении не чаще, чем раз в столько секунд
+_TOUCH_INTERVAL = 3600
+
+MIME_TYPES = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "webp": "image/webp",
+    "avif": "image/avif",
+}
+
+VARIANTS = ("display", "thumb")
+
+_NAME_RE = re.compile(r"^([0-9a-f]{64}(?:-(?:display|thumb))?)\.(png|jpg|webp|avif)$")
+
+
+def parse_name(name: str) -> Optional[Tuple[str, str]]:
+    """'<ключ>[-<вариант>].<ext>' -> (основа имени, ext) или None, если имя невалидное."""
+    m = _NAME_RE.match(name or "")
+    return (m.group(1), m.group(2)) if m else None
+
+
+class ImageStore:
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._approx_total: Optional[int] = None
+        self.evicted = 0
+
+    def _path(self, stem: str, ext: str) -> str:
+        # раскладываем по подпапкам, чтобы не было десятков тысяч файлов в одной
+        return os.path.join(self.root, stem[:2], f"{stem}.{ext}")
+
+    def put(self, data: bytes, ext: str = "png") -> str:
+        """Сохраняет байты, возвращает имя файла '<ключ>.<ext>'."""
+        return self.put_as(hashlib.sha256(data).hexdigest(), ext, data)
+
+    def put_as(self, stem: str, ext: str, data: bytes) -> str:
+        """Сохраняет под заданной основой имени (для производных версий)."""
+        if not parse_name(f"{stem}.{ext}"):
+            raise ValueError(f"bad image name: {stem}.{ext}")
+        path = self._path(stem, ext)
+        if os.path.exists(path):
+            os.utime(path)
+            return f"{stem}.{ext}"
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)  # атомарно: читатель не увидит половину файла
+        except Exception:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+        with self._lock:
+            if self._approx_total is None:
+                self._approx_total = self._disk_usage()
+            else:
+                self._approx_total += len(data)
+            over = self._approx_total > self.max_bytes
+        if over:
+            self._evict()
+        return f"{stem}.{ext}"
+
+    def path_for(self, name: str) -> Optional[str]:
+        """Путь к файлу по имени или None. Чтение продлевает жизнь файла."""
+        parsed = parse_name(name)
+        if not parsed:
+            return None
+        path = self._path(*parsed)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if time.time() - st.st_mtime > _TOUCH_INTERVAL:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return path
+
+    def _files(self):
+        for dirpath, _, files in os.walk(self.root):
+            for fn in files:
+                if parse_name(fn):
+                    p = os.path.join(dirpath, fn)
+                    try:
+                        yield p, os.stat(p)
+                    except OSError:
+                        continue
+
+    def _disk_usage(self) -> int:
+        return sum(st.st_size for _, st in self._files())
+
+    def _evict(self) -> None:
+        """Удаляет самые давно не читанные файлы, пока не станет <= 90% лимита."""
+        with self._lock:
+            files = sorted(self._files(), key=lambda item: item[1].st_mtime)
+            total = sum(st.st_size for _, st in files)
+            target = int(self.max_bytes * 0.9)
+            for path, st in files:
+                if total <= target:
+                    break
+                try:
+                    os.unlink(path)
+                    total -= st.st_size
+                    self.evicted += 1
+                except OSError:
+                    continue
+            self._approx_total = total
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "approx_bytes": self._approx_total,
+                "max_bytes": self.max_bytes,
+                "evicted": self.evicted,
+            }
+
+
+image_store = ImageStore(IMAGE_STORE_DIR, int(IMAGE_STORE_MAX_MB * 1024 * 1024))
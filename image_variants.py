@@ -0,0 +1,178 @@
+# image_variants.py
+"""
+Производные версии сгенерированной картинки.
+
+Оригинал (PNG от Stability) хранится для скачивания, а показывать в
+mini app удобнее уменьшенную картинку в WebP/AVIF и маленькое превью.
+PNG декодируется один раз, из него за один проход получаются
+недостающие варианты; каждый кодируется один раз и ложится в image_store
+рядом с оригиналом ("<ключ>-display.webp", "<ключ>-thumb.webp", ...).
+"""
+import io
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from image_store import ImageStore
+
+IMAGE_DISPLAY_MAX = int(os.getenv("IMAGE_DISPLAY_MAX") or "768")
+IMAGE_THUMB_MAX = int(os.getenv("IMAGE_THUMB_MAX") or "256")
+IMAGE_WEBP_QUALITY = int(os.getenv("IMAGE_WEBP_QUALITY") or "80")
+IMAGE_AVIF_QUALITY = int(os.getenv("IMAGE_AVIF_QUALITY") or "60")
+# AVIF меньше, но кодируется дольше и не везде поддерживается — можно выключить
+IMAGE_AVIF = (os.getenv("IMAGE_AVIF") or "1").strip() not in ("0", "false", "no")
+
+# вариант -> форматы (первый — формат по умолчанию)
+VARIANT_FORMATS: Dict[str, Tuple[str, ...]] = {
+    "display": ("webp", "avif"),
+    "thumb": ("webp",),
+}
+
+_avif_supported: Optional[bool] = None
+
+
+def avif_enabled() -> bool:
+    global _avif_supported
+    if not IMAGE_AVIF:
+        return False
+    if _avif_supported is None:
+        try:
+            from PIL import features
+
+            _avif_supported = bool(features.check("avif"))
+        except Exception:
+            _avif_supported = False
+    return _avif_supported
+
+
+def formats_for(variant: str) -> Tuple[str, ...]:
+    return tuple(f for f in VARIANT_FORMATS.get(variant, ()) if f != "avif" or avif_enabled())
+
+
+class _VariantStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+        self.encode_ms: Dict[str, float] = {}
+        self.bytes_out: Dict[str, int] = {}
+
+    def record(self, timings: Dict[str, float], sizes: Dict[str, int]) -> None:
+        with self._lock:
+            self.count += 1
+            for k, ms in timings.items():
+                self.encode_ms[k] = self.encode_ms.get(k, 0.0) + ms
+            for k, size in sizes.items():
+                self.bytes_out[k] = self.bytes_out.get(k, 0) + size
+
+    def error(self) -> None:
+        with self._lock:
+            self.errors += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            n = self.count or 1
+            return {
+                "count": self.count,
+                "errors": self.errors,
+                "avif": avif_enabled(),
+                "avg_ms": {k: round(v / n, 2) for k, v in self.encode_ms.items()},
+                "avg_bytes": {k: round(v / n) for k, v in self.bytes_out.items()},
+            }
+
+
+_stats = _VariantStats()
+
+# один ключ — одна генерация вариантов, даже если их одновременно просят несколько запросов
+_key_locks: Dict[str, threading.Lock] = {}
+_key_locks_guard = threading.Lock()
+
+
+def variant_stats() -> Dict[str, Any]:
+    return _stats.stats()
+
+
+def _encode(img, fmt: str) -> bytes:
+    out = io.BytesIO()
+    if fmt == "webp":
+        img.save(out, format="WEBP", quality=IMAGE_WEBP_QUALITY, method=4)
+    elif fmt == "avif":
+        img.save(out, format="AVIF", quality=IMAGE_AVIF_QUALITY, speed=8)
+    else:
+        raise ValueError(f"unknown format: {fmt}")
+    return out.getvalue()
+
+
+def _build(store: ImageStore, key: str, png: bytes, missing: Set[Tuple[str, str]]) -> None:
+    """Кодирует только пары (вариант, формат) из missing."""
+    from PIL import Image  # лениво, как и в image_prep
+
+    timings: Dict[str, float] = {}
+    sizes: Dict[str, int] = {}
+    # превью делается из display, поэтому уменьшаем по порядку до последнего нужного варианта
+    order = [("display", IMAGE_DISPLAY_MAX), ("thumb", IMAGE_THUMB_MAX)]
+    needed = {variant for variant, _ in missing}
+    last = max(i for i, (variant, _) in enumerate(order) if variant in needed)
+
+    t = time.perf_counter()
+    img = Image.open(io.BytesIO(png))
+    img.load()
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+    timings["decode"] = round((time.perf_counter() - t) * 1000, 2)
+
+    # превью делаем из уже уменьшенной версии — так дешевле
+    current = img
+    for variant, max_side in order[:last + 1]:
+        t = time.perf_counter()
+        resized = current.copy()
+        resized.thumbnail((max_side, max_side), Image.LANCZOS)
+        timings[f"{variant}_resize"] = round((time.perf_counter() - t) * 1000, 2)
+        for fmt in formats_for(variant):
+            if (variant, fmt) not in missing:
+                continue
+            t = time.perf_counter()
+            data = _encode(resized, fmt)
+            timings[f"{variant}_{fmt}"] = round((time.perf_counter() - t) * 1000, 2)
+            sizes[f"{variant}_{fmt}"] = len(data)
+            store.put_as(f"{key}-{variant}", fmt, data)
+        current = resized
+
+    _stats.record(timings, sizes)
+
+
+def make_variants(store: ImageStore, key: str, png: Optional[bytes] = None) -> List[str]:
+    """
+    Создаёт все производные версии для оригинала '<key>.png'.
+    png можно передать, чтобы не читать файл с диска. Уже готовые
+    версии не перекодируются. Возвращает имена файлов.
+    """
+    with _key_locks_guard:
+        lock = _key_locks.setdefault(key, threading.Lock())
+    try:
+        with lock:
+            names = [f"{key}-{v}.{f}" for v in VARIANT_FORMATS for f in formats_for(v)]
+            missing = {
+                (v, f) for v in VARIANT_FORMATS for f in formats_for(v)
+                if not store.path_for(f"{key}-{v}.{f}")
+            }
+            if not missing:
+                return names
+            if png is None:
+                path = store.path_for(f"{key}.png")
+                if not path:
+                    return []
+                with open(path, "rb") as fh:
+                    png = fh.read()
+            try:
+                _build(store, key, png, missing)
+                return names
+            except Exception as e:
+                _stats.error()
+                print("IMAGE VARIANTS ERROR:", e)
+                return []
+    finally:
+        with _key_locks_guard:
+            if _key_locks.get(key) is lock and not lock.locked():
+                _key_locks.pop(key, None)
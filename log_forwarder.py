@@ -0,0 +1,282 @@
+# log_forwarder.py
+"""
+Фоновая отправка логов в Telegram-группу.
+
+Обработчики только кладут текст в очередь (enqueue_log), отправкой
+занимается один фоновый поток: склеивает пачки сообщений, держит паузу
+между отправками в один чат, уважает retry_after от Telegram и после
+серии ошибок на время перестаёт пытаться.
+"""
+import atexit
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import http_client
+import metrics
+
+TELEGRAM_API_BASE = (os.getenv("TELEGRAM_API_BASE") or "https://api.telegram.org").strip().rstrip("/")
+
+LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX") or "1000")
+LOG_MAX_CHARS = 3900
+LOG_BATCH_CHARS = 4000  # лимит Telegram на сообщение — 4096
+# Telegram: в группу не больше ~20 сообщений в минуту
+LOG_MIN_INTERVAL = float(os.getenv("LOG_MIN_INTERVAL") or "3")
+LOG_FAIL_THRESHOLD = int(os.getenv("LOG_FAIL_THRESHOLD") or "5")
+LOG_COOLDOWN = float(os.getenv("LOG_COOLDOWN") or "60")
+LOG_SEND_TIMEOUT = float(os.getenv("LOG_SEND_TIMEOUT") or "12")
+
+TELEGRAM_SEND_SECONDS = metrics.histogram(
+    "telegram_log_send_seconds", "Telegram sendMessage latency for log forwarding", ["status"]
+)
+LOG_DROPPED = metrics.counter("log_forwarder_dropped_total", "Log messages dropped (queue overflow or give-up)")
+
+BATCH_SEPARATOR = "\n\n· · ·\n\n"
+
+
+def _env_group_id() -> int:
+    raw = (os.getenv("TARGET_GROUP_ID") or os.getenv("LOG_GROUP_ID") or "0").strip()
+    try:
+        return int(raw)
+    except Exception:
+        return 0
+
+
+def _truncate(text: str) -> str:
+    if len(text) > LOG_MAX_CHARS:
+        return text[:LOG_MAX_CHARS] + "\n…(truncated)"
+    return text
+
+
+class LogForwarder:
+    def __init__(self, bot_token: str, default_chat_id: int):
+        self.bot_token = bot_token
+        self.default_chat_id = default_chat_id
+
+        self._q: Deque[Tuple[int, str]] = deque()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._pid = 0
+        self._inflight = 0
+
+        self._next_send: Dict[int, float] = {}  # chat_id -> monotonic, раньше не слать
+        self._fails = 0
+        self._paused_until = 0.0
+
+        self.enqueued = 0
+        self.sent_messages = 0
+        self.sent_batches = 0
+        self.dropped = 0
+        self.failed = 0
+        self.rate_limited = 0
+
+    # ---------- публичное ----------
+    def enqueue(self, text: str, chat_id: Optional[int] = None) -> Tuple[bool, str]:
+        chat_id = chat_id or self.default_chat_id
+        if not self.bot_token:
+            return False, "BOT_TOKEN is empty"
+        if not chat_id:
+            return False, "TARGET_GROUP_ID/LOG_GROUP_ID is empty or invalid"
+
+        with self._cond:
+            if len(self._q) >= LOG_QUEUE_MAX:
+                # очередь полна — выкидываем самое старое, свежие логи важнее
+                self._q.popleft()
+                self.dropped += 1
+                LOG_DROPPED.inc()
+            self._q.append((chat_id, _truncate(text)))
+            self.enqueued += 1
+            self._cond.notify()
+        self._ensure_thread()
+        return True, "queued"
+
+    def send_now(self, text: str, chat_id: Optional[int] = None) -> Tuple[bool, str]:
+        """Синхронная отправка мимо очереди (для /api/test-log)."""
+        chat_id = chat_id or self.default_chat_id
+        if not self.bot_token:
+            return False, "BOT_TOKEN is empty"
+        if not chat_id:
+            return False, "TARGET_GROUP_ID/LOG_GROUP_ID is empty or invalid"
+        try:
+            r = self._post(chat_id, _truncate(text))
+            return r.ok, r.text
+        except Exception as e:
+            return False, f"requests error: {e}"
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Ждёт, пока очередь опустеет (вызывается при остановке)."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._q or self._inflight:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                self._cond.wait(min(left, 0.1))
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "queued": len(self._q),
+                "enqueued": self.enqueued,
+                "sent_messages": self.sent_messages,
+                "sent_batches": self.sent_batches,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "rate_limited": self.rate_limited,
+                "paused": self._paused_until > time.monotonic(),
+            }
+
+    def _after_fork(self) -> None:
+        # поток отправки в ребёнка не переезжает, а замок мог остаться захваченным;
+        # очередь родителя отправит сам родитель — копия в ребёнке ушла бы второй раз
+        self._cond = threading.Condition()
+        self._thread = None
+        self._inflight = 0
+        self._q = deque()
+
+    # ---------- фоновый поток ----------
+    def _ensure_thread(self) -> None:
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid and self._thread.is_alive():
+            return
+        with self._cond:
+            if self._thread is not None and self._pid == pid and self._thread.is_alive():
+                return
+            self._pid = pid
+            self._thread = threading.Thread(target=self._run, name="log-forwarder", daemon=True)
+            self._thread.start()
+
+    def _wait_time(self, chat_id: int) -> float:
+        now = time.monotonic()
+        return max(self._paused_until - now, self._next_send.get(chat_id, 0.0) - now, 0.0)
+
+    def _take_batch(self, chat_id: int) -> List[str]:
+        """Забирает из очереди все сообщения этого чата, пока влезают в одно."""
+        batch: List[str] = []
+        size = 0
+        rest: Deque[Tuple[int, str]] = deque()
+        while self._q:
+            cid, text = self._q.popleft()
+            extra = len(text) + (len(BATCH_SEPARATOR) if batch else 0)
+            if cid == chat_id and size + extra <= LOG_BATCH_CHARS:
+                batch.append(text)
+                size += extra
+            else:
+                rest.append((cid, text))
+                if cid == chat_id:
+                    break  # порядок внутри чата сохраняем
+        rest.extend(self._q)
+        self._q = rest
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._q:
+                    self._cond.wait()
+                chat_id = self._q[0][0]
+                wait = self._wait_time(chat_id)
+                if wait > 0:
+                    # пока ждём лимит, в очередь докапывают новые логи — уйдут одной пачкой
+                    self._cond.wait(wait)
+                    continue
+                batch = self._take_batch(chat_id)
+                self._inflight = len(batch)
+
+            try:
+                self._deliver(chat_id, batch)
+            finally:
+                with self._cond:
+                    self._inflight = 0
+                    self._cond.notify_all()
+
+    def _deliver(self, chat_id: int, batch: List[str]) -> None:
+        text = BATCH_SEPARATOR.join(batch)
+        now = time.monotonic()
+        self._next_send[chat_id] = now + LOG_MIN_INTERVAL
+        try:
+            r = self._post(chat_id, text)
+        except Exception as e:
+            print("LOG ERROR:", e)
+            self._on_failure(chat_id, batch)
+            return
+
+        if r.ok:
+            self._fails = 0
+            self.sent_batches += 1
+            self.sent_messages += len(batch)
+            return
+
+        if r.status_code == 429:
+            retry_after = http_client.retry_after_seconds(r) or 5.0
+            self.rate_limited += 1
+            self._next_send[chat_id] = time.monotonic() + retry_after
+            self._requeue(chat_id, batch)
+            return
+
+        print("LOG ERROR:", r.status_code, r.text)
+        if r.status_code >= 500:
+            self._on_failure(chat_id, batch)
+        else:
+            # 4xx (не тот чат, бот кикнут и т.п.) — повтор не поможет
+            self.failed += len(batch)
+
+    def _on_failure(self, chat_id: int, batch: List[str]) -> None:
+        self._fails += 1
+        if self._fails >= LOG_FAIL_THRESHOLD:
+            # серия ошибок — замолкаем на время, очередь продолжает копиться (с вытеснением)
+            self._paused_until = time.monotonic() + LOG_COOLDOWN
+            self._fails = 0
+            self.failed += len(batch)
+            print(f"LOG ERROR: telegram unavailable, pausing log sending for {LOG_COOLDOWN:.0f}s")
+            return
+        backoff = min(LOG_COOLDOWN, LOG_MIN_INTERVAL * (2 ** self._fails))
+        self._next_send[chat_id] = time.monotonic() + backoff * random.uniform(0.5, 1.0)
+        self._requeue(chat_id, batch)
+
+    def _requeue(self, chat_id: int, batch: List[str]) -> None:
+        with self._cond:
+            for text in reversed(batch):
+                if len(self._q) >= LOG_QUEUE_MAX:
+                    self.dropped += 1
+                    LOG_DROPPED.inc()
+                    continue
+                self._q.appendleft((chat_id, text))
+
+    def _post(self, chat_id: int, text: str):
+        # повторы и паузы решает сам форвардер, поэтому retries=0
+        t0 = time.perf_counter()
+        status = "error"
+        try:
+            r = http_client.post(
+                f"{TELEGRAM_API_BASE}/bot{self.bot_token}/sendMessage",
+                json={"chat_id": chat_id, "text": text},
+                read_timeout=LOG_SEND_TIMEOUT,
+                retries=0,
+            )
+            status = str(r.status_code)
+            return r
+        finally:
+            TELEGRAM_SEND_SECONDS.labels(status).observe(time.perf_counter() - t0)
+
+
+log_forwarder = LogForwarder((os.getenv("BOT_TOKEN") or "").strip(), _env_group_id())
+atexit.register(log_forwarder.flush, 3.0)
+os.register_at_fork(after_in_child=log_forwarder._after_fork)
+metrics.gauge("log_forwarder_queued", "Log messages waiting to be sent").set_function(lambda: len(log_forwarder._q))
+
+
+def enqueue_log(text: str, chat_id: Optional[int] = None) -> Tuple[bool, str]:
+    return log_forwarder.enqueue(text, chat_id)
+
+
+def send_log_now(text: str, chat_id: Optional[int] = None) -> Tuple[bool, str]:
+    return log_forwarder.send_now(text, chat_id)
+
+
+def log_stats() -> Dict[str, Any]:
+    return log_forwarder.stats()
@@ -1,14 +1,27 @@
 import os
+import multiprocessing
 import threading
 
-from api import api
-from bot import start_bot
-
 # Railway / ENV
 PORT = int(os.getenv("PORT", "8000"))
 
+# что запускать в этом процессе: all | api | bot
+APP_ROLE = (os.getenv("APP_ROLE") or "all").strip().lower()
+# чем обслуживать API: dev (встроенный сервер Flask) | gunicorn
+HTTP_SERVER = (os.getenv("HTTP_SERVER") or "dev").strip().lower()
+
+GUNICORN_CONF = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gunicorn.conf.py")
+
 
 def run_api():
+    from api import api
+    from storage import job_fail_stale
+
+    # один процесс API — задачи картинок прошлого запуска уже никто не доделает
+    n = job_fail_stale()
+    if n:
+        print(f"🧹 image jobs interrupted by restart: {n}")
+
     api.run(
         host="0.0.0.0",
         port=PORT,
@@ -17,14 +30,85 @@ def run_api():
     )
 
 
+def run_api_gunicorn():
+    from gunicorn.app.base import Application
+
+    class ApiServer(Application):
+        def init(self, parser, opts, args):
+            return None
+
+        def load_config(self):
+            self.load_config_from_file(GUNICORN_CONF)
+
+        def load(self):
+            from api import api
+
+            return api
+
+    ApiServer().run()
+
+
+def run_bot():
+    from bot import start_bot
+
+    start_bot()
+
+
+def start_webhook_bot():
+    from bot_webhook import start_webhook
+
+    start_webhook()
+
+
 def main():
+    # компакция памяти чата — одна на весь деплой (замок; воркеры gunicorn зовут её тоже)
+    from storage import start_memory_compactor
+
+    start_memory_compactor()
+
+    # BOT_MODE=webhook: апдейты принимает API, бот живёт в процессе API
+    from bot_webhook import webhook_enabled
+
+    webhook = webhook_enabled()
+
+    if APP_ROLE == "bot":
+        if webhook:
+            raise RuntimeError("BOT_MODE=webhook: updates go to the API process, run with APP_ROLE=api or all")
+        run_bot()
+        return
+
+    if HTTP_SERVER == "gunicorn":
+        # в режиме webhook бота поднимает один из воркеров (post_worker_init в gunicorn.conf.py)
+        if APP_ROLE == "api" or webhook:
+            run_api_gunicorn()
+            return
+
+        # бот — отдельным процессом, gunicorn — в основном (ему нужны сигналы)
+        bot_proc = multiprocessing.Process(target=run_bot, name="telegram-bot")
+        bot_proc.start()
+        try:
+            run_api_gunicorn()
+        finally:
+            bot_proc.terminate()
+            bot_proc.join(10)
+        return
+
+    if APP_ROLE == "api" and not webhook:
+        run_api()
+        return
+
+    if webhook:
+        start_webhook_bot()
+        run_api()
+        return
+
     # Flask API — в отдельном потоке
     t = threading.Thread(target=run_api, daemon=True)
     t.start()
 
     # Telegram bot — основной поток
-    start_bot()
+    run_bot()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,502 @@
+# metrics.py
+"""
+Минимальный реестр метрик в формате Prometheus (без внешних зависимостей).
+
+Счётчики, gauge и гистограммы с фиксированными корзинами. У каждого
+набора меток — свой объект со своим локом, так что запись — это поиск
+корзины и пара сложений под неконкурентным локом. Gauge можно задать
+функцией: значение (глубина очереди и т.п.) считается только при
+чтении /metrics и ничего не стоит на горячем пути.
+
+Под gunicorn у каждого воркера свой реестр. enable_multiprocess(dir)
+(из gunicorn.conf.py, до fork) включает общий каталог: каждый процесс раз в
+METRICS_FLUSH секунд и при каждом /metrics пишет туда снимок своих метрик,
+а /metrics складывает снимки всех процессов. Счётчики и гистограммы
+суммируются (в том числе завершившихся воркеров — счётчик не откатывается
+назад), gauge отдаются по каждому живому процессу с меткой pid.
+"""
+import fcntl
+import functools
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# секунды: от быстрых запросов к SQLite до долгой генерации картинок
+DEFAULT_BUCKETS: Tuple[float, ...] = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0,
+)
+
+
+def _fmt(value: float) -> str:
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_str(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _CounterChild:
+    __slots__ = ("_lock", "value")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class _GaugeChild:
+    __slots__ = ("_lock", "value", "fn")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+        self.fn: Optional[Callable[[], float]] = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.inc(-amount)
+
+    def set_function(self, fn: Callable[[], float]) -> None:
+        self.fn = fn
+
+    def get(self) -> float:
+        if self.fn is not None:
+            try:
+                return float(self.fn())
+            except Exception:
+                return float("nan")
+        return self.value
+
+
+class _HistogramChild:
+    __slots__ = ("_lock", "_bounds", "_counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self._lock = threading.Lock()
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)  # последняя — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        i = bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0)
+
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        with self._lock:
+            return list(self._counts), self.sum, self.count
+
+
+class _Family:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str]):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lookup: Dict[tuple, object] = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            # метрики без меток можно дёргать напрямую: family.inc(), family.observe()
+            child = self._children[()] = self._new_child()
+            for attr in ("inc", "dec", "set", "set_function", "observe", "time"):
+                if hasattr(child, attr):
+                    setattr(self, attr, getattr(child, attr))
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values, **kw):
+        if kw:
+            values = tuple(kw[n] for n in self.labelnames)
+        # быстрый путь: те же значения, что в прошлый раз (в т.ч. не строки, например код 200)
+        child = self._lookup.get(values)
+        if child is not None:
+            return child
+        key = tuple(str(v) for v in values)
+        if len(key) != len(self.labelnames):
+            raise ValueError(f"{self.name}: expected labels {self.labelnames}")
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = self._new_child()
+            self._lookup[values] = child
+        return child
+
+    def _items(self):
+        with self._lock:
+            return sorted(self._children.items())
+
+
+class Counter(_Family):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def render(self, out: List[str]) -> None:
+        for values, child in self._items():
+            out.append(f"{self.name}{_label_str(self.labelnames, values)} {_fmt(child.value)}")
+
+    def snapshot(self) -> List[Tuple[Tuple[str, ...], Any]]:
+        return [(values, child.value) for values, child in self._items()]
+
+
+class Gauge(_Family):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def render(self, out: List[str]) -> None:
+        for values, child in self._items():
+            out.append(f"{self.name}{_label_str(self.labelnames, values)} {_fmt(child.get())}")
+
+    def snapshot(self) -> List[Tuple[Tuple[str, ...], Any]]:
+        return [(values, child.get()) for values, child in self._items()]
+
+
+class Histogram(_Family):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str], buckets: Sequence[float]):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, doc, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def render(self, out: List[str]) -> None:
+        for values, child in self._items():
+            _render_histogram(out, self.name, self.labelnames, values, self.bounds, child.snapshot())
+
+    def snapshot(self) -> List[Tuple[Tuple[str, ...], Any]]:
+        return [(values, list(child.snapshot())) for values, child in self._items()]
+
+
+def _render_histogram(
+    out: List[str], name: str, labelnames: Sequence[str], values: Sequence[str],
+    bounds: Tuple[float, ...], data: Sequence[Any],
+) -> None:
+    counts, total, count = data
+    acc = 0
+    for bound, n in zip(tuple(bounds) + (float("inf"),), counts):
+        acc += n
+        le = f'le="{_fmt(bound)}"'
+        out.append(f"{name}_bucket{_label_str(labelnames, values, le)} {acc}")
+    labels = _label_str(labelnames, values)
+    out.append(f"{name}_sum{labels} {_fmt(total)}")
+    out.append(f"{name}_count{labels} {count}")
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families: Dict[str, _Family] = {}
+
+    def _register(self, family: _Family) -> _Family:
+        with self._lock:
+            existing = self._families.get(family.name)
+            if existing is not None:
+                # повторный импорт модуля (например, из разных точек входа) — тот же объект
+                return existing
+            self._families[family.name] = family
+            return family
+
+    def counter(self, name: str, doc: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, doc, labelnames))
+
+    def gauge(self, name: str, doc: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, doc, labelnames))
+
+    def histogram(
+        self, name: str, doc: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self._register(Histogram(name, doc, labelnames, buckets))
+
+    def _sorted_families(self) -> List[_Family]:
+        with self._lock:
+            return sorted(self._families.values(), key=lambda f: f.name)
+
+    def render(self) -> str:
+        out: List[str] = []
+        for fam in self._sorted_families():
+            out.append(f"# HELP {fam.name} {fam.doc}")
+            out.append(f"# TYPE {fam.name} {fam.kind}")
+            fam.render(out)
+        return "\n".join(out) + "\n"
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Все метрики процесса в виде, пригодном для JSON и сложения с другими процессами."""
+        return {
+            fam.name: {
+                "kind": fam.kind,
+                "doc": fam.doc,
+                "labelnames": list(fam.labelnames),
+                "bounds": list(getattr(fam, "bounds", ())),
+                "series": [[list(values), data] for values, data in fam.snapshot()],
+            }
+            for fam in self._sorted_families()
+        }
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def render() -> str:
+    if _mp_dir is not None:
+        return _render_multiprocess()
+    return REGISTRY.render()
+
+
+# =========================
+# ✅ НЕСКОЛЬКО ПРОЦЕССОВ (gunicorn)
+# =========================
+METRICS_FLUSH = float(os.getenv("METRICS_FLUSH") or "5")
+
+_mp_dir: Optional[str] = None
+_flusher: Optional[threading.Thread] = None
+_DEAD_FILE = "dead.json"  # сумма счётчиков завершившихся процессов
+
+
+def enable_multiprocess(path: str) -> None:
+    """Вызывать в мастере до fork воркеров. Снимки прошлого запуска удаляются."""
+    global _mp_dir
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(path):
+        if name.endswith(".json"):
+            os.unlink(os.path.join(path, name))
+    _mp_dir = path
+
+
+def multiprocess_dir() -> Optional[str]:
+    return _mp_dir
+
+
+def _write_json(path: str, data: Any) -> None:
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _read_json(path: str) -> Optional[Any]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def flush() -> None:
+    """Снимок метрик этого процесса — в общий каталог."""
+    if _mp_dir is not None:
+        _write_json(os.path.join(_mp_dir, f"{os.getpid()}.json"), REGISTRY.snapshot())
+
+
+def start_flusher() -> None:
+    """Фоновая запись снимков (в каждом воркере после fork)."""
+    global _flusher
+    if _mp_dir is None or (_flusher is not None and _flusher.is_alive()):
+        return
+
+    def loop():
+        while True:
+            time.sleep(METRICS_FLUSH)
+            try:
+                flush()
+            except Exception as e:
+                print("METRICS FLUSH ERROR:", e)
+
+    _flusher = threading.Thread(target=loop, name="metrics-flush", daemon=True)
+    _flusher.start()
+
+
+def _after_fork() -> None:
+    global _flusher
+    _flusher = None
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge(acc: Dict[str, Any], snap: Dict[str, Any], pid: Optional[str]) -> None:
+    """Прибавляет снимок процесса к acc. pid=None — gauge не берём (процесс завершился)."""
+    for name, fam in snap.items():
+        if fam["kind"] == "gauge" and pid is None:
+            continue
+        dst = acc.setdefault(name, dict(fam, series={}))
+        if fam["kind"] == "gauge":
+            dst["labelnames"] = list(fam["labelnames"]) + ["pid"]
+        for values, data in fam["series"]:
+            if fam["kind"] == "gauge":
+                dst["series"][tuple(values) + (pid,)] = data
+            elif fam["kind"] == "counter":
+                key = tuple(values)
+                dst["series"][key] = dst["series"].get(key, 0.0) + data
+            else:
+                key = tuple(values)
+                old = dst["series"].get(key)
+                if old is None:
+                    dst["series"][key] = [list(data[0]), data[1], data[2]]
+                else:
+                    old[0] = [a + b for a, b in zip(old[0], data[0])]
+                    old[1] += data[1]
+                    old[2] += data[2]
+
+
+def _fold_dead(pid_file: str) -> None:
+    """Счётчики завершившегося процесса переносятся в dead.json, его файл удаляется."""
+    lock_fd = os.open(os.path.join(_mp_dir, ".lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        snap = _read_json(pid_file)
+        if snap is None:
+            return  # уже перенёс другой воркер
+        dead_path = os.path.join(_mp_dir, _DEAD_FILE)
+        acc: Dict[str, Any] = {}
+        _merge(acc, _read_json(dead_path) or {}, None)
+        _merge(acc, snap, None)
+        _write_json(dead_path, {
+            name: dict(fam, series=[[list(k), v] for k, v in fam["series"].items()])
+            for name, fam in acc.items()
+        })
+        os.unlink(pid_file)
+    finally:
+        os.close(lock_fd)
+
+
+def _render_multiprocess() -> str:
+    flush()
+    live: List[Tuple[str, str]] = []
+    for name in sorted(os.listdir(_mp_dir)):
+        pid = name[: -len(".json")]
+        if not name.endswith(".json") or not pid.isdigit():
+            continue
+        path = os.path.join(_mp_dir, name)
+        if _pid_alive(int(pid)):
+            live.append((pid, path))
+        else:
+            _fold_dead(path)
+
+    acc: Dict[str, Any] = {}
+    _merge(acc, _read_json(os.path.join(_mp_dir, _DEAD_FILE)) or {}, None)
+    for pid, path in live:
+        snap = _read_json(path)
+        if snap is not None:
+            _merge(acc, snap, pid)
+
+    out: List[str] = []
+    for name in sorted(acc):
+        fam = acc[name]
+        out.append(f"# HELP {name} {fam['doc']}")
+        out.append(f"# TYPE {name} {fam['kind']}")
+        labelnames = fam["labelnames"]
+        for values, data in sorted(fam["series"].items()):
+            if fam["kind"] == "histogram":
+                _render_histogram(out, name, labelnames, values, tuple(fam["bounds"]), data)
+            else:
+                out.append(f"{name}{_label_str(labelnames, values)} {_fmt(data)}")
+    return "\n".join(out) + "\n"
+
+
+# ---- бот: время обработчиков ----
+BOT_HANDLER_SECONDS = histogram("bot_handler_seconds", "Telegram bot handler duration", ["handler"])
+BOT_HANDLER_ERRORS = counter("bot_handler_errors_total", "Telegram bot handler exceptions", ["handler"])
+
+
+def timed_handler(name: str, fn):
+    """Оборачивает async-обработчик PTB: время и ошибки по имени."""
+    hist = BOT_HANDLER_SECONDS.labels(name)
+    errors = BOT_HANDLER_ERRORS.labels(name)
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            hist.observe(time.perf_counter() - t0)
+
+    return wrapper
+
+
+def serve_metrics(port: int, host: str = "0.0.0.0") -> None:
+    """Отдельный /metrics на своём порту — для процесса бота, где нет Flask."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"📈 metrics on :{port}/metrics")
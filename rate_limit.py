@@ -0,0 +1,222 @@
+# rate_limit.py
+"""
+Ограничение нагрузки на AI-эндпоинты.
+
+1) Token bucket на пару (пользователь, эндпоинт): в ведре до N жетонов,
+   они восполняются равномерно за окно. Проверка — O(1), состояние —
+   два числа на ведро. Ведра, которые давно не трогали, удаляются
+   (полное ведро ничем не отличается от отсутствующего).
+2) Ограничение одновременных запросов к апстриму (Groq, Stability):
+   часть слотов зарезервирована за приоритетными пользователями.
+
+Всё в памяти процесса: при нескольких воркерах gunicorn лимиты действуют
+на каждый процесс отдельно.
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Set, Tuple
+
+
+def _parse_limits(raw: str) -> Dict[str, Tuple[int, float]]:
+    """'chat=20/60,image=5/60' -> {"chat": (20, 60.0), ...}."""
+    out: Dict[str, Tuple[int, float]] = {}
+    for part in (raw or "").split(","):
+        name, _, spec = part.partition("=")
+        count, _, window = spec.partition("/")
+        try:
+            out[name.strip().lower()] = (int(count), float(window or "60"))
+        except ValueError:
+            continue
+    return out
+
+
+def _parse_ids(raw: str) -> Set[int]:
+    out: Set[int] = set()
+    for part in (raw or "").replace(" ", ",").split(","):
+        try:
+            out.add(int(part))
+        except ValueError:
+            continue
+    return out
+
+
+def _parse_sizes(raw: str) -> Dict[str, int]:
+    out: Dict[str, int] = {}
+    for part in (raw or "").split(","):
+        name, _, size = part.partition("=")
+        try:
+            out[name.strip().lower()] = int(size)
+        except ValueError:
+            continue
+    return out
+
+
+# запросов на окно (секунды) для каждого эндпоинта: "chat=20/60,image=5/60"
+RATE_LIMITS = _parse_limits(os.getenv("RATE_LIMITS") or "chat=20/60,image=5/60")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS") or "50000")
+# приоритетная полоса: платящие пользователи (в БД флага оплаты пока нет — список из env)
+PRIORITY_USER_IDS = _parse_ids(os.getenv("PRIORITY_USER_IDS") or "")
+RATE_LIMIT_PRIORITY_MULT = float(os.getenv("RATE_LIMIT_PRIORITY_MULT") or "3")
+
+# одновременных запросов к апстриму на процесс и сколько из них только для приоритетных
+UPSTREAM_LIMITS = _parse_sizes(os.getenv("UPSTREAM_LIMITS") or "groq=16,stability=8")
+UPSTREAM_PRIORITY_RESERVE = int(os.getenv("UPSTREAM_PRIORITY_RESERVE") or "2")
+# сколько HTTP-запрос ждёт свободный слот, прежде чем получить 503
+UPSTREAM_WAIT = float(os.getenv("UPSTREAM_WAIT") or "2")
+
+
+def is_priority(user_id: int) -> bool:
+    return user_id in PRIORITY_USER_IDS
+
+
+def retry_after_header(seconds: float) -> Dict[str, str]:
+    return {"Retry-After": str(max(1, math.ceil(seconds)))}
+
+
+class TokenBuckets:
+    def __init__(self, limits: Dict[str, Tuple[int, float]], max_keys: int, priority_mult: float):
+        self.limits = limits
+        self.max_keys = max(1, max_keys)
+        self.priority_mult = max(1.0, priority_mult)
+        self._lock = threading.Lock()
+        # (user_id, endpoint) -> [жетоны, время последнего обновления]; порядок = давность обращения
+        self._buckets: "OrderedDict[Tuple[int, str], list]" = OrderedDict()
+        self.allowed = 0
+        self.rejected = 0
+        self.evicted = 0
+
+    def _after_fork(self) -> None:
+        # лок мог быть захвачен потоком родителя в момент fork
+        self._lock = threading.Lock()
+
+    def _params(self, endpoint: str, priority: bool) -> Tuple[float, float]:
+        count, window = self.limits[endpoint]
+        burst = count * (self.priority_mult if priority else 1.0)
+        return burst, burst / window
+
+    def take(self, user_id: int, endpoint: str, priority: bool = False) -> float:
+        """Берёт жетон. 0.0 — можно, иначе сколько секунд подождать."""
+        if endpoint not in self.limits:
+            return 0.0
+        burst, rate = self._params(endpoint, priority)
+        now = time.monotonic()
+        key = (user_id, endpoint)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = [burst, now]
+                self._buckets[key] = bucket
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+
+            if bucket[0] >= 1.0:
+                bucket[0] -= 1.0
+                self.allowed += 1
+                wait = 0.0
+            else:
+                self.rejected += 1
+                wait = (1.0 - bucket[0]) / rate
+
+            self._evict(now)
+        return wait
+
+    def _evict(self, now: float) -> None:
+        # в начале — самые давно тронутые; за одну проверку удаляем немного (амортизированно O(1))
+        for _ in range(4):
+            if not self._buckets:
+                return
+            (_, endpoint), bucket = next(iter(self._buckets.items()))
+            window = self.limits.get(endpoint, (0, 0.0))[1]
+            if len(self._buckets) > self.max_keys or now - bucket[1] >= window:
+                self._buckets.popitem(last=False)
+                self.evicted += 1
+            else:
+                return
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "buckets": len(self._buckets),
+                "allowed": self.allowed,
+                "rejected": self.rejected,
+                "evicted": self.evicted,
+            }
+
+
+class UpstreamBusy(Exception):
+    def __init__(self, name: str, retry_after: float = 5.0):
+        super().__init__(f"{name} is busy")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class ConcurrencyGate:
+    """Не больше limit одновременных вызовов; последние reserve слотов — только приоритетным."""
+
+    def __init__(self, name: str, limit: int, reserve: int):
+        self.name = name
+        self.limit = max(1, limit)
+        self.reserve = min(max(0, reserve), self.limit - 1)
+        self._init_state()
+
+    def _init_state(self) -> None:
+        self._cond = threading.Condition()
+        self.active = 0
+        self.peak = 0
+        self.rejected = 0
+
+    def _after_fork(self) -> None:
+        self._init_state()
+
+    def acquire(self, priority: bool = False, timeout: Optional[float] = None) -> bool:
+        cap = self.limit if priority else self.limit - self.reserve
+        wait = UPSTREAM_WAIT if timeout is None else timeout
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.active < cap, timeout=wait):
+                self.rejected += 1
+                return False
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            return True
+
+    def release(self) -> None:
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, priority: bool = False, timeout: Optional[float] = None) -> Iterator[None]:
+        if not self.acquire(priority, timeout):
+            raise UpstreamBusy(self.name)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "limit": self.limit,
+                "priority_reserve": self.reserve,
+                "active": self.active,
+                "peak": self.peak,
+                "rejected": self.rejected,
+            }
+
+
+def make_gate(name: str) -> ConcurrencyGate:
+    gate = ConcurrencyGate(name, UPSTREAM_LIMITS.get(name, 8), UPSTREAM_PRIORITY_RESERVE)
+    os.register_at_fork(after_in_child=gate._after_fork)
+    return gate
+
+
+rate_limiter = TokenBuckets(RATE_LIMITS, RATE_LIMIT_MAX_KEYS, RATE_LIMIT_PRIORITY_MULT)
+os.register_at_fork(after_in_child=rate_limiter._after_fork)
+groq_gate = make_gate("groq")
+stability_gate = make_gate("stability")
@@ -0,0 +1,168 @@
+# singleflight.py
+"""
+Склейка одинаковых запросов и ключи идемпотентности.
+
+Двойной тап, повтор после таймаута или перезагрузка WebView присылают
+тот же запрос ещё раз. По ключу (пользователь + эндпоинт + ключ
+идемпотентности или отпечаток содержимого) выполняется только первый
+запрос — «ведущий», остальные ждут его результат. Для явного ключа
+успешный результат ещё какое-то время хранится и отдаётся повторно без
+обращения к Groq/Stability.
+
+Таблица живёт в памяти процесса и ограничена по размеру.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# сколько хранить результат для явного ключа идемпотентности (склейка по отпечатку — без хранения)
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL") or "300")
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES") or "10000")
+# сколько ожидающий запрос ждёт ведущего
+COALESCE_WAIT = float(os.getenv("COALESCE_WAIT") or "180")
+
+LEAD, WAIT, DONE, CONFLICT = "lead", "wait", "done", "conflict"
+
+
+def fingerprint(*parts: Any) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, bytes):
+            h.update(part)
+        else:
+            h.update(str(part).encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+class Flight:
+    __slots__ = ("event", "result", "fingerprint", "expires")
+
+    def __init__(self, fp: str):
+        self.event = threading.Event()
+        self.result: Any = None
+        self.fingerprint = fp
+        self.expires = 0.0
+
+    def wait(self, timeout: float = COALESCE_WAIT) -> Any:
+        """Результат ведущего или None (ведущий упал / не дождались)."""
+        if not self.event.wait(timeout):
+            return None
+        return self.result
+
+
+class FlightTable:
+    def __init__(self, max_entries: int):
+        self.max_entries = max(1, max_entries)
+        self._init_state()
+
+    def _init_state(self) -> None:
+        self._lock = threading.Lock()
+        self._flights: "OrderedDict[str, Flight]" = OrderedDict()
+        self.leaders = 0
+        self.coalesced = 0
+        self.replayed = 0
+        self.conflicts = 0
+
+    def _after_fork(self) -> None:
+        self._init_state()
+
+    def begin(self, key: str, fp: str) -> Tuple[str, Flight]:
+        """
+        LEAD — выполнять самому и потом вызвать finish(),
+        WAIT — такой же запрос уже выполняется (flight.wait()),
+        DONE — готовый результат в flight.result,
+        CONFLICT — ключ уже использован с другим содержимым.
+        """
+        now = time.monotonic()
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and flight.event.is_set() and flight.expires <= now:
+                del self._flights[key]
+                flight = None
+
+            if flight is not None:
+                if flight.fingerprint != fp:
+                    self.conflicts += 1
+                    return CONFLICT, flight
+                if flight.event.is_set():
+                    self.replayed += 1
+                    return DONE, flight
+                self.coalesced += 1
+                return WAIT, flight
+
+            flight = Flight(fp)
+            self._flights[key] = flight
+            self.leaders += 1
+            self._evict()
+            return LEAD, flight
+
+    def finish(self, key: str, flight: Flight, result: Any, ttl: float) -> None:
+        """Отдаёт результат ожидающим; ttl > 0 — ещё и сохраняет для повторов."""
+        with self._lock:
+            flight.result = result
+            flight.expires = time.monotonic() + ttl
+            if (ttl <= 0 or result is None) and self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.event.set()
+
+    def _evict(self) -> None:
+        # выполняющиеся запросы не выкидываем — переносим в конец
+        for _ in range(len(self._flights)):
+            if len(self._flights) <= self.max_entries:
+                return
+            key, flight = self._flights.popitem(last=False)
+            if not flight.event.is_set():
+                self._flights[key] = flight
+
+    def do(
+        self,
+        key: str,
+        fp: str,
+        fn: Callable[[], Any],
+        ttl_for: Callable[[Any], float],
+    ) -> Tuple[Optional[Any], str]:
+        """
+        Выполняет fn() один раз на ключ. Возвращает (результат, как получен):
+        LEAD/WAIT/DONE, (None, WAIT) — ведущий не успел за COALESCE_WAIT,
+        (None, CONFLICT) — ключ уже использован с другим содержимым.
+        """
+        while True:
+            state, flight = self.begin(key, fp)
+            if state == CONFLICT:
+                return None, CONFLICT
+            if state == DONE:
+                return flight.result, DONE
+            if state == WAIT:
+                result = flight.wait()
+                if result is not None or not flight.event.is_set():
+                    # None здесь — не дождались ведущего
+                    return result, WAIT
+                # ведущий упал — пробуем заново (возможно, станем ведущим сами)
+                continue
+
+            result = None
+            try:
+                result = fn()
+            finally:
+                self.finish(key, flight, result, ttl_for(result) if result is not None else 0)
+            return result, LEAD
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._flights),
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+                "replayed": self.replayed,
+                "conflicts": self.conflicts,
+            }
+
+
+def make_flight_table() -> FlightTable:
+    table = FlightTable(IDEMPOTENCY_MAX_ENTRIES)
+    os.register_at_fork(after_in_child=table._after_fork)
+    return table
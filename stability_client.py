@@ -1,14 +1,36 @@
 # stability_client.py
 import os
 import base64
+import time
 from typing import Optional
 
+import http_client
+import metrics
+
 # --- ENV ---
 STABILITY_API_KEY = (os.getenv("STABILITY_API_KEY") or "").strip()
+# можно направить на локальную заглушку (bench/fake_upstreams.py)
+STABILITY_API_HOST = (os.getenv("STABILITY_API_HOST") or "https://api.stability.ai").strip().rstrip("/")
 
 # --- Stability Client ---
 print(f"🔧 STABILITY_API_KEY loaded: {'Yes' if STABILITY_API_KEY else 'No'}")
 
+STABILITY_SECONDS = metrics.histogram(
+    "stability_http_seconds", "Stability API call latency", ["endpoint", "status"]
+)
+
+
+def _post(endpoint: str, url: str, **kwargs):
+    t0 = time.perf_counter()
+    status = "error"
+    try:
+        response = http_client.post(url, **kwargs)
+        status = str(response.status_code)
+        return response
+    finally:
+        STABILITY_SECONDS.labels(endpoint, status).observe(time.perf_counter() - t0)
+
+
 def generate_image(
     prompt: str,
     negative_prompt: Optional[str] = None,
@@ -17,10 +39,10 @@ def generate_image(
     width: int = 1024,
     height: int = 1024,
     samples: int = 1,
-) -> str:
+) -> bytes:
     """
     Генерация изображения через Stability AI HTTP API.
-    Возвращает base64 строку.
+    Возвращает PNG (bytes).
     """
     if not STABILITY_API_KEY:
         raise RuntimeError("STABILITY_API_KEY is not set")
@@ -30,7 +52,7 @@ def generate_image(
     
     # Используем Engine ID для SDXL
     engine_id = "stable-diffusion-xl-1024-v1-0"
-    url = f"https://api.stability.ai/v1/generation/{engine_id}/text-to-image"
+    url = f"{STABILITY_API_HOST}/v1/generation/{engine_id}/text-to-image"
     
     headers = {
         "Authorization": f"Bearer {STABILITY_API_KEY}",
@@ -59,8 +81,7 @@ def generate_image(
     }
     
     try:
-        import requests
-        response = requests.post(url, headers=headers, json=payload, timeout=60)
+        response = _post("text-to-image", url, headers=headers, json=payload, read_timeout=60)
         
         if response.status_code != 200:
             error_msg = f"Stability API error {response.status_code}"
@@ -77,11 +98,8 @@ def generate_image(
             raise RuntimeError("No image generated")
         
         # Берем первую сгенерированную картинку
-        image_base64 = data["artifacts"][0]["base64"]
-        return f"data:image/png;base64,{image_base64}"
+        return base64.b64decode(data["artifacts"][0]["base64"])
         
-    except ImportError:
-        raise RuntimeError("requests library is required")
     except Exception as e:
         raise RuntimeError(f"Image generation failed: {str(e)}")
 
@@ -92,10 +110,11 @@ def generate_image_from_image(
     strength: float = 0.7,
     steps: int = 30,
     cfg_scale: float = 7.0,
-) -> str:
+    init_image_mime: str = "image/png",
+) -> bytes:
     """
     Генерация изображения на основе другого изображения (img2img).
-    Используем image-to-image API.
+    Используем image-to-image API. Возвращает PNG (bytes).
     """
     if not STABILITY_API_KEY:
         raise RuntimeError("STABILITY_API_KEY is not set")
@@ -108,7 +127,7 @@ def generate_image_from_image(
     
     # Используем Engine ID для SDXL
     engine_id = "stable-diffusion-xl-1024-v1-0"
-    url = f"https://api.stability.ai/v1/generation/{engine_id}/image-to-image"
+    url = f"{STABILITY_API_HOST}/v1/generation/{engine_id}/image-to-image"
     
     headers = {
         "Authorization": f"Bearer {STABILITY_API_KEY}",
@@ -116,8 +135,9 @@ def generate_image_from_image(
     }
     
     # Подготовка данных
+    ext = "jpg" if init_image_mime == "image/jpeg" else "png"
     files = {
-        "init_image": ("image.png", init_image, "image/png")
+        "init_image": (f"image.{ext}", init_image, init_image_mime)
     }
     
     data = {
@@ -129,8 +149,7 @@ def generate_image_from_image(
     }
     
     try:
-        import requests
-        response = requests.post(url, headers=headers, files=files, data=data, timeout=90)
+        response = _post("image-to-image", url, headers=headers, files=files, data=data, read_timeout=90)
         
         if response.status_code != 200:
             error_msg = f"Stability img2img API error {response.status_code}"
@@ -147,11 +166,8 @@ def generate_image_from_image(
             raise RuntimeError("No image generated from input")
         
         # Берем первую сгенерированную картинку
-        image_base64 = data["artifacts"][0]["base64"]
-        return f"data:image/png;base64,{image_base64}"
+        return base64.b64decode(data["artifacts"][0]["base64"])
         
-    except ImportError:
-        raise RuntimeError("requests library is required")
     except Exception as e:
         raise RuntimeError(f"Image-to-image generation failed: {str(e)}")
 
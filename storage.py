@@ -0,0 +1,1133 @@
+# storage.py
+"""
+Слой хранения: SQLite (права доступа, память чата, задачи картинок,
+рассылки) без веб-зависимостей — его импортируют и API, и бот.
+
+Схема догоняется при первом обращении к БД (db_session), а не при
+импорте: процесс бота или API стартует без лишней работы, а у
+нескольких процессов миграция всё равно выполняется один раз
+(BEGIN IMMEDIATE + PRAGMA user_version).
+"""
+import atexit
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import metrics
+import timing
+
+# =========================
+# SQLITE POOL
+# =========================
+DB_PATH = os.getenv("ACCESS_DB_PATH") or "access.db"
+
+# пул соединений: открываем файл один раз, дальше переиспользуем
+DB_POOL_SIZE = max(1, int(os.getenv("DB_POOL_SIZE") or "8"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS") or "5000")
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB") or "8192")
+DB_SYNCHRONOUS = (os.getenv("DB_SYNCHRONOUS") or "NORMAL").strip().upper()
+if DB_SYNCHRONOUS not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+    DB_SYNCHRONOUS = "NORMAL"
+
+_db_lock = threading.Lock()
+_db_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+_db_idle: List[sqlite3.Connection] = []  # свободные соединения, LIFO
+_db_closed = False
+# схема проверяется один раз на процесс, при первом обращении
+_db_ready = False
+_db_init_lock = threading.Lock()
+
+
+def _db_open() -> sqlite3.Connection:
+    con = sqlite3.connect(
+        DB_PATH,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,  # соединение ходит между потоками через пул
+        cached_statements=128,
+    )
+    con.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    # WAL: читатели не ждут писателя, fsync только на checkpoint;
+    # несколько процессов (воркеры gunicorn + бот) спокойно делят один файл
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    con.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+    con.execute("PRAGMA temp_store=MEMORY")
+    return con
+
+
+def _db_acquire() -> sqlite3.Connection:
+    if not _db_slots.acquire(timeout=DB_BUSY_TIMEOUT_MS / 1000):
+        raise sqlite3.OperationalError("database pool exhausted")
+    with _db_lock:
+        if _db_idle:
+            return _db_idle.pop()
+    try:
+        return _db_open()
+    except Exception:
+        _db_slots.release()
+        raise
+
+
+def _db_release(con: sqlite3.Connection) -> None:
+    try:
+        if con.in_transaction:
+            con.rollback()
+        with _db_lock:
+            if not _db_closed:
+                _db_idle.append(con)
+                con = None
+        if con is not None:
+            con.close()
+    finally:
+        _db_slots.release()
+
+
+DB_POOL_WAIT_SECONDS = metrics.histogram("db_pool_wait_seconds", "Time waiting for a pooled SQLite connection")
+DB_SESSION_SECONDS = metrics.histogram(
+    "db_session_seconds", "SQLite session duration including pool wait", ["mode"]
+)
+_DB_SESSION_READ = DB_SESSION_SECONDS.labels("read")
+_DB_SESSION_WRITE = DB_SESSION_SECONDS.labels("write")
+
+
+@contextmanager
+def db_session(write: bool = False) -> Iterator[sqlite3.Connection]:
+    """Соединение из пула. write=True — одна транзакция с commit/rollback."""
+    if not _db_ready:
+        db_init()
+    with _pooled(write) as con:
+        yield con
+
+
+@contextmanager
+def _pooled(write: bool) -> Iterator[sqlite3.Connection]:
+    t0 = time.perf_counter()
+    con = _db_acquire()
+    DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - t0)
+    try:
+        if write:
+            with con:
+                yield con
+        else:
+            yield con
+    finally:
+        _db_release(con)
+        (_DB_SESSION_WRITE if write else _DB_SESSION_READ).observe(time.perf_counter() - t0)
+
+
+def db_close() -> None:
+    """Закрывает все свободные соединения (занятые закроются при возврате)."""
+    global _db_closed
+    with _db_lock:
+        _db_closed = True
+        idle = list(_db_idle)
+        _db_idle.clear()
+    for con in idle:
+        try:
+            con.close()
+        except Exception:
+            pass
+
+
+def _db_after_fork() -> None:
+    """В дочернем процессе соединения родителя не трогаем (SQLite это запрещает) — пул с нуля."""
+    global _db_lock, _db_slots, _db_idle, _db_init_lock
+    _db_lock = threading.Lock()
+    _db_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+    _db_idle = []
+    _db_init_lock = threading.Lock()
+
+
+atexit.register(db_close)
+os.register_at_fork(after_in_child=_db_after_fork)
+
+
+# --- миграции схемы: версия хранится в PRAGMA user_version ---
+def _table_columns(con: sqlite3.Connection, table: str) -> set:
+    return {row[1] for row in con.execute(f"PRAGMA table_info({table})")}
+
+
+def _m1_base_tables(con: sqlite3.Connection) -> None:
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS access (
+            user_id INTEGER PRIMARY KEY,
+            is_free INTEGER DEFAULT 0,
+            is_blocked INTEGER DEFAULT 0,
+            updated_at TEXT,
+            last_menu_chat_id INTEGER,
+            last_menu_message_id INTEGER
+        )
+        """
+    )
+    # ✅ память чата
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS chat_memory (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            role TEXT NOT NULL,               -- "user" | "assistant"
+            text TEXT NOT NULL,
+            created_at TEXT
+        )
+        """
+    )
+
+
+def _m2_menu_columns(con: sqlite3.Connection) -> None:
+    """Старые базы создавались без колонок меню."""
+    cols = _table_columns(con, "access")
+    if "last_menu_chat_id" not in cols:
+        con.execute("ALTER TABLE access ADD COLUMN last_menu_chat_id INTEGER")
+    if "last_menu_message_id" not in cols:
+        con.execute("ALTER TABLE access ADD COLUMN last_menu_message_id INTEGER")
+
+
+def _m3_chat_memory_index(con: sqlite3.Connection) -> None:
+    # mem_get / mem_clear / компакция идут по (user_id, id)
+    con.execute("CREATE INDEX IF NOT EXISTS idx_chat_memory_user_id ON chat_memory (user_id, id)")
+
+
+def _m4_image_jobs(con: sqlite3.Connection) -> None:
+    # статусы задач генерации: общие для всех воркеров, поэтому в БД
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS image_jobs (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,             -- queued | running | done | error
+            mode TEXT,
+            result TEXT,                      -- JSON ответа (как у /api/image)
+            http_status INTEGER,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL
+        )
+        """
+    )
+    con.execute("CREATE INDEX IF NOT EXISTS idx_image_jobs_user_status ON image_jobs (user_id, status)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_image_jobs_created ON image_jobs (created_at)")
+
+
+def _m5_broadcasts(con: sqlite3.Connection) -> None:
+    # рассылки: очередь получателей в БД, чтобы пережить рестарт и делиться между процессами
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,               -- menu | text
+            text TEXT,
+            status TEXT NOT NULL,             -- running | done | cancelled
+            total INTEGER NOT NULL,
+            report_chat_id INTEGER,
+            report_message_id INTEGER,
+            created_at REAL NOT NULL,
+            finished_at REAL
+        )
+        """
+    )
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            broadcast_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',  -- pending | sending | sent | failed
+            attempts INTEGER NOT NULL DEFAULT 0,
+            claimed_at REAL,
+            error TEXT,
+            PRIMARY KEY (broadcast_id, user_id)
+        ) WITHOUT ROWID
+        """
+    )
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_status ON broadcast_recipients (broadcast_id, status)"
+    )
+
+
+def _m6_telegram_updates(con: sqlite3.Connection) -> None:
+    # апдейты webhook: общая очередь и дедупликация update_id для всех воркеров
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS telegram_updates (
+            update_id INTEGER PRIMARY KEY,
+            payload TEXT,                     -- JSON апдейта; после обработки NULL
+            status TEXT NOT NULL,             -- pending | processing | done
+            received_at REAL NOT NULL,
+            finished_at REAL
+        )
+        """
+    )
+    con.execute("CREATE INDEX IF NOT EXISTS idx_telegram_updates_status ON telegram_updates (status, update_id)")
+
+
+def _m7_access_generation(con: sqlite3.Connection) -> None:
+    # счётчик изменений прав: по нему кэши доступа в других процессах узнают, что устарели
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS access_generation (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            gen INTEGER NOT NULL
+        )
+        """
+    )
+    con.execute("INSERT OR IGNORE INTO access_generation (id, gen) VALUES (1, 0)")
+
+
+SCHEMA_MIGRATIONS = [
+    (1, _m1_base_tables),
+    (2, _m2_menu_columns),
+    (3, _m3_chat_memory_index),
+    (4, _m4_image_jobs),
+    (5, _m5_broadcasts),
+    (6, _m6_telegram_updates),
+    (7, _m7_access_generation),
+]
+
+
+def db_migrate() -> int:
+    """Догоняет схему до последней версии. Безопасно при параллельном старте процессов."""
+    with _pooled(False) as con:
+        # IMMEDIATE: второй процесс подождёт и увидит уже новую версию
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            version = con.execute("PRAGMA user_version").fetchone()[0]
+            for target, migrate in SCHEMA_MIGRATIONS:
+                if target > version:
+                    migrate(con)
+                    con.execute(f"PRAGMA user_version={target}")
+                    version = target
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+    return version
+
+
+def db_init():
+    global _db_ready
+    with _db_init_lock:
+        if not _db_ready:
+            db_migrate()
+            _db_ready = True
+
+
+def _now_str() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+# SQL держим константами: sqlite3 кэширует подготовленные запросы по тексту
+_SQL_SET_FREE = """
+    INSERT INTO access (user_id, is_free, is_blocked, updated_at)
+    VALUES (?, ?, COALESCE((SELECT is_blocked FROM access WHERE user_id=?), 0), ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        is_free=excluded.is_free,
+        updated_at=excluded.updated_at
+"""
+
+_SQL_SET_BLOCKED = """
+    INSERT INTO access (user_id, is_free, is_blocked, updated_at)
+    VALUES (?, COALESCE((SELECT is_free FROM access WHERE user_id=?), 0), ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        is_blocked=excluded.is_blocked,
+        updated_at=excluded.updated_at
+"""
+
+_SQL_GET_ACCESS = (
+    "SELECT is_free, is_blocked, updated_at, last_menu_chat_id, last_menu_message_id "
+    "FROM access WHERE user_id=?"
+)
+
+_SQL_SET_LAST_MENU = """
+    INSERT INTO access (user_id, is_free, is_blocked, updated_at, last_menu_chat_id, last_menu_message_id)
+    VALUES (?, COALESCE((SELECT is_free FROM access WHERE user_id=?), 0),
+            COALESCE((SELECT is_blocked FROM access WHERE user_id=?), 0),
+            ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        last_menu_chat_id=excluded.last_menu_chat_id,
+        last_menu_message_id=excluded.last_menu_message_id,
+        updated_at=excluded.updated_at
+"""
+
+_SQL_CLEAR_LAST_MENU = """
+    UPDATE access
+    SET last_menu_chat_id=NULL, last_menu_message_id=NULL, updated_at=?
+    WHERE user_id=?
+"""
+
+_SQL_GET_ACCESS_GEN = "SELECT gen FROM access_generation WHERE id=1"
+_SQL_BUMP_ACCESS_GEN = "UPDATE access_generation SET gen = gen + 1 WHERE id=1 RETURNING gen"
+
+_SQL_MEM_ADD = "INSERT INTO chat_memory (user_id, role, text, created_at) VALUES (?, ?, ?, ?)"
+
+_SQL_MEM_GET = """
+    SELECT role, text
+    FROM chat_memory
+    WHERE user_id=?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+
+_SQL_MEM_CLEAR = "DELETE FROM chat_memory WHERE user_id=?"
+
+
+# =========================
+# ACCESS CACHE (read-through)
+# =========================
+ACCESS_CACHE_SIZE = int(os.getenv("ACCESS_CACHE_SIZE") or "10000")
+ACCESS_CACHE_TTL = float(os.getenv("ACCESS_CACHE_TTL") or "30")
+# как часто сверять счётчик изменений прав в БД (изменения из других процессов), с
+ACCESS_CACHE_SYNC = float(os.getenv("ACCESS_CACHE_SYNC") or "1")
+
+
+class _AccessCache:
+    """
+    LRU + TTL кэш строк access. Запись в access сразу делает invalidate(),
+    а права (is_free/is_blocked) ещё и увеличивают access_generation в БД:
+    кэш другого процесса, увидев новый счётчик, сбрасывается целиком.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[int, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._gen = 0  # растёт при каждой инвалидации — защита от гонки чтение/запись
+        self._db_gen: Optional[int] = None  # последний увиденный access_generation
+        self._sync_at = 0.0
+        self.resets = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(user_id)
+            if item is not None and item[0] > now:
+                self._data.move_to_end(user_id)
+                self.hits += 1
+                return item[1]
+            if item is not None:
+                del self._data[user_id]
+            self.misses += 1
+            return None
+
+    def generation(self) -> int:
+        return self._gen
+
+    def sync_due(self) -> bool:
+        return time.monotonic() >= self._sync_at
+
+    def sync(self, db_gen: int) -> None:
+        """Счётчик из БД: изменился — права менял другой процесс, кэш сбрасываем."""
+        with self._lock:
+            self._sync_at = time.monotonic() + ACCESS_CACHE_SYNC
+            if self._db_gen is not None and db_gen != self._db_gen:
+                self._gen += 1
+                self._data.clear()
+                self.resets += 1
+            self._db_gen = db_gen
+
+    def note_own_write(self, db_gen: int) -> None:
+        """Счётчик увеличили мы сами (и уже сделали invalidate) — сбрасывать весь кэш незачем."""
+        with self._lock:
+            if self._db_gen == db_gen - 1:
+                self._db_gen = db_gen
+
+    def put(self, user_id: int, value: Dict[str, Any], gen: int) -> None:
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            # пока мы читали из БД, кто-то записал — не кладём устаревшее
+            if gen != self._gen:
+                return
+            self._data[user_id] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._gen += 1
+            self._data.pop(user_id, None)
+
+    def invalidate_many(self, user_ids: List[int]) -> None:
+        with self._lock:
+            self._gen += 1
+            for user_id in user_ids:
+                self._data.pop(user_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._gen += 1
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "resets": self.resets,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+_access_cache = _AccessCache(ACCESS_CACHE_SIZE, ACCESS_CACHE_TTL)
+
+
+def access_cache_stats() -> Dict[str, Any]:
+    return _access_cache.stats()
+
+
+def _sync_access_cache() -> None:
+    if not _access_cache.sync_due():
+        return
+    with db_session() as con:
+        row = con.execute(_SQL_GET_ACCESS_GEN).fetchone()
+    _access_cache.sync(row[0] if row else 0)
+
+
+def _bump_access_generation(con: sqlite3.Connection) -> int:
+    """В той же транзакции, что и изменение прав."""
+    return con.execute(_SQL_BUMP_ACCESS_GEN).fetchone()[0]
+
+
+metrics.gauge("db_pool_idle", "Idle pooled SQLite connections").set_function(lambda: len(_db_idle))
+metrics.gauge("access_cache_entries", "Entries in the access cache").set_function(lambda: access_cache_stats()["size"])
+
+
+# =========================
+# ACCESS (как было)
+# =========================
+def set_free(user_id: int, value: bool) -> None:
+    with db_session(write=True) as con:
+        con.execute(_SQL_SET_FREE, (user_id, 1 if value else 0, user_id, _now_str()))
+        gen = _bump_access_generation(con)
+    _access_cache.invalidate(user_id)
+    _access_cache.note_own_write(gen)
+
+
+def set_blocked(user_id: int, value: bool) -> None:
+    with db_session(write=True) as con:
+        con.execute(_SQL_SET_BLOCKED, (user_id, user_id, 1 if value else 0, _now_str()))
+        gen = _bump_access_generation(con)
+    _access_cache.invalidate(user_id)
+    _access_cache.note_own_write(gen)
+
+
+def get_access(user_id: int) -> Dict[str, Any]:
+    _sync_access_cache()
+    cached = _access_cache.get(user_id)
+    if cached is not None:
+        return dict(cached)  # копия: вызывающий код не должен портить кэш
+    gen = _access_cache.generation()
+    with timing.span("access_db"):
+        a = _get_access_db(user_id)
+    _access_cache.put(user_id, a, gen)
+    return dict(a)
+
+
+def peek_access(user_id: int) -> Optional[Dict[str, Any]]:
+    """Только из кэша, без обращения к БД (None — в кэше нет или пора сверить счётчик изменений)."""
+    if _access_cache.sync_due():
+        return None
+    cached = _access_cache.get(user_id)
+    return dict(cached) if cached is not None else None
+
+
+def _get_access_db(user_id: int) -> Dict[str, Any]:
+    with db_session() as con:
+        row = con.execute(_SQL_GET_ACCESS, (user_id,)).fetchone()
+    if not row:
+        return {
+            "user_id": user_id,
+            "is_free": False,
+            "is_blocked": False,
+            "updated_at": None,
+            "last_menu_chat_id": None,
+            "last_menu_message_id": None,
+        }
+    return {
+        "user_id": user_id,
+        "is_free": bool(row[0]),
+        "is_blocked": bool(row[1]),
+        "updated_at": row[2],
+        "last_menu_chat_id": row[3],
+        "last_menu_message_id": row[4],
+    }
+
+
+def set_last_menu(user_id: int, chat_id: int, message_id: int) -> None:
+    with db_session(write=True) as con:
+        con.execute(_SQL_SET_LAST_MENU, (user_id, user_id, user_id, _now_str(), chat_id, message_id))
+    _access_cache.invalidate(user_id)
+
+
+def clear_last_menu(user_id: int) -> None:
+    with db_session(write=True) as con:
+        con.execute(_SQL_CLEAR_LAST_MENU, (_now_str(), user_id))
+    _access_cache.invalidate(user_id)
+
+
+def get_last_menu(user_id: int) -> Tuple[Optional[int], Optional[int]]:
+    a = get_access(user_id)
+    return a.get("last_menu_chat_id"), a.get("last_menu_message_id")
+
+
+# =========================
+# ✅ ACCESS: массовые изменения
+# =========================
+def _unique_ids(user_ids: List[int]) -> List[int]:
+    return [uid for uid in dict.fromkeys(user_ids) if uid]
+
+
+def set_free_many(user_ids: List[int], value: bool) -> int:
+    """Как set_free, но для списка — одной транзакцией. Возвращает число пользователей."""
+    ids = _unique_ids(user_ids)
+    now = _now_str()
+    v = 1 if value else 0
+    with db_session(write=True) as con:
+        con.executemany(_SQL_SET_FREE, [(uid, v, uid, now) for uid in ids])
+        gen = _bump_access_generation(con)
+    _access_cache.invalidate_many(ids)
+    _access_cache.note_own_write(gen)
+    return len(ids)
+
+
+def set_blocked_many(user_ids: List[int], value: bool) -> int:
+    ids = _unique_ids(user_ids)
+    now = _now_str()
+    v = 1 if value else 0
+    with db_session(write=True) as con:
+        con.executemany(_SQL_SET_BLOCKED, [(uid, uid, v, now) for uid in ids])
+        gen = _bump_access_generation(con)
+    _access_cache.invalidate_many(ids)
+    _access_cache.note_own_write(gen)
+    return len(ids)
+
+
+def list_user_ids(include_blocked: bool = False) -> List[int]:
+    """Все известные пользователи (для рассылки)."""
+    sql = "SELECT user_id FROM access" + ("" if include_blocked else " WHERE is_blocked=0")
+    with db_session() as con:
+        return [row[0] for row in con.execute(sql + " ORDER BY user_id")]
+
+
+# =========================
+# ✅ MEMORY (новое)
+# =========================
+def mem_add(user_id: int, role: str, text: str) -> None:
+    with timing.span("mem_add"), db_session(write=True) as con:
+        con.execute(_SQL_MEM_ADD, (user_id, role, text, _now_str()))
+
+
+def mem_get(user_id: int, limit: int = 24) -> List[Dict[str, str]]:
+    with timing.span("mem_get"), db_session() as con:
+        rows = con.execute(_SQL_MEM_GET, (user_id, limit)).fetchall()
+    rows.reverse()  # в правильный порядок (старые -> новые)
+    out = []
+    for r in rows:
+        out.append({"role": r[0], "text": r[1]})
+    return out
+
+
+def mem_clear(user_id: int) -> None:
+    with db_session(write=True) as con:
+        con.execute(_SQL_MEM_CLEAR, (user_id,))
+
+
+# =========================
+# MEMORY RETENTION (компакция)
+# =========================
+MEMORY_MAX_ROWS_PER_USER = int(os.getenv("MEMORY_MAX_ROWS_PER_USER") or "200")
+MEMORY_MAX_AGE_DAYS = int(os.getenv("MEMORY_MAX_AGE_DAYS") or "90")
+MEMORY_COMPACT_BATCH = int(os.getenv("MEMORY_COMPACT_BATCH") or "500")
+MEMORY_COMPACT_INTERVAL = float(os.getenv("MEMORY_COMPACT_INTERVAL") or "3600")
+MEMORY_COMPACT_PAUSE = 0.05  # пауза между пачками — отдаём замок записи другим
+
+# id растут со временем, поэтому просроченные строки — это префикс таблицы:
+# смотрим только на batch самых старых строк
+_SQL_MEM_EXPIRE = """
+    DELETE FROM chat_memory
+    WHERE id IN (SELECT id FROM chat_memory ORDER BY id LIMIT ?)
+      AND created_at < ?
+"""
+
+_SQL_MEM_OVER_CAP = """
+    SELECT user_id, COUNT(*) FROM chat_memory
+    GROUP BY user_id
+    HAVING COUNT(*) > ?
+"""
+
+_SQL_MEM_TRIM_USER = """
+    DELETE FROM chat_memory
+    WHERE id IN (SELECT id FROM chat_memory WHERE user_id=? ORDER BY id LIMIT ?)
+"""
+
+
+def mem_compact(max_seconds: Optional[float] = None) -> Dict[str, int]:
+    """
+    Удаляет старые сообщения (старше MEMORY_MAX_AGE_DAYS) и лишние сверх
+    MEMORY_MAX_ROWS_PER_USER на пользователя. Работает пачками по
+    MEMORY_COMPACT_BATCH строк, каждая пачка — своя короткая транзакция.
+    """
+    deadline = time.monotonic() + max_seconds if max_seconds else None
+    expired = trimmed = 0
+
+    def out_of_time() -> bool:
+        return deadline is not None and time.monotonic() >= deadline
+
+    if MEMORY_MAX_AGE_DAYS > 0:
+        cutoff = (datetime.now() - timedelta(days=MEMORY_MAX_AGE_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+        while not out_of_time():
+            with db_session(write=True) as con:
+                n = con.execute(_SQL_MEM_EXPIRE, (MEMORY_COMPACT_BATCH, cutoff)).rowcount
+            expired += n
+            if n < MEMORY_COMPACT_BATCH:
+                break
+            time.sleep(MEMORY_COMPACT_PAUSE)
+
+    if MEMORY_MAX_ROWS_PER_USER > 0 and not out_of_time():
+        with db_session() as con:
+            over = con.execute(_SQL_MEM_OVER_CAP, (MEMORY_MAX_ROWS_PER_USER,)).fetchall()
+        for user_id, count in over:
+            excess = count - MEMORY_MAX_ROWS_PER_USER
+            while excess > 0 and not out_of_time():
+                with db_session(write=True) as con:
+                    n = con.execute(_SQL_MEM_TRIM_USER, (user_id, min(excess, MEMORY_COMPACT_BATCH))).rowcount
+                trimmed += n
+                excess -= n
+                if n == 0:
+                    break
+                time.sleep(MEMORY_COMPACT_PAUSE)
+
+    return {"expired": expired, "trimmed": trimmed}
+
+
+# компактор запускается в каждом процессе (main.py, воркеры gunicorn), работает один — владелец замка
+MEMORY_COMPACT_LOCK_PATH = os.getenv("MEMORY_COMPACT_LOCK_PATH") or (DB_PATH + ".compact.lock")
+
+_compactor_thread: Optional[threading.Thread] = None
+_compact_lock_fd: Optional[int] = None
+
+
+def _hold_compactor_lock() -> bool:
+    """Этот процесс — единственный компактор? Замок держим до конца процесса."""
+    global _compact_lock_fd
+    if _compact_lock_fd is not None:
+        return True
+    fd = os.open(MEMORY_COMPACT_LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return False
+    _compact_lock_fd = fd
+    return True
+
+
+def _compactor_after_fork() -> None:
+    # flock наследуется через общий файл — ребёнок компактором не считается
+    global _compact_lock_fd, _compactor_thread
+    if _compact_lock_fd is not None:
+        os.close(_compact_lock_fd)
+    _compact_lock_fd = None
+    _compactor_thread = None
+
+
+os.register_at_fork(after_in_child=_compactor_after_fork)
+
+
+def start_memory_compactor() -> None:
+    """
+    Фоновая компакция раз в MEMORY_COMPACT_INTERVAL секунд (0 — выключено).
+    Безопасно звать в каждом процессе: компактит только взявший замок, остальные
+    раз в минуту проверяют, не освободился ли он (владелец завершился).
+    """
+    global _compactor_thread
+    if MEMORY_COMPACT_INTERVAL <= 0 or (_compactor_thread and _compactor_thread.is_alive()):
+        return
+
+    def loop():
+        while True:
+            if not _hold_compactor_lock():
+                time.sleep(min(MEMORY_COMPACT_INTERVAL, 60))
+                continue
+            try:
+                res = mem_compact(max_seconds=60)
+                res["jobs_expired"] = job_expire()
+                if any(res.values()):
+                    print(f"🧹 compaction: {res}")
+            except Exception as e:
+                print("COMPACT ERROR:", e)
+            time.sleep(min(MEMORY_COMPACT_INTERVAL, IMAGE_JOB_TTL))
+
+    _compactor_thread = threading.Thread(target=loop, name="memory-compactor", daemon=True)
+    _compactor_thread.start()
+
+
+# =========================
+# IMAGE JOBS (статусы в БД)
+# =========================
+IMAGE_JOB_TTL = float(os.getenv("IMAGE_JOB_TTL") or "3600")
+
+_SQL_JOB_ACTIVE = """
+    SELECT COUNT(*) FROM image_jobs
+    WHERE user_id=? AND status IN ('queued', 'running') AND created_at > ?
+"""
+
+_SQL_JOB_INSERT = "INSERT INTO image_jobs (id, user_id, status, mode, created_at) VALUES (?, ?, 'queued', ?, ?)"
+
+_SQL_JOB_GET = """
+    SELECT id, user_id, status, mode, result, http_status, created_at, started_at, finished_at
+    FROM image_jobs WHERE id=?
+"""
+
+_SQL_JOB_START = "UPDATE image_jobs SET status='running', started_at=? WHERE id=?"
+
+_SQL_JOB_FINISH = "UPDATE image_jobs SET status=?, result=?, http_status=?, finished_at=? WHERE id=?"
+
+_SQL_JOB_DELETE = "DELETE FROM image_jobs WHERE id=?"
+
+_SQL_JOB_FAIL_STALE = """
+    UPDATE image_jobs SET status='error', result=?, http_status=500, finished_at=?
+    WHERE status IN ('queued', 'running')
+"""
+
+_SQL_JOB_EXPIRE = """
+    DELETE FROM image_jobs
+    WHERE id IN (SELECT id FROM image_jobs WHERE created_at < ? LIMIT ?)
+"""
+
+
+def job_create(job_id: str, user_id: int, mode: str, per_user_limit: int) -> bool:
+    """Создаёт задачу, если у пользователя меньше per_user_limit активных. Атомарно между процессами."""
+    now = time.time()
+    with db_session() as con:
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            active = con.execute(_SQL_JOB_ACTIVE, (user_id, now - IMAGE_JOB_TTL)).fetchone()[0]
+            if active >= per_user_limit:
+                con.rollback()
+                return False
+            con.execute(_SQL_JOB_INSERT, (job_id, user_id, mode, now))
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+    return True
+
+
+def job_start(job_id: str) -> None:
+    with db_session(write=True) as con:
+        con.execute(_SQL_JOB_START, (time.time(), job_id))
+
+
+def job_finish(job_id: str, result: Dict[str, Any], http_status: int) -> None:
+    status = "done" if http_status == 200 else "error"
+    with db_session(write=True) as con:
+        con.execute(
+            _SQL_JOB_FINISH,
+            (status, json.dumps(result, ensure_ascii=False), http_status, time.time(), job_id),
+        )
+
+
+def job_delete(job_id: str) -> None:
+    with db_session(write=True) as con:
+        con.execute(_SQL_JOB_DELETE, (job_id,))
+
+
+def job_get(job_id: str, user_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """user_id — вернуть задачу, только если она этого пользователя."""
+    with db_session() as con:
+        row = con.execute(_SQL_JOB_GET, (job_id,)).fetchone()
+    if row and user_id is not None and row[1] != user_id:
+        return None
+    if not row:
+        return None
+    return {
+        "job_id": row[0],
+        "user_id": row[1],
+        "status": row[2],
+        "mode": row[3],
+        "result": json.loads(row[4]) if row[4] else None,
+        "http_status": row[5],
+        "created_at": row[6],
+        "started_at": row[7],
+        "finished_at": row[8],
+    }
+
+
+def job_fail_stale() -> int:
+    """
+    При старте API: задачи queued/running остались от прошлого запуска — очереди
+    в памяти больше нет, никто их не доделает. Помечаем ошибкой, чтобы опрос
+    получил ответ, а лимит активных задач пользователя освободился.
+    """
+    body = json.dumps({"error": "generation_interrupted"})
+    with db_session(write=True) as con:
+        return con.execute(_SQL_JOB_FAIL_STALE, (body, time.time())).rowcount
+
+
+def job_expire(batch: int = 500) -> int:
+    """Удаляет задачи старше IMAGE_JOB_TTL (и зависшие после падения процесса)."""
+    cutoff = time.time() - IMAGE_JOB_TTL
+    total = 0
+    while True:
+        with db_session(write=True) as con:
+            n = con.execute(_SQL_JOB_EXPIRE, (cutoff, batch)).rowcount
+        total += n
+        if n < batch:
+            return total
+        time.sleep(MEMORY_COMPACT_PAUSE)
+
+
+# =========================
+# ✅ BROADCASTS (очередь рассылок)
+# =========================
+# получатель "sending" дольше аренды — процесс умер посреди пачки, берём заново
+BROADCAST_LEASE = float(os.getenv("BROADCAST_LEASE") or "120")
+
+_SQL_BROADCAST_INSERT = """
+    INSERT INTO broadcasts (kind, text, status, total, report_chat_id, created_at)
+    VALUES (?, ?, 'running', ?, ?, ?)
+"""
+
+_SQL_BROADCAST_RECIPIENT_INSERT = (
+    "INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, user_id) VALUES (?, ?)"
+)
+
+_SQL_BROADCAST_SELECT = (
+    "SELECT id, kind, text, status, total, report_chat_id, report_message_id, created_at, finished_at "
+    "FROM broadcasts "
+)
+
+_SQL_BROADCAST_GET = _SQL_BROADCAST_SELECT + "WHERE id=?"
+
+# меню одному пользователю (/free, /block...) не ждёт конца массовой рассылки
+_SQL_BROADCAST_ACTIVE = _SQL_BROADCAST_SELECT + "WHERE status='running' ORDER BY total > 1, id"
+
+_SQL_BROADCAST_RECENT = _SQL_BROADCAST_SELECT + "ORDER BY id DESC LIMIT ?"
+
+_SQL_BROADCAST_CLAIMABLE = """
+    SELECT user_id, attempts FROM broadcast_recipients
+    WHERE broadcast_id=? AND (status='pending' OR (status='sending' AND claimed_at < ?))
+    LIMIT ?
+"""
+
+_SQL_BROADCAST_CLAIM = """
+    UPDATE broadcast_recipients SET status='sending', claimed_at=?, attempts=attempts+1
+    WHERE broadcast_id=? AND user_id=?
+"""
+
+_SQL_BROADCAST_MARK = """
+    UPDATE broadcast_recipients SET status=?, error=?, attempts=attempts-?
+    WHERE broadcast_id=? AND user_id=?
+"""
+
+_SQL_BROADCAST_COUNTS = (
+    "SELECT status, COUNT(*) FROM broadcast_recipients WHERE broadcast_id=? GROUP BY status"
+)
+
+_SQL_BROADCAST_FINISH = """
+    UPDATE broadcasts SET status='done', finished_at=?
+    WHERE id=? AND status='running'
+      AND NOT EXISTS (
+          SELECT 1 FROM broadcast_recipients
+          WHERE broadcast_id=? AND status IN ('pending', 'sending')
+      )
+"""
+
+
+def _broadcast_row(row) -> Dict[str, Any]:
+    return {
+        "id": row[0],
+        "kind": row[1],
+        "text": row[2],
+        "status": row[3],
+        "total": row[4],
+        "report_chat_id": row[5],
+        "report_message_id": row[6],
+        "created_at": row[7],
+        "finished_at": row[8],
+    }
+
+
+def broadcast_create(kind: str, text: Optional[str], user_ids: List[int], report_chat_id: Optional[int]) -> int:
+    """Новая рассылка со списком получателей — одной транзакцией."""
+    ids = _unique_ids(user_ids)
+    with db_session(write=True) as con:
+        bid = con.execute(_SQL_BROADCAST_INSERT, (kind, text, len(ids), report_chat_id, time.time())).lastrowid
+        con.executemany(_SQL_BROADCAST_RECIPIENT_INSERT, [(bid, uid) for uid in ids])
+    return bid
+
+
+def broadcast_set_report(broadcast_id: int, message_id: int) -> None:
+    with db_session(write=True) as con:
+        con.execute("UPDATE broadcasts SET report_message_id=? WHERE id=?", (message_id, broadcast_id))
+
+
+def broadcast_get(broadcast_id: int) -> Optional[Dict[str, Any]]:
+    with db_session() as con:
+        row = con.execute(_SQL_BROADCAST_GET, (broadcast_id,)).fetchone()
+    return _broadcast_row(row) if row else None
+
+
+def broadcast_active() -> List[Dict[str, Any]]:
+    """Незавершённые рассылки, старые первыми (после рестарта продолжаем с них)."""
+    with db_session() as con:
+        rows = con.execute(_SQL_BROADCAST_ACTIVE).fetchall()
+    return [_broadcast_row(r) for r in rows]
+
+
+def broadcast_recent(limit: int = 5) -> List[Dict[str, Any]]:
+    with db_session() as con:
+        rows = con.execute(_SQL_BROADCAST_RECENT, (limit,)).fetchall()
+    return [_broadcast_row(r) for r in rows]
+
+
+def broadcast_claim(broadcast_id: int, limit: int) -> List[Tuple[int, int]]:
+    """Забирает пачку получателей под отправку: [(user_id, номер попытки)]. Атомарно между процессами."""
+    now = time.time()
+    with db_session() as con:
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            rows = con.execute(_SQL_BROADCAST_CLAIMABLE, (broadcast_id, now - BROADCAST_LEASE, limit)).fetchall()
+            con.executemany(_SQL_BROADCAST_CLAIM, [(now, broadcast_id, uid) for uid, _ in rows])
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+    return [(uid, attempts + 1) for uid, attempts in rows]
+
+
+def broadcast_mark(broadcast_id: int, results: List[Tuple[int, str, Optional[str], int]]) -> None:
+    """results: (user_id, status, error, вернуть попыток) — вернуть 1, если попытка не считается (flood wait)."""
+    with db_session(write=True) as con:
+        con.executemany(
+            _SQL_BROADCAST_MARK,
+            [(status, error, refund, broadcast_id, uid) for uid, status, error, refund in results],
+        )
+
+
+def broadcast_counts(broadcast_id: int) -> Dict[str, int]:
+    with db_session() as con:
+        counts = dict(con.execute(_SQL_BROADCAST_COUNTS, (broadcast_id,)).fetchall())
+    return {k: counts.get(k, 0) for k in ("pending", "sending", "sent", "failed")}
+
+
+def broadcast_try_finish(broadcast_id: int) -> bool:
+    """Помечает рассылку завершённой, если получателей не осталось. True — только одному процессу."""
+    with db_session(write=True) as con:
+        n = con.execute(_SQL_BROADCAST_FINISH, (time.time(), broadcast_id, broadcast_id)).rowcount
+    return n == 1
+
+
+def broadcast_cancel(broadcast_id: int) -> bool:
+    with db_session(write=True) as con:
+        n = con.execute(
+            "UPDATE broadcasts SET status='cancelled', finished_at=? WHERE id=? AND status='running'",
+            (time.time(), broadcast_id),
+        ).rowcount
+    return n == 1
+
+
+# =========================
+# ✅ TELEGRAM UPDATES (webhook)
+# =========================
+_SQL_UPDATE_EXISTS = "SELECT 1 FROM telegram_updates WHERE update_id=?"
+
+_SQL_UPDATE_PENDING = "SELECT COUNT(*) FROM telegram_updates WHERE status IN ('pending', 'processing')"
+
+_SQL_UPDATE_INSERT = (
+    "INSERT INTO telegram_updates (update_id, payload, status, received_at) VALUES (?, ?, 'pending', ?)"
+)
+
+_SQL_UPDATE_CLAIMABLE = """
+    SELECT update_id, payload, received_at FROM telegram_updates
+    WHERE status='pending' ORDER BY update_id LIMIT ?
+"""
+
+_SQL_UPDATE_CLAIM = "UPDATE telegram_updates SET status='processing' WHERE update_id=?"
+
+_SQL_UPDATE_FINISH = "UPDATE telegram_updates SET status='done', payload=NULL, finished_at=? WHERE update_id=?"
+
+_SQL_UPDATE_EXPIRE = """
+    DELETE FROM telegram_updates WHERE update_id IN (
+        SELECT update_id FROM telegram_updates WHERE status='done' AND finished_at < ? LIMIT ?
+    )
+"""
+
+
+def update_enqueue(update_id: int, payload: str, max_pending: int) -> str:
+    """accepted | duplicate | busy. update_id запоминается только у принятых — busy Telegram повторит."""
+    with db_session() as con:
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            if con.execute(_SQL_UPDATE_EXISTS, (update_id,)).fetchone():
+                result = "duplicate"
+            elif con.execute(_SQL_UPDATE_PENDING).fetchone()[0] >= max_pending:
+                result = "busy"
+            else:
+                con.execute(_SQL_UPDATE_INSERT, (update_id, payload, time.time()))
+                result = "accepted"
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+    return result
+
+
+def update_claim(limit: int) -> List[Tuple[int, str, float]]:
+    """Забирает до limit апдейтов в обработку: [(update_id, payload, received_at)], по порядку update_id."""
+    with db_session() as con:
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            rows = con.execute(_SQL_UPDATE_CLAIMABLE, (limit,)).fetchall()
+            con.executemany(_SQL_UPDATE_CLAIM, [(row[0],) for row in rows])
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+    return rows
+
+
+def update_finish(update_id: int) -> None:
+    with db_session(write=True) as con:
+        con.execute(_SQL_UPDATE_FINISH, (time.time(), update_id))
+
+
+def update_requeue_processing() -> int:
+    """Апдейты, которые обрабатывал упавший процесс бота, — снова в очередь (вызывает новый владелец)."""
+    with db_session(write=True) as con:
+        return con.execute("UPDATE telegram_updates SET status='pending' WHERE status='processing'").rowcount
+
+
+def update_pending_count() -> int:
+    with db_session() as con:
+        return con.execute(_SQL_UPDATE_PENDING).fetchone()[0]
+
+
+def update_expire(max_age: float, batch: int = 1000) -> int:
+    """Удаляет обработанные апдейты старше max_age секунд (до них дедупликация повторов)."""
+    cutoff = time.time() - max_age
+    deleted = 0
+    while True:
+        with db_session(write=True) as con:
+            n = con.execute(_SQL_UPDATE_EXPIRE, (cutoff, batch)).rowcount
+        deleted += n
+        if n < batch:
+            return deleted
@@ -0,0 +1,21 @@
+# tests/conftest.py
+"""
+Общая настройка: модули читают ENV при импорте, поэтому временная БД и
+фейковые токены выставляются до первого import из тестов.
+"""
+import os
+import sys
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+_TMP = tempfile.mkdtemp(prefix="instagroq_tests_")
+os.environ.update({
+    "ACCESS_DB_PATH": os.path.join(_TMP, "test.db"),
+    "IMAGE_STORE_DIR": os.path.join(_TMP, "images"),
+    "BOT_TOKEN": "123:test",
+    "GROQ_API_KEY": "test",
+    "TARGET_GROUP_ID": "",
+    "RATE_LIMITS": "chat=100000/1,image=100000/1",
+})
@@ -0,0 +1,88 @@
+# tests/test_broadcast.py
+import asyncio
+
+import pytest
+from telegram.error import Forbidden, NetworkError, RetryAfter
+
+import bot_broadcast
+import storage
+
+
+@pytest.fixture
+def db(monkeypatch, tmp_path):
+    monkeypatch.setattr(storage, "DB_PATH", str(tmp_path / "broadcast.db"))
+    monkeypatch.setattr(storage, "_db_idle", [])
+    monkeypatch.setattr(storage, "_db_ready", False)
+    monkeypatch.setattr(bot_broadcast, "pacer", bot_broadcast.SendPacer(10000, 0))
+    monkeypatch.setattr(bot_broadcast, "_last_progress", {})
+
+
+class FakeBot:
+    """send_message по сценарию: user_id -> список исключений/None на каждую попытку."""
+
+    def __init__(self, script=None):
+        self.script = script or {}
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        plan = self.script.get(chat_id) or []
+        err = plan.pop(0) if plan else None
+        if err is not None:
+            raise err
+        self.sent.append((chat_id, text))
+
+
+def _drain(bot, rounds=10):
+    async def run():
+        for _ in range(rounds):
+            if not await bot_broadcast._tick(bot):
+                return
+
+    asyncio.run(run())
+
+
+def test_claim_leases_recipients_until_expiry(db, monkeypatch):
+    bid = storage.broadcast_create("text", "hi", [1, 2, 3], None)
+    first = storage.broadcast_claim(bid, 2)
+    rest = storage.broadcast_claim(bid, 10)
+    assert len(first) == 2 and len(rest) == 1
+    assert {uid for uid, _ in first + rest} == {1, 2, 3}
+    assert all(attempt == 1 for _, attempt in first + rest)
+    # аренда ещё действует — второй процесс ничего не получит
+    assert storage.broadcast_claim(bid, 10) == []
+
+    # владелец аренды пропал: по истечении BROADCAST_LEASE получатели снова в работе
+    monkeypatch.setattr(storage, "BROADCAST_LEASE", -1)
+    assert sorted(storage.broadcast_claim(bid, 10)) == [(1, 2), (2, 2), (3, 2)]
+
+
+def test_retry_until_max_attempts_and_flood_wait_is_free(db, monkeypatch):
+    monkeypatch.setattr(bot_broadcast, "BROADCAST_MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(bot_broadcast.pacer, "pause", lambda seconds: None)
+    bot = FakeBot({
+        1: [NetworkError("boom")],  # со второй попытки дошло
+        2: [NetworkError("boom"), NetworkError("boom")],  # попытки кончились
+        3: [RetryAfter(1), RetryAfter(1), NetworkError("boom")],  # 429 попыткой не считается
+        4: [Forbidden("blocked")],  # повторять бессмысленно
+    })
+    bid = storage.broadcast_create("text", "hi", [1, 2, 3, 4], None)
+    _drain(bot)
+
+    assert storage.broadcast_counts(bid) == {"pending": 0, "sending": 0, "sent": 2, "failed": 2}
+    assert sorted(uid for uid, _ in bot.sent) == [1, 3]
+    assert storage.broadcast_get(bid)["status"] == "done"
+
+
+def test_single_recipient_goes_before_bulk(db):
+    bulk = storage.broadcast_create("text", "all", list(range(100, 200)), None)
+    single = storage.broadcast_create("menu", None, [7], None)
+    assert [b["id"] for b in storage.broadcast_active()] == [single, bulk]
+
+
+def test_admin_menu_push_is_a_single_recipient_job(db):
+    import bot_admin
+
+    asyncio.run(bot_admin._push_menu(type("Ctx", (), {"bot": FakeBot()})(), 42))
+    (b,) = storage.broadcast_active()
+    assert (b["kind"], b["total"], b["report_chat_id"]) == ("menu", 1, None)
+    assert storage.broadcast_claim(b["id"], 10) == [(42, 1)]
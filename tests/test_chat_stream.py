@@ -0,0 +1,147 @@
+# tests/test_chat_stream.py
+import json
+import threading
+import time
+
+import pytest
+
+import api
+import storage
+
+
+@pytest.fixture
+def stream(monkeypatch):
+    """Клиент /api/chat/stream с подменённым стримом Groq."""
+    monkeypatch.setattr(api, "_log_chat_turn", lambda ctx, reply: None)
+    monkeypatch.setattr(api, "send_log_to_group", lambda text: (True, "test"))
+    monkeypatch.setattr(api, "ask_groq_stream", lambda messages=None, **kw: iter(["При", "вет"]))
+    client = api.api.test_client()
+
+    def post(payload, headers=None):
+        return client.post("/api/chat/stream", json=payload, headers=headers or {})
+
+    return post
+
+
+def _events(body: bytes):
+    """SSE -> [(event, data)]; событие без имени — "message"."""
+    out = []
+    for block in body.decode("utf-8").split("\n\n"):
+        if not block.strip():
+            continue
+        event, data = "message", None
+        for line in block.split("\n"):
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                data = json.loads(line[len("data: "):])
+        out.append((event, data))
+    return out
+
+
+def test_failed_user_message_write_releases_slot(stream, monkeypatch):
+    uid = 3101
+    storage.set_free(uid, True)
+
+    def broken_mem_add(user_id, role, text):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(api, "mem_add", broken_mem_add)
+    r = stream({"tg_user_id": uid, "text": "сломанная запись"})
+    assert _events(r.data)[-1][0] == "error"
+    assert api.groq_gate.active == 0
+    # flight завершён — повтор не ждёт ушедшего ведущего, а выполняется сам
+    monkeypatch.undo()
+    monkeypatch.setattr(api, "_log_chat_turn", lambda ctx, reply: None)
+    monkeypatch.setattr(api, "ask_groq_stream", lambda messages=None, **kw: iter(["ок"]))
+    r = stream({"tg_user_id": uid, "text": "сломанная запись"})
+    assert _events(r.data)[-1] == ("done", {"reply": "ок"})
+
+
+def _run_with_follower(stream, monkeypatch, payload):
+    """Ведущий задерживается в _prepare_chat, пока копия не встанет в ожидание."""
+    started, release = threading.Event(), threading.Event()
+    real_prepare = api._prepare_chat
+
+    def slow_prepare(data):
+        started.set()
+        release.wait(5)
+        return real_prepare(data)
+
+    monkeypatch.setattr(api, "_prepare_chat", slow_prepare)
+    results = {}
+    coalesced = api.flights.stats()["coalesced"]
+    lead = threading.Thread(target=lambda: results.setdefault("lead", stream(payload)))
+    lead.start()
+    started.wait(5)
+    follower = threading.Thread(target=lambda: results.setdefault("follower", stream(payload)))
+    follower.start()
+    while api.flights.stats()["coalesced"] == coalesced:
+        time.sleep(0.01)
+    release.set()
+    lead.join(5)
+    follower.join(5)
+    return results["lead"], results["follower"]
+
+
+def test_follower_gets_leaders_rejection(stream, monkeypatch):
+    uid = 3201
+    storage.set_free(uid, False)
+    lead, follower = _run_with_follower(stream, monkeypatch, {"tg_user_id": uid, "text": "платно"})
+    assert lead.status_code == follower.status_code == 402
+    assert follower.get_json() == {"error": "payment_required"}
+    assert follower.headers["Idempotent-Replayed"] == "true"
+
+
+def test_follower_gets_busy_with_retry_after(stream, monkeypatch):
+    uid = 3202
+    storage.set_free(uid, True)
+    monkeypatch.setattr(api, "_acquire_groq_slot", lambda priority: False)
+    lead, follower = _run_with_follower(stream, monkeypatch, {"tg_user_id": uid, "text": "занято"})
+    assert lead.status_code == follower.status_code == 503
+    assert follower.get_json() == {"error": "upstream_busy"}
+    assert follower.headers["Retry-After"] == lead.headers["Retry-After"]
+
+
+def test_sse_framing(stream):
+    uid = 3301
+    storage.set_free(uid, True)
+    r = stream({"tg_user_id": uid, "text": "привет, стрим"})
+    assert r.status_code == 200
+    assert r.mimetype == "text/event-stream"
+    assert r.headers["Cache-Control"] == "no-cache"
+    body = r.data.decode("utf-8")
+    # каждое событие — строки "event:"/"data:" и пустая строка после
+    assert body.endswith("\n\n") and "\n\n\n" not in body
+    assert _events(r.data) == [
+        ("message", {"delta": "При"}),
+        ("message", {"delta": "вет"}),
+        ("done", {"reply": "Привет"}),
+    ]
+    assert [m["role"] for m in storage.mem_get(uid, limit=10)][-2:] == ["user", "assistant"]
+
+
+def test_client_disconnect_releases_slot(stream, monkeypatch):
+    uid = 3302
+    storage.set_free(uid, True)
+    upstream_closed = threading.Event()
+
+    def endless(messages=None, **kw):
+        try:
+            while True:
+                yield "слово "
+        finally:
+            upstream_closed.set()
+
+    monkeypatch.setattr(api, "ask_groq_stream", endless)
+    client = api.api.test_client()
+    r = client.post("/api/chat/stream", json={"tg_user_id": uid, "text": "ушёл"}, buffered=False)
+    chunks = iter(r.response)
+    assert b"delta" in next(chunks)
+    assert api.groq_gate.active == 1
+    r.close()  # клиент оборвал соединение
+
+    assert api.groq_gate.active == 0
+    assert upstream_closed.wait(2)
+    # недочитанный ответ в память не пишется
+    assert [m["role"] for m in storage.mem_get(uid, limit=10)] == ["user"]
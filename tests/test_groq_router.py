@@ -0,0 +1,209 @@
+# tests/test_groq_router.py
+import threading
+import time
+from types import SimpleNamespace
+
+import groq
+import httpx
+import pytest
+
+import groq_router
+from groq_router import CLOSED, HALF_OPEN, OPEN, GroqRouter, HedgeCancelled
+from rate_limit import UpstreamBusy
+
+
+def _timeout_error():
+    return groq.APITimeoutError(request=httpx.Request("POST", "https://api.groq.com/"))
+
+
+@pytest.fixture
+def router(monkeypatch):
+    monkeypatch.setattr(groq_router, "GROQ_BREAKER_FAILURES", 2)
+    monkeypatch.setattr(groq_router, "GROQ_BREAKER_COOLDOWN", 0.2)
+    monkeypatch.setattr(groq_router, "GROQ_BREAKER_COOLDOWN_MAX", 1.0)
+    monkeypatch.setattr(groq_router, "GROQ_LATENCY_MIN_SAMPLES", 5)
+    return GroqRouter(["key-a", "key-b"], ["model-1"])
+
+
+def _fail(router, ep, times=1):
+    for _ in range(times):
+        router.pick("complete", {e.name for e in router.endpoints if e is not ep})
+        router.on_failure(ep, "server_error")
+
+
+def test_breaker_opens_after_consecutive_failures(router):
+    ep = router.endpoints[0]
+    _fail(router, ep)
+    assert ep.state == CLOSED
+    _fail(router, ep)
+    assert ep.state == OPEN
+    # разомкнутая точка не выбирается, пока есть другая
+    assert router.pick("complete", set()) is router.endpoints[1]
+
+
+def test_half_open_trial_closes_or_reopens(router):
+    ep = router.endpoints[0]
+    only_ep = {router.endpoints[1].name}
+    _fail(router, ep, 2)
+    with pytest.raises(UpstreamBusy):
+        router.pick("complete", only_ep)
+
+    time.sleep(0.25)
+    assert router.pick("complete", only_ep) is ep
+    assert ep.state == HALF_OPEN
+    # пока идёт проба, второй запрос на точку не пускаем
+    with pytest.raises(UpstreamBusy):
+        router.pick("complete", only_ep)
+    # проба неудачна — снова разомкнута, пауза удвоена
+    router.on_failure(ep, "timeout")
+    assert ep.state == OPEN and ep.cooldown == pytest.approx(0.4)
+
+    time.sleep(0.45)
+    assert router.pick("complete", only_ep) is ep
+    router.on_success(ep, "complete", 0.1)
+    assert ep.state == CLOSED and ep.cooldown == pytest.approx(0.2)
+
+
+def test_client_error_does_not_open_breaker(router):
+    ep = router.endpoints[0]
+    for _ in range(5):
+        router.pick("complete", set())
+        router.on_failure(ep, "client_error")
+    assert ep.state == CLOSED
+
+
+def test_timeout_is_max_until_enough_samples(router):
+    ep = router.endpoints[0]
+    assert router.timeout("model-1", "complete") == groq_router.GROQ_TIMEOUT_MAX
+    for _ in range(4):
+        router.pick("complete", set())
+        router.on_success(ep, "complete", 0.5)
+    assert router.timeout("model-1", "complete") == groq_router.GROQ_TIMEOUT_MAX
+
+
+def test_timeout_follows_p99_within_bounds(router, monkeypatch):
+    monkeypatch.setattr(groq_router, "GROQ_TIMEOUT_MIN", 1.0)
+    monkeypatch.setattr(groq_router, "GROQ_TIMEOUT_MAX", 10.0)
+    monkeypatch.setattr(groq_router, "GROQ_TIMEOUT_FACTOR", 3.0)
+    window = router.windows[("model-1", "complete")]
+    for _ in range(10):
+        window.add(2.0)
+    assert router.timeout("model-1", "complete") == pytest.approx(6.0)
+    window.add(50.0)
+    assert router.timeout("model-1", "complete") == 10.0
+    # стрим считается отдельно — замеров нет, таймаут максимальный
+    assert router.timeout("model-1", "stream") == 10.0
+
+
+def test_timeout_fails_over_to_another_endpoint(router):
+    seen = []
+
+    def call(ep):
+        seen.append(ep.name)
+        if len(seen) == 1:
+            raise _timeout_error()
+        return "ok"
+
+    result, ep = router.run("complete", call)
+    assert result == "ok"
+    assert seen == ["k1:model-1", "k2:model-1"] or seen == ["k2:model-1", "k1:model-1"]
+    assert router.endpoints[0].timeouts + router.endpoints[1].timeouts == 1
+
+
+@pytest.fixture
+def hedging(router, monkeypatch):
+    monkeypatch.setattr(groq_router, "GROQ_HEDGE", True)
+    window = router.windows[("model-1", "complete")]
+    for _ in range(10):
+        window.add(0.05)
+    return router
+
+
+def test_hedge_takes_over_failed_primary_on_calling_thread(hedging):
+    caller = threading.current_thread()
+    threads = {}
+    release = threading.Event()
+
+    def call(ep):
+        first = not threads
+        threads.setdefault(ep.name, threading.current_thread())
+        if first:
+            # основная зависла дольше порога дубля и в итоге оборвалась
+            release.wait(2)
+            raise _timeout_error()
+        release.set()
+        return "from hedge"
+
+    result, ep = hedging.run_hedged("complete", call)
+    assert result == "from hedge"
+    primary, second = list(threads.values())
+    assert primary is caller and second is not caller
+    assert hedging.hedges["sent"] == 1 and hedging.hedges["won"] == 1
+
+
+def test_fast_primary_sends_no_hedge(hedging):
+    result, ep = hedging.run_hedged("complete", lambda ep: "fast")
+    assert result == "fast"
+    time.sleep(0.1)
+    assert hedging.hedges["sent"] == 0
+
+
+def test_losing_hedge_is_cancelled(hedging):
+    hedge_started = threading.Event()
+    answered = threading.Event()
+    outcome = {}
+
+    def call(ep):
+        if threading.current_thread() is caller:
+            # основная медленнее порога, но отвечает, пока дубль ещё в пути
+            assert hedge_started.wait(2)
+            hedging.on_success(ep, "complete", 0.1)
+            return "primary"
+        hedge_started.set()
+        answered.wait(2)
+        outcome["cancelled"] = hedging.attempt_cancelled()
+        if outcome["cancelled"]:
+            raise HedgeCancelled()
+        return "late hedge"
+
+    caller = threading.current_thread()
+    result, ep = hedging.run_hedged("complete", call)
+    answered.set()
+    assert result == "primary"
+    deadline = time.monotonic() + 2
+    while hedging.hedges["cancelled"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert outcome == {"cancelled": True}
+    assert hedging.hedges["sent"] == 1 and hedging.hedges["cancelled"] == 1
+    assert all(e.inflight == 0 and e.failures == 0 for e in hedging.endpoints)
+    # в основном потоке отмены нет
+    assert not hedging.attempt_cancelled()
+
+
+def _chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+
+def test_mid_stream_failure_counts_against_endpoint(router, monkeypatch):
+    import groq_client
+
+    def broken_stream(ep, kind, messages, **extra):
+        yield _chunk("нача")
+        raise groq.APIConnectionError(request=httpx.Request("POST", "https://api.groq.com/"))
+
+    monkeypatch.setattr(groq_client, "router", router)
+    monkeypatch.setattr(groq_client, "_create", broken_stream)
+    # одна точка — чтобы обе попытки пришлись на неё
+    router.endpoints = router.endpoints[:1]
+    ep = router.endpoints[0]
+
+    for _ in range(2):
+        parts = []
+        with pytest.raises(groq.APIConnectionError):
+            for delta in groq_client.ask_groq_stream(messages=[{"role": "user", "content": "?"}]):
+                parts.append(delta)
+        assert parts == ["нача"]
+
+    assert ep.state == OPEN
+    assert ep.error_rate > 0
+    assert ep.inflight == 0
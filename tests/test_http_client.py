@@ -0,0 +1,94 @@
+# tests/test_http_client.py
+import io
+
+import pytest
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+import http_client
+
+
+class FakeSession:
+    """Отдаёт заготовленные ответы/исключения по очереди и считает попытки."""
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def request(self, method, url, timeout=None, **kwargs):
+        self.calls += 1
+        out = self.outcomes.pop(0)
+        if isinstance(out, Exception):
+            raise out
+        return out
+
+
+def _resp(status, headers=None):
+    r = requests.Response()
+    r.status_code = status
+    r.headers.update(headers or {})
+    r.raw = io.BytesIO(b"")
+    return r
+
+
+def _refused():
+    reason = NewConnectionError(None, "Connection refused")
+    return requests.ConnectionError(MaxRetryError(None, "/", reason))
+
+
+@pytest.fixture
+def session(monkeypatch):
+    monkeypatch.setattr(http_client, "_backoff", lambda attempt: 0.0)
+
+    def install(*outcomes):
+        s = FakeSession(outcomes)
+        monkeypatch.setattr(http_client, "get_session", lambda: s)
+        return s
+
+    return install
+
+
+@pytest.mark.parametrize("status", [502, 504])
+def test_post_is_not_retried_on_gateway_errors(session, status):
+    s = session(_resp(status), _resp(200))
+    assert http_client.post("http://x/").status_code == status
+    assert s.calls == 1
+
+
+def test_post_is_not_retried_after_reset(session):
+    # соединение оборвалось после отправки тела — генерация могла уже списать кредиты
+    s = session(requests.ConnectionError("Connection aborted"), _resp(200))
+    with pytest.raises(requests.ConnectionError):
+        http_client.post("http://x/")
+    assert s.calls == 1
+
+
+def test_post_is_not_retried_on_read_timeout(session):
+    s = session(requests.ReadTimeout(), _resp(200))
+    with pytest.raises(requests.ReadTimeout):
+        http_client.post("http://x/")
+    assert s.calls == 1
+
+
+@pytest.mark.parametrize("error", [requests.ConnectTimeout, _refused])
+def test_post_is_retried_when_not_connected(session, error):
+    s = session(error(), _resp(200))
+    assert http_client.post("http://x/").status_code == 200
+    assert s.calls == 2
+
+
+@pytest.mark.parametrize("status", [429, 503])
+def test_post_is_retried_only_with_retry_after(session, status):
+    s = session(_resp(status, {"Retry-After": "0"}), _resp(200))
+    assert http_client.post("http://x/").status_code == 200
+    assert s.calls == 2
+
+    s = session(_resp(status), _resp(200))
+    assert http_client.post("http://x/").status_code == status
+    assert s.calls == 1
+
+
+def test_idempotent_get_is_retried(session):
+    s = session(requests.ConnectionError("reset"), requests.ReadTimeout(), _resp(502))
+    assert http_client.get("http://x/").status_code == 502
+    assert s.calls == 3
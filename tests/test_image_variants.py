@@ -0,0 +1,43 @@
+# tests/test_image_variants.py
+import io
+import os
+
+import pytest
+
+import image_variants
+from image_store import ImageStore
+
+Image = pytest.importorskip("PIL.Image")
+
+
+@pytest.fixture
+def stored(tmp_path):
+    store = ImageStore(str(tmp_path), 50 * 1024 * 1024)
+    buf = io.BytesIO()
+    Image.new("RGB", (1024, 768), (200, 100, 50)).save(buf, format="PNG")
+    name = store.put(buf.getvalue())
+    return store, name.rsplit(".", 1)[0]
+
+
+def test_only_missing_variant_is_encoded(stored, monkeypatch):
+    store, key = stored
+    names = image_variants.make_variants(store, key)
+    assert f"{key}-thumb.webp" in names
+
+    os.remove(store.path_for(f"{key}-thumb.webp"))
+    encoded = []
+    real_encode = image_variants._encode
+
+    def counting_encode(img, fmt):
+        encoded.append((img.size, fmt))
+        return real_encode(img, fmt)
+
+    monkeypatch.setattr(image_variants, "_encode", counting_encode)
+    assert image_variants.make_variants(store, key) == names
+    assert len(encoded) == 1 and encoded[0][1] == "webp" and max(encoded[0][0]) <= image_variants.IMAGE_THUMB_MAX
+    assert store.path_for(f"{key}-thumb.webp")
+
+    # всё на месте — ничего не кодируется
+    encoded.clear()
+    image_variants.make_variants(store, key)
+    assert encoded == []
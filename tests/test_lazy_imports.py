@@ -0,0 +1,31 @@
+# tests/test_lazy_imports.py
+"""Тяжёлые SDK грузятся при первом вызове, а не при импорте (чистый интерпретатор на каждый случай)."""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _loaded(module, tmp_path):
+    code = f"import json, sys; import {module}; print(json.dumps(sorted({{m.split('.')[0] for m in sys.modules}})))"
+    env = dict(os.environ, ACCESS_DB_PATH=str(tmp_path / "lazy.db"), GROQ_API_KEY="test", BOT_TOKEN="123:test")
+    out = subprocess.run(
+        [sys.executable, "-c", code], cwd=REPO, env=env, capture_output=True, text=True, timeout=60, check=True
+    ).stdout
+    return set(json.loads(out.strip().splitlines()[-1]))
+
+
+@pytest.mark.parametrize(
+    "module, absent",
+    [
+        ("api", {"groq", "stability_sdk", "requests", "PIL"}),
+        ("bot", {"groq", "stability_sdk", "stability_client", "flask", "flask_cors", "requests", "PIL"}),
+        ("storage", {"groq", "flask", "telegram", "requests", "PIL"}),
+    ],
+)
+def test_import_does_not_load_sdks(module, absent, tmp_path):
+    assert not _loaded(module, tmp_path) & absent
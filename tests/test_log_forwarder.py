@@ -0,0 +1,24 @@
+# tests/test_log_forwarder.py
+import os
+
+from log_forwarder import LogForwarder
+
+
+def test_child_does_not_resend_parent_queue(monkeypatch):
+    fwd = LogForwarder("123:test", -100)
+    monkeypatch.setattr(fwd, "_ensure_thread", lambda: None)  # без сети: поток отправки не запускаем
+    fwd.enqueue("из родителя")
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        fwd._after_fork()  # как register_at_fork в модуле
+        os.write(write_fd, str(fwd.stats()["queued"]).encode())
+        os._exit(0)
+    os.close(write_fd)
+    child_queued = os.read(read_fd, 16).decode()
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+
+    assert child_queued == "0"
+    assert fwd.stats()["queued"] == 1
@@ -0,0 +1,56 @@
+# tests/test_memory_budget.py
+import api
+
+
+def _turns(n, text="x" * 40):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "text": f"{i} {text}"} for i in range(n)]
+
+
+def _cost(m):
+    return api.estimate_tokens(m["text"]) + api._MSG_OVERHEAD_TOKENS
+
+
+def test_budget_lookup_order(monkeypatch):
+    monkeypatch.setattr(api, "MEMORY_TOKEN_BUDGETS", {"short": 800, "big-model": 4000, "big-model:short": 1000})
+    monkeypatch.setattr(api, "MEMORY_TOKEN_BUDGET", 1500)
+    assert api.memory_budget("short", "big-model") == 1000
+    assert api.memory_budget("detail", "Big-Model") == 4000
+    assert api.memory_budget("short", "small-model") == 800
+    assert api.memory_budget("steps", "small-model") == 1500
+
+
+def test_chat_budget_fits_every_model_in_pool(monkeypatch):
+    # роутер может отдать запрос запасной модели с меньшим контекстом
+    monkeypatch.setattr(api, "MEMORY_TOKEN_BUDGETS", {"big-model": 4000, "small-model": 600})
+    monkeypatch.setattr(api, "MEMORY_TOKEN_BUDGET", 1500)
+    assert api.chat_memory_budget("steps", ["big-model", "small-model"]) == 600
+    assert api.chat_memory_budget("steps", ["big-model"]) == 4000
+    assert api.chat_memory_budget("steps", []) == 1500
+
+
+def test_history_within_budget_is_kept_whole():
+    history = _turns(4)
+    kept, summary, used = api.select_memory(history, 10_000)
+    assert kept == history and summary is None
+    assert used == sum(_cost(m) for m in history)
+
+
+def test_trims_oldest_turns_and_summarizes_them(monkeypatch):
+    monkeypatch.setattr(api, "MEMORY_SUMMARY_TOKENS", 30)
+    history = _turns(20)
+    budget = 100
+    kept, summary, used = api.select_memory(history, budget)
+
+    # остались самые свежие ходы, по порядку
+    assert kept == history[-len(kept):] and 0 < len(kept) < len(history)
+    assert sum(_cost(m) for m in kept) <= budget - api.MEMORY_SUMMARY_TOKENS
+    # сводка — о выпавших вопросах пользователя, свежие темы в приоритете
+    assert summary.startswith("Earlier in this chat the user asked about: ")
+    dropped = history[: len(history) - len(kept)]
+    assert [m for m in dropped if m["role"] == "user"][-1]["text"] in summary
+    assert used <= budget
+
+
+def test_zero_budget_keeps_nothing():
+    kept, summary, used = api.select_memory(_turns(3), 0)
+    assert kept == [] and summary is None and used == 0
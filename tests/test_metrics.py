@@ -0,0 +1,76 @@
+# tests/test_metrics.py
+import os
+
+import pytest
+
+import api
+import metrics
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    reg = metrics.Registry()
+    monkeypatch.setattr(metrics, "REGISTRY", reg)
+    return reg
+
+
+def test_exposition_format(registry):
+    c = registry.counter("demo_total", "Demo counter", ["path"])
+    c.labels('/a"b\\c\n').inc(2)
+    g = registry.gauge("demo_depth", "Demo gauge")
+    g.set_function(lambda: 1 / 0)
+    h = registry.histogram("demo_seconds", "Demo histogram", buckets=(0.1, 1.0))
+    for v in (0.05, 0.5, 0.5, 5):
+        h.observe(v)
+
+    lines = metrics.render().splitlines()
+    assert lines[:2] == ["# HELP demo_depth Demo gauge", "# TYPE demo_depth gauge"]
+    # функция gauge упала — NaN, а не ошибка всего /metrics
+    assert "demo_depth NaN" in lines
+    # бакеты накопительные, последний +Inf равен _count
+    assert lines[lines.index("# TYPE demo_seconds histogram") + 1 :][:5] == [
+        'demo_seconds_bucket{le="0.1"} 1',
+        'demo_seconds_bucket{le="1"} 3',
+        'demo_seconds_bucket{le="+Inf"} 4',
+        "demo_seconds_sum 6.05",
+        "demo_seconds_count 4",
+    ]
+    assert 'demo_total{path="/a\\"b\\\\c\\n"} 2' in lines
+
+
+def test_metrics_endpoint_content_type():
+    r = api.api.test_client().get("/metrics")
+    assert r.status_code == 200
+    assert r.headers["Content-Type"] == metrics.CONTENT_TYPE
+    assert "# TYPE http_request_seconds histogram" in r.get_data(as_text=True)
+
+
+def test_workers_are_summed_and_survive_exit(registry, monkeypatch, tmp_path):
+    monkeypatch.setattr(metrics, "_mp_dir", None)
+    metrics.enable_multiprocess(str(tmp_path))
+    c = registry.counter("jobs_total", "Jobs", ["kind"])
+    g = registry.gauge("queue_depth", "Queue")
+    h = registry.histogram("job_seconds", "Job time", buckets=(1.0,))
+
+    pid = os.fork()
+    if pid == 0:
+        # «другой воркер»: насчитал своё, сбросил снимок и завершился
+        c.labels("a").inc(3)
+        g.set(7)
+        h.observe(0.5)
+        metrics.flush()
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+    c.labels("a").inc(2)
+    g.set(1)
+    h.observe(2)
+    for _ in range(2):  # второй раз — уже из dead.json
+        lines = metrics.render().splitlines()
+        assert 'jobs_total{kind="a"} 5' in lines
+        assert ['job_seconds_bucket{le="1"} 1', 'job_seconds_bucket{le="+Inf"} 2'] == [
+            line for line in lines if line.startswith("job_seconds_bucket")
+        ]
+        # gauge — только живые процессы, у каждого своя серия
+        assert [line for line in lines if line.startswith("queue_depth")] == [f'queue_depth{{pid="{os.getpid()}"}} 1']
+    assert not os.path.exists(tmp_path / f"{pid}.json")
@@ -0,0 +1,61 @@
+# tests/test_rate_limit.py
+import pytest
+
+import rate_limit
+from rate_limit import TokenBuckets
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = FakeClock()
+    monkeypatch.setattr(rate_limit, "time", c)
+    return c
+
+
+def test_burst_then_wait(clock):
+    tb = TokenBuckets({"chat": (3, 60.0)}, 100, 3)
+    assert [tb.take(1, "chat") for _ in range(3)] == [0.0, 0.0, 0.0]
+    # жетон восполняется за 60/3 = 20 с
+    assert tb.take(1, "chat") == pytest.approx(20.0)
+    clock.now += 10
+    assert tb.take(1, "chat") == pytest.approx(10.0)
+    clock.now += 10
+    assert tb.take(1, "chat") == 0.0
+    assert tb.stats()["allowed"] == 4 and tb.stats()["rejected"] == 2
+
+
+def test_users_and_endpoints_are_separate(clock):
+    tb = TokenBuckets({"chat": (1, 60.0), "image": (1, 60.0)}, 100, 3)
+    assert tb.take(1, "chat") == 0.0
+    assert tb.take(1, "chat") > 0
+    assert tb.take(2, "chat") == 0.0
+    assert tb.take(1, "image") == 0.0
+    # эндпоинт без лимита не ограничивается
+    assert tb.take(1, "stats") == 0.0
+
+
+def test_priority_gets_bigger_bucket(clock):
+    tb = TokenBuckets({"image": (2, 60.0)}, 100, 3)
+    assert sum(tb.take(7, "image", priority=True) == 0.0 for _ in range(10)) == 6
+    assert sum(tb.take(8, "image") == 0.0 for _ in range(10)) == 2
+
+
+def test_idle_and_excess_buckets_are_evicted(clock):
+    tb = TokenBuckets({"chat": (5, 60.0)}, 3, 1)
+    for uid in range(5):
+        tb.take(uid, "chat")
+    assert tb.stats()["buckets"] <= 3
+
+    clock.now += 61
+    tb.take(100, "chat")
+    # старые ведра полные — удалены; новое ведро на месте
+    assert tb.stats()["buckets"] == 1
+    assert tb.take(0, "chat") == 0.0
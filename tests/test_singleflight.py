@@ -0,0 +1,114 @@
+# tests/test_singleflight.py
+import threading
+
+import pytest
+
+import api
+import storage
+from singleflight import DONE, LEAD, WAIT, FlightTable
+
+
+@pytest.fixture
+def chat(monkeypatch):
+    """Клиент API с подменённым Groq; calls — сколько раз реально спросили модель."""
+    calls = []
+
+    def fake_ask_groq(messages=None, **kwargs):
+        calls.append(messages[-1]["content"])
+        return f"ответ {len(calls)}"
+
+    monkeypatch.setattr(api, "ask_groq", fake_ask_groq)
+    monkeypatch.setattr(api, "_log_chat_turn", lambda ctx, reply: None)
+    monkeypatch.setattr(api, "send_log_to_group", lambda text: (True, "test"))
+    client = api.api.test_client()
+
+    def post(payload, headers=None):
+        return client.post("/api/chat", json=payload, headers=headers or {})
+
+    post.calls = calls
+    return post
+
+
+def test_error_is_not_replayed_after_access_changes(chat):
+    uid = 15001
+    storage.set_free(uid, False)
+    r = chat({"tg_user_id": uid, "text": "привет"})
+    assert r.status_code == 402
+
+    storage.set_free(uid, True)
+    r = chat({"tg_user_id": uid, "text": "привет"})
+    assert r.status_code == 200
+    assert "Idempotent-Replayed" not in r.headers
+
+
+def test_error_is_not_replayed_for_explicit_key(chat):
+    uid = 15002
+    storage.set_free(uid, False)
+    headers = {"Idempotency-Key": "k-15002"}
+    assert chat({"tg_user_id": uid, "text": "вопрос"}, headers).status_code == 402
+
+    storage.set_free(uid, True)
+    r = chat({"tg_user_id": uid, "text": "вопрос"}, headers)
+    assert r.status_code == 200
+    assert "Idempotent-Replayed" not in r.headers
+
+
+def test_same_text_without_key_is_asked_again(chat):
+    uid = 15003
+    storage.set_free(uid, True)
+    first = chat({"tg_user_id": uid, "text": "да"})
+    second = chat({"tg_user_id": uid, "text": "да"})
+    assert first.status_code == second.status_code == 200
+    assert "Idempotent-Replayed" not in second.headers
+    assert len(chat.calls) == 2
+
+
+def test_explicit_key_replays_success(chat):
+    uid = 15004
+    storage.set_free(uid, True)
+    headers = {"Idempotency-Key": "k-15004"}
+    first = chat({"tg_user_id": uid, "text": "один раз"}, headers)
+    second = chat({"tg_user_id": uid, "text": "один раз"}, headers)
+    assert second.headers.get("Idempotent-Replayed") == "true"
+    assert second.get_json() == first.get_json()
+    assert len(chat.calls) == 1
+
+    conflict = chat({"tg_user_id": uid, "text": "другое"}, headers)
+    assert conflict.status_code == 422
+
+
+def test_concurrent_copies_share_one_call():
+    table = FlightTable(100)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def work():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "result"
+
+    results = {}
+    lead = threading.Thread(target=lambda: results.setdefault("lead", table.do("k", "fp", work, lambda r: 0)))
+    lead.start()
+    started.wait(5)
+    follower = threading.Thread(target=lambda: results.setdefault("follower", table.do("k", "fp", work, lambda r: 0)))
+    follower.start()
+    # дождаться, пока копия встанет в ожидание
+    while table.stats()["coalesced"] == 0:
+        threading.Event().wait(0.01)
+    release.set()
+    lead.join(5)
+    follower.join(5)
+
+    assert results["lead"] == ("result", LEAD)
+    assert results["follower"] == ("result", WAIT)
+    assert len(calls) == 1
+    # ttl 0 — после ответа ничего не хранится, следующий запрос выполняется заново
+    assert table.do("k", "fp", lambda: "again", lambda r: 0) == ("again", LEAD)
+
+
+def test_ttl_replay_and_expiry():
+    table = FlightTable(100)
+    assert table.do("k", "fp", lambda: "v1", lambda r: 60) == ("v1", LEAD)
+    assert table.do("k", "fp", lambda: "v2", lambda r: 60) == ("v1", DONE)
@@ -0,0 +1,144 @@
+# tests/test_storage.py
+import os
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+import storage
+
+LATEST = storage.SCHEMA_MIGRATIONS[-1][0]
+
+
+@pytest.fixture
+def fresh_db(monkeypatch, tmp_path):
+    """Отдельный файл БД со своим пулом; возвращает путь."""
+    path = str(tmp_path / "fresh.db")
+    monkeypatch.setattr(storage, "DB_PATH", path)
+    monkeypatch.setattr(storage, "_db_idle", [])
+    monkeypatch.setattr(storage, "_db_ready", False)
+    return path
+
+
+def _tables(path):
+    con = sqlite3.connect(path)
+    try:
+        return {row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    finally:
+        con.close()
+
+
+def test_fresh_db_migrates_to_latest(fresh_db):
+    assert storage.db_migrate() == LATEST
+    assert {"access", "chat_memory", "image_jobs", "broadcasts", "telegram_updates", "access_generation"} <= _tables(
+        fresh_db
+    )
+    # повторный запуск ничего не делает
+    assert storage.db_migrate() == LATEST
+
+
+def test_old_db_gets_menu_columns_and_keeps_rows(fresh_db):
+    con = sqlite3.connect(fresh_db)
+    con.execute("CREATE TABLE access (user_id INTEGER PRIMARY KEY, is_free INTEGER, is_blocked INTEGER, updated_at TEXT)")
+    con.execute("INSERT INTO access VALUES (7, 1, 0, '2024-01-01 00:00:00')")
+    con.commit()
+    con.close()
+
+    assert storage.db_migrate() == LATEST
+    a = storage.get_access(7)
+    assert a["is_free"] is True and a["last_menu_chat_id"] is None
+    storage.set_last_menu(7, 100, 200)
+    assert storage.get_last_menu(7) == (100, 200)
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    """Сверка со счётчиком в БД на каждом обращении."""
+    monkeypatch.setattr(storage, "ACCESS_CACHE_SYNC", 0)
+    monkeypatch.setattr(storage._access_cache, "_sync_at", 0.0)
+    return storage._access_cache
+
+
+def test_own_write_invalidates_only_that_user(cache):
+    storage.set_free(5001, True)
+    storage.set_free(5002, True)
+    assert storage.get_access(5001)["is_free"] and storage.get_access(5002)["is_free"]
+    resets = cache.resets
+
+    storage.set_blocked(5001, True)
+    assert storage.get_access(5001)["is_blocked"] is True
+    # свой счётчик — весь кэш не сбрасывается, соседняя запись осталась
+    assert 5002 in cache._data
+    assert cache.resets == resets
+
+
+def _in_other_process(code):
+    env = dict(os.environ, ACCESS_DB_PATH=storage.DB_PATH)
+    subprocess.run([sys.executable, "-c", "import storage; " + code], check=True, env=env, cwd=os.path.dirname(storage.__file__))
+
+
+def test_block_from_other_process_reaches_cache(cache):
+    storage.set_free(5101, True)
+    assert storage.get_access(5101)["is_blocked"] is False
+
+    _in_other_process("storage.set_blocked(5101, True)")
+    assert storage.get_access(5101)["is_blocked"] is True
+
+    _in_other_process("storage.set_blocked_many([5101], False)")
+    assert storage.get_access(5101)["is_blocked"] is False
+
+
+def test_cache_is_used_between_syncs(cache, monkeypatch):
+    storage.set_free(5201, True)
+    assert storage.get_access(5201)["is_free"] is True
+    monkeypatch.setattr(storage, "ACCESS_CACHE_SYNC", 60)
+    storage.get_access(5201)  # сверка — следующая через минуту
+
+    _in_other_process("storage.set_free(5201, False)")
+    assert storage.get_access(5201)["is_free"] is True
+    cache._sync_at = 0.0
+    assert storage.get_access(5201)["is_free"] is False
+
+
+def test_stale_jobs_fail_at_startup():
+    storage.job_create("stale-queued", 5301, "txt2img", 10)
+    storage.job_create("stale-running", 5301, "txt2img", 10)
+    storage.job_start("stale-running")
+    storage.job_create("finished", 5301, "txt2img", 10)
+    storage.job_finish("finished", {"image_url": "x"}, 200)
+
+    assert storage.job_fail_stale() >= 2
+    for job_id in ("stale-queued", "stale-running"):
+        job = storage.job_get(job_id)
+        assert job["status"] == "error" and job["result"] == {"error": "generation_interrupted"}
+    assert storage.job_get("finished")["status"] == "done"
+    # лимит активных задач пользователя освободился
+    assert storage.job_create("after-restart", 5301, "txt2img", 1)
+
+
+def test_job_is_visible_only_to_owner():
+    storage.job_create("owned", 5401, "txt2img", 10)
+    assert storage.job_get("owned", 5401)["user_id"] == 5401
+    assert storage.job_get("owned", 5402) is None
+
+
+def test_only_one_process_compacts(monkeypatch, tmp_path):
+    monkeypatch.setattr(storage, "MEMORY_COMPACT_LOCK_PATH", str(tmp_path / "compact.lock"))
+    monkeypatch.setattr(storage, "_compact_lock_fd", None)
+    assert storage._hold_compactor_lock()
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # воркер gunicorn, форкнутый от владельца: замок не его и взять его нельзя
+        os.write(write_fd, b"1" if storage._hold_compactor_lock() else b"0")
+        os._exit(0)
+    os.close(write_fd)
+    child_holds = os.read(read_fd, 1)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    assert child_holds == b"0"
+    assert storage._hold_compactor_lock()
+
+    os.close(storage._compact_lock_fd)
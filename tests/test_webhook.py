@@ -0,0 +1,131 @@
+# tests/test_webhook.py
+import asyncio
+import time
+
+import pytest
+
+import bot_webhook
+import storage
+from bot_webhook import WebhookRunner
+
+
+class FakeApp:
+    """Вместо PTB: считает post_init и обработанные апдейты."""
+
+    def __init__(self, processed, post_inits):
+        self.bot = None
+        self.processed = processed
+        self.post_inits = post_inits
+
+    async def process_update(self, update):
+        self.processed.append(update)
+
+    async def stop(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+@pytest.fixture
+def runners(monkeypatch, tmp_path):
+    """Фабрика «воркеров»: у каждого свой WebhookRunner, общие БД и файл замка."""
+    monkeypatch.setattr(bot_webhook, "WEBHOOK_LOCK_PATH", str(tmp_path / "bot.lock"))
+    monkeypatch.setattr(bot_webhook, "WEBHOOK_POLL", 0.02)
+    processed, post_inits = [], []
+
+    async def fake_startup(self):
+        self.app = FakeApp(processed, post_inits)
+        post_inits.append(self)
+
+    async def fake_process(self, update_id, payload, received_at):
+        processed.append(update_id)
+        await asyncio.to_thread(storage.update_finish, update_id)
+
+    monkeypatch.setattr(WebhookRunner, "_startup", fake_startup)
+    monkeypatch.setattr(WebhookRunner, "_process", fake_process)
+    created = []
+
+    def make():
+        r = WebhookRunner(workers=4, max_pending=3)
+        created.append(r)
+        return r
+
+    make.processed = processed
+    make.post_inits = post_inits
+    yield make
+    for r in created:
+        r.stop()
+
+
+def _wait_for(cond, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if cond():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_duplicate_update_id_is_rejected_in_any_worker():
+    first, second = WebhookRunner(1, 100), WebhookRunner(1, 100)
+    assert first.submit({"update_id": 910001}) == "accepted"
+    # повтор доставки пришёл в другой процесс — дедупликация в БД, а не в памяти воркера
+    assert second.submit({"update_id": 910001}) == "duplicate"
+    assert first.submit({"update_id": 910001}) == "duplicate"
+
+
+def test_busy_when_queue_is_full():
+    storage.update_claim(10_000)  # чужие апдейты других тестов — не в счёт
+    r = WebhookRunner(1, storage.update_pending_count() + 2)
+    assert r.submit({"update_id": 920001}) == "accepted"
+    assert r.submit({"update_id": 920002}) == "accepted"
+    assert r.submit({"update_id": 920003}) == "busy"
+    # отвергнутый апдейт не запомнен — повтор Telegram примется, когда место освободится
+    for update_id, _, _ in storage.update_claim(10):
+        storage.update_finish(update_id)
+    assert r.submit({"update_id": 920003}) == "accepted"
+
+
+def test_only_one_worker_runs_the_bot(runners):
+    for update_id, _, _ in storage.update_claim(10_000):
+        storage.update_finish(update_id)
+    a, b = runners(), runners()
+    a.start()
+    assert _wait_for(a.running)
+    b.start()
+    time.sleep(0.2)
+    assert not b.running()
+    assert len(runners.post_inits) == 1
+
+    # апдейт пришёл в воркер без бота — разбирает владелец
+    assert b.submit({"update_id": 930001}) == "accepted"
+    assert _wait_for(lambda: 930001 in runners.processed)
+
+    # владелец завершился — бота подхватывает второй воркер
+    a.stop()
+    assert _wait_for(b.running)
+    assert len(runners.post_inits) == 2
+    assert b.submit({"update_id": 930002}) == "accepted"
+    assert _wait_for(lambda: 930002 in runners.processed)
+    assert runners.processed.count(930001) == 1
+
+
+def test_unfinished_updates_are_requeued():
+    storage.update_enqueue(940001, "{}", 10_000)
+    claimed = [row[0] for row in storage.update_claim(10_000)]
+    assert 940001 in claimed
+    # процесс бота упал, не закончив, — новый владелец возвращает их в очередь
+    assert storage.update_requeue_processing() >= 1
+    assert 940001 in [row[0] for row in storage.update_claim(10_000)]
+    for update_id in claimed:
+        storage.update_finish(update_id)
+
+
+def test_submit_wakes_local_consumer(runners):
+    r = runners()
+    r.start()
+    assert _wait_for(r.running)
+    assert r.submit({"update_id": 950001}) == "accepted"
+    # будит сам submit, а не опрос раз в WEBHOOK_POLL
+    assert _wait_for(lambda: 950001 in runners.processed, timeout=2)
@@ -0,0 +1,112 @@
+# timing.py
+"""
+Разбивка времени одного запроса по этапам.
+
+На запрос заводится RequestTiming в ContextVar; код отмечает этапы через
+span("name"). Одноимённые этапы суммируются (два mem_add -> mem_add с
+count=2). Вне запроса (фоновые потоки, бот) span ничего не делает, кроме
+чтения ContextVar. Разбивка уходит клиенту в заголовке Server-Timing,
+а медленные запросы пишутся в лог целиком.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS") or "2000")
+# файл для медленных запросов (JSON по строке); пусто — печать в stdout
+SLOW_REQUEST_LOG = (os.getenv("SLOW_REQUEST_LOG") or "").strip()
+
+_current: ContextVar[Optional["RequestTiming"]] = ContextVar("request_timing", default=None)
+_log_lock = threading.Lock()
+
+
+class RequestTiming:
+    __slots__ = ("started", "spans", "order")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        # имя -> [мс, сколько раз]
+        self.spans: Dict[str, List[float]] = {}
+        self.order: List[str] = []
+
+    def add(self, name: str, ms: float) -> None:
+        s = self.spans.get(name)
+        if s is None:
+            self.spans[name] = [ms, 1]
+            self.order.append(name)
+        else:
+            s[0] += ms
+            s[1] += 1
+
+    def total_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def breakdown(self) -> List[Dict[str, Any]]:
+        return [
+            {"name": n, "ms": round(self.spans[n][0], 2), "count": int(self.spans[n][1])}
+            for n in self.order
+        ]
+
+    def header(self, total_ms: Optional[float] = None) -> str:
+        parts = []
+        for n in self.order:
+            ms, count = self.spans[n]
+            desc = f';desc="x{int(count)}"' if count > 1 else ""
+            parts.append(f"{n};dur={ms:.1f}{desc}")
+        parts.append(f"total;dur={(total_ms if total_ms is not None else self.total_ms()):.1f}")
+        return ", ".join(parts)
+
+
+def start() -> RequestTiming:
+    rt = RequestTiming()
+    _current.set(rt)
+    return rt
+
+
+def current() -> Optional[RequestTiming]:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    rt = _current.get()
+    if rt is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        rt.add(name, (time.perf_counter() - t0) * 1000)
+
+
+def record(name: str, ms: float) -> None:
+    """Добавить уже измеренный этап (например, время до первого токена стрима)."""
+    rt = _current.get()
+    if rt is not None:
+        rt.add(name, ms)
+
+
+def log_if_slow(rt: RequestTiming, total_ms: float, info: Dict[str, Any]) -> bool:
+    if total_ms < SLOW_REQUEST_MS:
+        return False
+    entry = dict(info)
+    entry.update(
+        ts=time.strftime("%Y-%m-%d %H:%M:%S"),
+        total_ms=round(total_ms, 1),
+        spans=rt.breakdown(),
+    )
+    line = json.dumps(entry, ensure_ascii=False)
+    if SLOW_REQUEST_LOG:
+        try:
+            with _log_lock, open(SLOW_REQUEST_LOG, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+            return True
+        except OSError as e:
+            print("SLOW LOG ERROR:", e)
+    print("SLOW REQUEST:", line)
+    return True
@@ -0,0 +1,3 @@
+# wsgi.py
+# Точка входа для WSGI-сервера: gunicorn -c gunicorn.conf.py wsgi:app
+from api import api as app  # noqa: F401